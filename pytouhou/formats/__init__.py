@@ -4,8 +4,29 @@ This package provides modules to handle the various proprietary file formats
 used by Touhou games.
 """
 
+from struct import Struct
+
+
 class WrongFormatError(Exception):
     pass
 
 class ChecksumError(Exception):
     pass
+
+
+def compile_formats(instructions):
+    """Precompile the argument formats of a dict of opcode → (format, name)
+    instructions.
+
+    Return a dict of opcode → (Struct, has_string), the Struct leaving out
+    the trailing string, if any, as its size is only known from each
+    instruction.
+    """
+
+    structs = {}
+    for opcode, (fmt, name) in instructions.items():
+        has_string = fmt.endswith('s')
+        if has_string:
+            fmt = fmt[:-1]
+        structs[opcode] = Struct('<' + fmt), has_string
+    return structs
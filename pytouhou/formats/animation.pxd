@@ -5,3 +5,4 @@ cdef class Animation:
     cdef public object texture
 
     cdef double size_inv[2]
+    cdef double _size[2]
@@ -16,13 +16,23 @@ cdef class Animation:
     def __init__(self):
         self.version = 0
         self.size_inv[:] = [0, 0]
+        self._size[:] = [0, 0]
         self.first_name = None
         self.secondary_name = None
         self.sprites = {}
         self.scripts = {}
 
+
+    def __deepcopy__(self, memo):
+        # Animations never change once loaded, and can be shared as is.
+        return self
+
     property size:
+        def __get__(self):
+            return (self._size[0], self._size[1])
+
         def __set__(self, tuple value):
             cdef double width, height
             width, height = value
+            self._size[:] = [width, height]
             self.size_inv[:] = [1 / width, 1 / height]
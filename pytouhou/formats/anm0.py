@@ -20,16 +20,23 @@ and animations.
 Almost everything rendered in the game is described by an ANM0 file.
 """
 
-from struct import pack, unpack
-from pytouhou.utils.helpers import read_string, get_logger
+from struct import Struct, pack, unpack_from
+from pytouhou.utils.helpers import get_buffer, unpack_string, get_logger
 
-from pytouhou.formats import WrongFormatError
+from pytouhou.formats import WrongFormatError, compile_formats
 from pytouhou.formats.animation import Animation
 from pytouhou.formats.thtx import Texture
 
 
 logger = get_logger(__name__)
 
+_header = Struct('<IIIIIIIIIIIIIIII')
+_script_offset = Struct('<II')
+_sprite = Struct('<Iffff')
+_instruction_v0 = Struct('<HBB')
+_instruction_v2 = Struct('<HHHH')
+_texture_header = Struct('<HHHHI')
+
 #TODO: refactor/clean up
 
 
@@ -39,6 +46,11 @@ class Script(list):
         self.interrupts = {}
 
 
+    def __deepcopy__(self, memo):
+        # Scripts never change once loaded, and can be shared as is.
+        return self
+
+
 
 class ANM0(Animation):
     _instructions = {0: {0: ('', 'delete'),
@@ -121,16 +133,20 @@ class ANM0(Animation):
                          80: ('I', None)}}
 
 
+    _structs = {version: compile_formats(instructions)
+                for version, instructions in _instructions.items()}
+
+
     @classmethod
     def read(cls, file):
+        data = get_buffer(file)
         anm_list = []
         start_offset = 0
         while True:
-            file.seek(start_offset)
-            nb_sprites, nb_scripts, zero1 = unpack('<III', file.read(12))
-            width, height, fmt, unknown1 = unpack('<IIII', file.read(16))
-            first_name_offset, unused, secondary_name_offset = unpack('<III', file.read(12))
-            version, unknown2, texture_offset, has_data, next_offset, unknown3 = unpack('<IIIIII', file.read(24))
+            (nb_sprites, nb_scripts, zero1, width, height, fmt, unknown1,
+             first_name_offset, unused, secondary_name_offset, version,
+             unknown2, texture_offset, has_data, next_offset,
+             unknown3) = _header.unpack_from(data, start_offset)
 
             if version == 0:
                 assert zero1 == 0
@@ -143,10 +159,13 @@ class ANM0(Animation):
             else:
                 raise WrongFormatError(version)
 
-            instructions = cls._instructions[version]
+            structs = cls._structs[version]
 
-            sprite_offsets = [unpack('<I', file.read(4))[0] for i in range(nb_sprites)]
-            script_offsets = [unpack('<II', file.read(8)) for i in range(nb_scripts)]
+            offset = start_offset + _header.size
+            sprite_offsets = unpack_from('<%dI' % nb_sprites, data, offset)
+            offset += 4 * nb_sprites
+            script_offsets = [_script_offset.unpack_from(data, offset + 8 * i)
+                              for i in range(nb_scripts)]
 
             self = cls()
 
@@ -155,75 +174,75 @@ class ANM0(Animation):
 
             # Names
             if first_name_offset:
-                file.seek(start_offset + first_name_offset)
-                self.first_name = read_string(file, 32, 'ascii') #TODO: 32, really?
+                self.first_name = unpack_string(data, start_offset + first_name_offset, 32, 'ascii') #TODO: 32, really?
             if secondary_name_offset:
-                file.seek(start_offset + secondary_name_offset)
-                self.secondary_name = read_string(file, 32, 'ascii') #TODO: 32, really?
+                self.secondary_name = unpack_string(data, start_offset + secondary_name_offset, 32, 'ascii') #TODO: 32, really?
 
 
             # Sprites
             for offset in sprite_offsets:
-                file.seek(start_offset + offset)
-                idx, x, y, width, height = unpack('<Iffff', file.read(20))
+                idx, x, y, width, height = _sprite.unpack_from(data, start_offset + offset)
                 self.sprites[idx] = x, y, width, height
 
 
             # Scripts
             for i, offset in script_offsets:
-                self.scripts[i] = Script()
+                script = self.scripts[i] = Script()
                 instruction_offsets = []
-                file.seek(start_offset + offset)
+                script_start = offset = start_offset + offset
                 while True:
-                    instruction_offsets.append(file.tell() - (start_offset + offset))
+                    instruction_offsets.append(offset - script_start)
                     if version == 0:
-                        time, opcode, size = unpack('<HBB', file.read(4))
+                        time, opcode, size = _instruction_v0.unpack_from(data, offset)
+                        offset += 4
                     elif version == 2:
-                        opcode, size, time, mask = unpack('<HHHH', file.read(8))
+                        opcode, size, time, mask = _instruction_v2.unpack_from(data, offset)
                         if opcode == 0xffff:
                             break
+                        offset += 8
                         size -= 8
-                    data = file.read(size)
-                    if opcode in instructions:
-                        args = unpack('<%s' % instructions[opcode][0], data)
+                    if opcode in structs:
+                        args = structs[opcode][0].unpack_from(data, offset)
                     else:
-                        args = (data,)
+                        args = (bytes(data[offset:offset+size]),)
                         logger.warn('unknown opcode %d', opcode)
+                    offset += size
 
-                    self.scripts[i].append((time, opcode, args))
+                    script.append((time, opcode, args))
                     if version == 0 and opcode == 0:
                         break
 
                 # Translate offsets to instruction pointers and register interrupts
-                for instr_offset, (j, instr) in zip(instruction_offsets, enumerate(self.scripts[i])):
+                indices = {instr_offset: j for j, instr_offset in enumerate(instruction_offsets)}
+                for j, instr in enumerate(script):
                     time, opcode, args = instr
                     if version == 0:
                         if opcode == 5:
-                            args = (instruction_offsets.index(args[0]),)
+                            args = (indices[args[0]],)
                         elif opcode == 22:
                             interrupt = args[0]
-                            self.scripts[i].interrupts[interrupt] = j + 1
+                            script.interrupts[interrupt] = j + 1
                     elif version == 2:
                         if opcode == 4:
-                            args = (instruction_offsets.index(args[0]), args[1])
+                            args = (indices[args[0]], args[1])
                         elif opcode == 5:
-                            args = (args[0], instruction_offsets.index(args[1]), args[2])
+                            args = (args[0], indices[args[1]], args[2])
                         elif opcode == 21:
                             interrupt = args[0]
-                            self.scripts[i].interrupts[interrupt] = j + 1
+                            script.interrupts[interrupt] = j + 1
                         elif opcode == 69:
-                            args = (args[0], args[1], instruction_offsets.index(args[2]), args[3])
-                    self.scripts[i][j] = time, opcode, args
+                            args = (args[0], args[1], indices[args[2]], args[3])
+                    script[j] = time, opcode, args
 
             # Texture
             if has_data:
-                file.seek(start_offset + texture_offset)
-                magic = file.read(4)
+                offset = start_offset + texture_offset
+                magic = bytes(data[offset:offset+4])
                 assert magic == b'THTX'
-                zero, fmt, width, height, size = unpack('<HHHHI', file.read(12))
+                zero, fmt, width, height, size = _texture_header.unpack_from(data, offset + 4)
                 assert zero == 0
-                data = file.read(size)
-                self.texture = Texture(width, height, fmt, data)
+                offset += 4 + _texture_header.size
+                self.texture = Texture(width, height, fmt, bytes(data[offset:offset+size]))
 
             anm_list.append(self)
 
@@ -20,12 +20,18 @@ aspects of the game, such as enemy movements, attacks, and so on.
 """
 
 import struct
-from struct import pack, unpack, calcsize
+from struct import Struct, pack, unpack_from, calcsize
 
-from pytouhou.utils.helpers import get_logger
+from pytouhou.formats import compile_formats
+from pytouhou.utils.helpers import get_buffer, get_logger
 
 logger = get_logger(__name__)
 
+_header = Struct('<HH')
+_instruction_start = Struct('<IH')
+_instruction_end = Struct('<HHH')
+
+
 class ECL:
     """Handle Touhou 6 ECL files.
 
@@ -162,6 +168,9 @@ class ECL:
                           10: ('II', 'resume_ecl'),
                           12: ('', 'stop_time')}
 
+    _structs = compile_formats(_instructions)
+    _main_structs = compile_formats(_main_instructions)
+
     _parameters = {6: {'main_count': 1,
                        'nb_main_offsets': 3,
                        'jumps_list': {2: 1, 3: 1, 29: 1, 30: 1, 31: 1, 32: 1, 33: 1, 34: 1}}}
@@ -174,63 +183,69 @@ class ECL:
 
     @classmethod
     def read(cls, file, version=6):
-        """Read an ECL file.
+        """Read an ECL file, or a buffer of its content.
 
         Raise an exception if the file is invalid.
         Return a ECL instance otherwise.
         """
 
         parameters = cls._parameters[version]
+        jumps_list = parameters['jumps_list']
+        structs = cls._structs
+        data = get_buffer(file)
 
-        sub_count, main_count = unpack('<HH', file.read(4))
+        sub_count, main_count = _header.unpack_from(data)
 
-        main_offsets = unpack('<%dI' % parameters['nb_main_offsets'], file.read(4 * parameters['nb_main_offsets']))
-        sub_offsets = unpack('<%dI' % sub_count, file.read(4 * sub_count))
+        nb_main_offsets = parameters['nb_main_offsets']
+        main_offsets = unpack_from('<%dI' % nb_main_offsets, data, 4)
+        sub_offsets = unpack_from('<%dI' % sub_count, data, 4 + 4 * nb_main_offsets)
 
         ecl = cls()
 
         # Read subs
         for sub_offset in sub_offsets:
-            file.seek(sub_offset)
-            ecl.subs.append([])
+            sub = []
+            ecl.subs.append(sub)
 
             instruction_offsets = []
 
+            offset = sub_offset
             while True:
-                instruction_offsets.append(file.tell() - sub_offset)
+                instruction_offsets.append(offset - sub_offset)
 
-                time, opcode = unpack('<IH', file.read(6))
+                time, opcode = _instruction_start.unpack_from(data, offset)
                 if time == 0xffffffff or opcode == 0xffff:
                     break
 
-                size, rank_mask, param_mask = unpack('<HHH', file.read(6))
-                data = file.read(size - 12)
-                if opcode in cls._instructions:
-                    fmt = '<%s' % cls._instructions[opcode][0]
-                    if fmt.endswith('s'):
-                        fmt = fmt[:-1]
-                        fmt = '%s%ds' % (fmt, size - 12 - calcsize(fmt))
-                    args = unpack(fmt, data)
-                    if fmt.endswith('s'):
-                        args = args[:-1] + (args[-1].decode('shift_jis'),)
+                size, rank_mask, param_mask = _instruction_end.unpack_from(data, offset + 6)
+                args_offset = offset + 12
+                offset += size
+                if opcode in structs:
+                    struct, has_string = structs[opcode]
+                    args = struct.unpack_from(data, args_offset)
+                    if has_string:
+                        string = bytes(data[args_offset+struct.size:offset])
+                        args += (string.decode('shift_jis'),)
                 else:
-                    args = (data, )
+                    args = (bytes(data[args_offset:offset]),)
                     logger.warn('unknown opcode %d', opcode)
 
-                ecl.subs[-1].append((time, opcode, rank_mask, param_mask, args))
+                sub.append((time, opcode, rank_mask, param_mask, args))
 
 
             # Translate offsets to instruction pointers.
             # Indeed, jump instructions are relative and byte-based.
             # Since our representation doesn't conserve offsets, we have to
             # keep trace of where the jump is supposed to end up.
-            for instr_offset, (i, instr) in zip(instruction_offsets, enumerate(ecl.subs[-1])):
+            instruction_indices = {instr_offset: i for i, instr_offset
+                                   in enumerate(instruction_offsets)}
+            for instr_offset, (i, instr) in zip(instruction_offsets, enumerate(sub)):
                 time, opcode, rank_mask, param_mask, args = instr
-                if opcode in parameters['jumps_list']:
-                    num = parameters['jumps_list'][opcode]
+                if opcode in jumps_list:
+                    num = jumps_list[opcode]
                     args = list(args)
-                    args[num] = instruction_offsets.index(instr_offset + args[num])
-                    ecl.subs[-1][i] = time, opcode, rank_mask, param_mask, tuple(args)
+                    args[num] = instruction_indices[instr_offset + args[num]]
+                    sub[i] = time, opcode, rank_mask, param_mask, tuple(args)
 
 
         # Read main
@@ -238,23 +253,25 @@ class ECL:
             if main_offset == 0:
                 break
 
-            file.seek(main_offset)
-            ecl.mains.append([])
+            main = []
+            ecl.mains.append(main)
+            offset = main_offset
             while True:
-                time, sub = unpack('<HH', file.read(4))
+                time, sub = _header.unpack_from(data, offset)
                 if time == 0xffff and sub == 4:
                     break
 
-                opcode, size = unpack('<HH', file.read(4))
-                data = file.read(size - 8)
+                opcode, size = _header.unpack_from(data, offset + 4)
+                args_offset = offset + 8
+                offset += size
 
-                if opcode in cls._main_instructions:
-                    args = unpack('<%s' % cls._main_instructions[opcode][0], data)
+                if opcode in cls._main_structs:
+                    args = cls._main_structs[opcode][0].unpack_from(data, args_offset)
                 else:
-                    args = (data,)
+                    args = (bytes(data[args_offset:offset]),)
                     logger.warn('unknown main opcode %d', opcode)
 
-                ecl.mains[-1].append((time, sub, opcode, args))
+                main.append((time, sub, opcode, args))
 
         return ecl
 
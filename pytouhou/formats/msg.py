@@ -12,12 +12,17 @@
 ## GNU General Public License for more details.
 ##
 
-from struct import pack, unpack, calcsize
+from struct import Struct, pack, unpack_from
 
-from pytouhou.utils.helpers import get_logger
+from pytouhou.formats import compile_formats
+from pytouhou.utils.helpers import get_buffer, get_logger
 
 logger = get_logger(__name__)
 
+_entry_count = Struct('<I')
+_instruction = Struct('<HBB')
+
+
 class MSG:
     _instructions = {0: ('', None),
                      1: ('hh', None),
@@ -35,6 +40,8 @@ class MSG:
                      13: ('I', None),
                      14: ('', None)} #TODO
 
+    _structs = compile_formats(_instructions)
+
 
     def __init__(self):
         self.msgs = {}
@@ -42,8 +49,9 @@ class MSG:
 
     @classmethod
     def read(cls, file):
-        entry_count, = unpack('<I', file.read(4))
-        entry_offsets = unpack('<%dI' % entry_count, file.read(4 * entry_count))
+        data = get_buffer(file)
+        entry_count, = _entry_count.unpack_from(data)
+        entry_offsets = unpack_from('<%dI' % entry_count, data, 4)
 
         msg = cls()
         msg.msgs = {}
@@ -53,24 +61,22 @@ class MSG:
                 continue                                # If Reimu has less than 10 scripts, the remaining offsets are equal to her first.
 
             msg.msgs[i] = []
-            file.seek(offset)
 
             while True:
-                time, opcode, size = unpack('<HBB', file.read(4))
+                time, opcode, size = _instruction.unpack_from(data, offset)
                 if time == 0 and opcode == 0:
                     break
-                data = file.read(size)
-                if opcode in cls._instructions:
-                    fmt = '<%s' % cls._instructions[opcode][0]
-                    if fmt.endswith('s'):
-                        fmt = fmt[:-1]
-                        fmt = '%s%ds' % (fmt, size - calcsize(fmt))
-                    args = unpack(fmt, data)
-                    if fmt.endswith('s'):
-                        args = args[:-1] + (args[-1].decode('shift_jis'),)
+                offset += 4
+                if opcode in cls._structs:
+                    struct, has_string = cls._structs[opcode]
+                    args = struct.unpack_from(data, offset)
+                    if has_string:
+                        string = bytes(data[offset+struct.size:offset+size])
+                        args += (string.decode('shift_jis'),)
                 else:
-                    args = (data, )
+                    args = (bytes(data[offset:offset+size]), )
                     logger.warn('unknown msg opcode %d', opcode)
+                offset += size
 
                 msg.msgs[i].append((time, opcode, args))
 
@@ -21,11 +21,20 @@ and various scripted events such as camera movement.
 """
 
 
-from struct import pack, unpack, calcsize
-from pytouhou.utils.helpers import read_string, get_logger
+from struct import Struct, pack, unpack_from, calcsize
+from pytouhou.utils.helpers import get_buffer, unpack_string, get_logger
+
+from pytouhou.formats import compile_formats
 
 logger = get_logger(__name__)
 
+_header = Struct('<HHIII')
+_model_header = Struct('<HHffffff')
+_quad_header = Struct('<HH')
+_quad = Struct('<Hxxfffff')
+_object_instance = Struct('<HHfff')
+_instruction = Struct('<IHH')
+
 
 class Model:
     def __init__(self, unknown=0, bounding_box=None, quads=None):
@@ -62,6 +71,8 @@ class Stage:
                      3: ('Ixxxxxxxx', 'start_interpolating_viewpos2'),
                      4: ('Ixxxxxxxx', 'start_interpolating_fog')}
 
+    _structs = compile_formats(_instructions)
+
     def __init__(self):
         self.name = ''
         self.bgms = (('', ''), ('', ''), ('', ''), ('', ''))
@@ -72,78 +83,80 @@ class Stage:
 
     @classmethod
     def read(cls, file):
-        """Read a Stage Definition file.
+        """Read a Stage Definition file, or a buffer of its content.
 
         Raise an exception if the file is invalid.
         Return a STD instance otherwise.
         """
 
+        data = get_buffer(file)
         stage = Stage()
 
-        nb_models, nb_faces = unpack('<HH', file.read(4))
-        object_instances_offset, script_offset, zero = unpack('<III', file.read(12))
+        nb_models, nb_faces, object_instances_offset, script_offset, zero = _header.unpack_from(data)
         assert zero == 0
 
-        stage.name = read_string(file, 128, 'shift_jis')
+        stage.name = unpack_string(data, 16, 128, 'shift_jis')
 
-        bgm_a = read_string(file, 128, 'shift_jis')
-        bgm_b = read_string(file, 128, 'shift_jis')
-        bgm_c = read_string(file, 128, 'shift_jis')
-        bgm_d = read_string(file, 128, 'shift_jis')
+        bgm_a = unpack_string(data, 144, 128, 'shift_jis')
+        bgm_b = unpack_string(data, 272, 128, 'shift_jis')
+        bgm_c = unpack_string(data, 400, 128, 'shift_jis')
+        bgm_d = unpack_string(data, 528, 128, 'shift_jis')
 
-        bgm_a_path = read_string(file, 128, 'ascii')
-        bgm_b_path = read_string(file, 128, 'ascii')
-        bgm_c_path = read_string(file, 128, 'ascii')
-        bgm_d_path = read_string(file, 128, 'ascii')
+        bgm_a_path = unpack_string(data, 656, 128, 'ascii')
+        bgm_b_path = unpack_string(data, 784, 128, 'ascii')
+        bgm_c_path = unpack_string(data, 912, 128, 'ascii')
+        bgm_d_path = unpack_string(data, 1040, 128, 'ascii')
 
         stage.bgms = [None if bgm[0] == u' ' else bgm
             for bgm in ((bgm_a, bgm_a_path), (bgm_b, bgm_b_path), (bgm_c, bgm_c_path), (bgm_d, bgm_d_path))]
 
         # Read model definitions
-        offsets = unpack('<%s' % ('I' * nb_models), file.read(4 * nb_models))
+        offsets = unpack_from('<%dI' % nb_models, data, 1168)
         for offset in offsets:
             model = Model()
-            file.seek(offset)
 
             # Read model header
-            id_, unknown, x, y, z, width, height, depth = unpack('<HHffffff', file.read(28))
+            id_, unknown, x, y, z, width, height, depth = _model_header.unpack_from(data, offset)
             model.unknown = unknown
             model.bounding_box = x, y, z, width, height, depth #TODO: check
+            offset += _model_header.size
 
             # Read model quads
             while True:
-                unknown, size = unpack('<HH', file.read(4))
+                unknown, size = _quad_header.unpack_from(data, offset)
                 if unknown == 0xffff:
                     break
                 assert size == 0x1c
-                script_index, x, y, z, width, height = unpack('<Hxxfffff', file.read(24))
-                model.quads.append((script_index, x, y, z, width, height))
+                model.quads.append(_quad.unpack_from(data, offset + 4))
+                offset += size
             stage.models.append(model)
 
 
         # Read object usages
-        file.seek(object_instances_offset)
+        offset = object_instances_offset
         while True:
-            obj_id, unknown, x, y, z = unpack('<HHfff', file.read(16))
+            obj_id, unknown, x, y, z = _object_instance.unpack_from(data, offset)
             if (obj_id, unknown) == (0xffff, 0xffff):
                 break
             assert unknown == 256 #TODO: really?
             stage.object_instances.append((obj_id, x, y, z))
+            offset += _object_instance.size
 
 
         # Read the script
-        file.seek(script_offset)
+        offset = script_offset
         while True:
-            frame, opcode, size = unpack('<IHH', file.read(8))
+            frame, opcode, size = _instruction.unpack_from(data, offset)
             if (frame, opcode, size) == (0xffffffff, 0xffff, 0xffff):
                 break
             assert size == 0x0c
-            data = file.read(size)
-            if opcode in cls._instructions:
-                args = unpack('<%s' % cls._instructions[opcode][0], data)
+            offset += _instruction.size
+            if opcode in cls._structs:
+                args = cls._structs[opcode][0].unpack_from(data, offset)
             else:
-                args = (data,)
+                args = (bytes(data[offset:offset+size]),)
                 logger.warn('unknown opcode %d', opcode)
+            offset += size
             stage.script.append((frame, opcode, args))
 
         return stage
@@ -20,12 +20,13 @@ a game of EoSD. Since the EoSD engine is entirely deterministic, a small
 replay file is sufficient to unfold a full game.
 """
 
-from struct import unpack, pack
+from struct import Struct, unpack, pack, error as StructError
 from io import BytesIO
 from time import strftime
+from array import array
 
 from pytouhou.utils.helpers import read_string, get_logger
-from pytouhou.formats import ChecksumError
+from pytouhou.formats import ChecksumError, WrongFormatError
 
 logger = get_logger(__name__)
 
@@ -99,7 +100,7 @@ class T6RP:
             decrypted_file = BytesIO()
             file.seek(0)
             decrypted_file.write(file.read(15))
-            decrypted_file.write(b''.join(chr((ord(c) - replay.key - 7*i) & 0xff) for i, c in enumerate(file.read())))
+            decrypted_file.write(bytes((c - replay.key - 7*i) & 0xff for i, c in enumerate(file.read())))
             file = decrypted_file
             file.seek(15)
 
@@ -107,7 +108,7 @@ class T6RP:
         if verify:
             data = file.read()
             file.seek(15)
-            real_sum = (sum(ord(c) for c in data) + 0x3f000318 + replay.key) & 0xffffffff
+            real_sum = (sum(data) + 0x3f000318 + replay.key) & 0xffffffff
             if checksum != real_sum:
                 raise ChecksumError(checksum, real_sum)
 
@@ -155,12 +156,14 @@ class T6RP:
         file.write(pack('<B', self.unknown3))
 
         #TODO: find a more elegant method.
-        n = 9 - len(self.date)
-        file.write(self.date)
-        file.write('\0' * n)
-        n = 9 - len(self.name)
-        file.write(self.name)
-        file.write('\0' * n)
+        date = self.date.encode('ascii') if isinstance(self.date, str) else self.date
+        n = 9 - len(date)
+        file.write(date)
+        file.write(b'\0' * n)
+        name = self.name.encode('ascii') if isinstance(self.name, str) else self.name
+        n = 9 - len(name)
+        file.write(name)
+        file.write(b'\0' * n)
 
         file.write(pack('<HIIfI', self.unknown4, self.score, self.unknown5, self.slowdown, self.unknown6))
 
@@ -189,7 +192,7 @@ class T6RP:
         # Write checksum
         file.seek(15)
         data = file.read()
-        checksum = (sum(ord(c) for c in data) + 0x3f000318 + self.key) & 0xffffffff
+        checksum = (sum(data) + 0x3f000318 + self.key) & 0xffffffff
         file.seek(checksum_offset)
         file.write(pack('<I', checksum))
 
@@ -197,5 +200,195 @@ class T6RP:
         if encrypt:
             file.seek(0)
             encrypted_file.write(file.read(15))
-            encrypted_file.write(b''.join(chr((ord(c) + self.key + 7*i) & 0xff) for i, c in enumerate(file.read())))
+            encrypted_file.write(bytes((c + self.key + 7*i) & 0xff for i, c in enumerate(file.read())))
 
+
+
+
+class KeystateRecorder:
+    """Record the keystates of a level, one per frame.
+
+    Only the changes get stored, in two compact arrays, exactly as they will
+    end up in Level.keys.  If a journal is given, each change is also written
+    to it as soon as it happens.
+    """
+
+    def __init__(self, journal=None):
+        self.times = array('I')
+        self.keys = array('H')
+        self.frame = 0
+        self.journal = journal
+
+
+    def push(self, keystate):
+        keys = self.keys
+        if not keys or keys[-1] != keystate:
+            self.times.append(self.frame)
+            keys.append(keystate)
+            if self.journal is not None:
+                self.journal.write_keys(self.frame, keystate)
+        self.frame += 1
+
+
+    def __len__(self):
+        return self.frame
+
+
+    def __iter__(self):
+        for time, keys in zip(self.times, self.keys):
+            yield time, keys, 0
+
+
+
+class ReplayJournal:
+    """Append-only log of a game being recorded.
+
+    The journal is written as the game goes on, so that a replay can still be
+    recovered if the game crashes before the T6RP file is written.  It starts
+    with a header, followed by one-byte tagged records: b'L' starts a level,
+    b'K' is a keystate change, and b'E' ends a level.
+    """
+
+    magic = b'T6RJ'
+    _header = Struct('<HBB')
+    _level = Struct('<BIHHBbbBI')
+    _keys = Struct('<IH')
+    _end = Struct('<I')
+
+    def __init__(self, file, character, rank, flush_interval=60):
+        self.file = file
+        self.flush_interval = flush_interval
+        self.last_flush = 0
+        file.write(self.magic)
+        file.write(self._header.pack(0x102, character, rank))
+        file.flush()
+
+
+    def start_level(self, stage, level):
+        self.file.write(b'L' + self._level.pack(stage - 1, level.score,
+                                                level.random_seed,
+                                                level.point_items, level.power,
+                                                level.lives, level.bombs,
+                                                level.difficulty, level.unknown))
+        self.file.flush()
+        self.last_flush = 0
+
+
+    def write_keys(self, time, keys):
+        self.file.write(b'K' + self._keys.pack(time, keys))
+        if time - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = time
+
+
+    def end_level(self, nb_frames):
+        self.file.write(b'E' + self._end.pack(nb_frames))
+        self.file.flush()
+
+
+    def close(self):
+        self.file.close()
+
+
+    @classmethod
+    def recover(cls, file):
+        """Rebuild a T6RP out of a journal.
+
+        A truncated last record, as left by a crash, is ignored.
+        """
+
+        magic = file.read(4)
+        if magic != cls.magic:
+            raise WrongFormatError(magic)
+
+        replay = T6RP()
+        replay.version, replay.character, replay.rank = cls._header.unpack(file.read(cls._header.size))
+
+        level = None
+        try:
+            while True:
+                tag = file.read(1)
+                if not tag:
+                    break
+                elif tag == b'L':
+                    level = Level()
+                    (index, level.score, level.random_seed, level.point_items,
+                     level.power, level.lives, level.bombs, level.difficulty,
+                     level.unknown) = cls._level.unpack(file.read(cls._level.size))
+                    replay.levels[index] = level
+                elif tag == b'K':
+                    time, keys = cls._keys.unpack(file.read(cls._keys.size))
+                    level.keys.append((time, keys, 0))
+                elif tag == b'E':
+                    cls._end.unpack(file.read(cls._end.size))
+                    level = None
+                else:
+                    raise WrongFormatError(tag)
+        except StructError:
+            logger.warn('Replay journal truncated, the end of the last level is lost.')
+
+        return replay
+
+
+
+class StateHashes:
+    """Hashes of the game state taken while recording a replay.
+
+    They are stored in a sidecar file next to the replay, as the T6RP format
+    has no room for them, so that playing the replay back can tell on which
+    frames it stopped doing the same thing.  The file starts with a magic,
+    followed by one record per hash.
+    """
+
+    magic = b'T6RH'
+    _hash = Struct('<BII')
+
+    def __init__(self):
+        self.levels = {}
+
+
+    def check(self, stage, hashes):
+        """Compare the hashes taken while playing a level back with the
+        recorded ones.
+
+        Return the first and last frames between which the game diverged, or
+        None if it didn’t.
+        """
+
+        recorded = self.levels.get(stage)
+        if not recorded:
+            return None
+
+        synced = -1
+        for frame in sorted(recorded):
+            if frame not in hashes:
+                break
+            if hashes[frame] != recorded[frame]:
+                logger.error('Replay desynchronised between frames %d and %d '
+                             'of stage %d!', synced + 1, frame, stage)
+                return synced + 1, frame
+            synced = frame
+        return None
+
+
+    @classmethod
+    def read(cls, file):
+        magic = file.read(4)
+        if magic != cls.magic:
+            raise WrongFormatError(magic)
+
+        hashes = cls()
+        while True:
+            data = file.read(cls._hash.size)
+            if len(data) < cls._hash.size:
+                break
+            stage, frame, state_hash = cls._hash.unpack(data)
+            hashes.levels.setdefault(stage, {})[frame] = state_hash
+        return hashes
+
+
+    def write(self, file):
+        file.write(self.magic)
+        for stage, hashes in sorted(self.levels.items()):
+            for frame, state_hash in sorted(hashes.items()):
+                file.write(self._hash.pack(stage, frame, state_hash))
@@ -13,13 +13,40 @@
 ##
 
 
+from math import floor, sqrt
+
 from pytouhou.utils.interpolator import Interpolator
+from pytouhou.utils.frustum import background_matrix, frustum_planes, box_visible
 from pytouhou.vm import ANMRunner
 from pytouhou.game.sprite import Sprite
 
 
+class BackgroundChunk:
+    """Quads of the background close to each other along the camera path.
+
+    Instance variables:
+    box -- bounding box of the quads, as (x1, y1, z1, x2, y2, z2)
+    quads -- list of (order, x, y, z, sprite), order being the rank of the
+             quad in the drawing order of the whole background
+    """
+
+    def __init__(self):
+        self.box = None
+        self.quads = []
+
+
+    def add(self, order, x, y, z, sprite, box):
+        self.quads.append((order, x, y, z, sprite))
+        if self.box is None:
+            self.box = box
+        else:
+            self.box = (tuple(min(a, b) for a, b in zip(self.box[:3], box[:3])) +
+                        tuple(max(a, b) for a, b in zip(self.box[3:], box[3:])))
+
+
+
 class Background:
-    def __init__(self, stage, anm):
+    def __init__(self, stage, anm, chunk_length=256., margin=64.):
         self.stage = stage
         self.anm = anm
         self.last_frame = -1
@@ -34,6 +61,7 @@ class Background:
 
         self.build_models()
         self.build_object_instances()
+        self.build_chunks(chunk_length, margin)
 
 
     def build_object_instances(self):
@@ -59,6 +87,80 @@ class Background:
             self.models.append(quads)
 
 
+    def camera_path(self):
+        """Return the successive positions of the camera, from the script."""
+
+        path = []
+        for frame_num, message_type, args in self.stage.script:
+            if message_type == 0 and (not path or path[-1] != tuple(args)):
+                path.append(tuple(args))
+        return path
+
+
+    def build_chunks(self, chunk_length=256., margin=64.):
+        """Split the quads in chunks of chunk_length along the camera path.
+
+        Quads are sprites animated by their ANM scripts, so their bounding
+        boxes are only estimated from their position and size, enlarged by
+        margin.
+        """
+
+        # The point the camera looks at, rather than its position.
+        path = [(x + 192., y + 224., z) for x, y, z in self.camera_path()]
+        if len(path) < 2:
+            path = [(192., 0., 0.), (192., 1., 0.)]
+        segments = []
+        length = 0.
+        for (x1, y1, z1), (x2, y2, z2) in zip(path, path[1:]):
+            segment_length = sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2 + (z2 - z1) ** 2)
+            segments.append((x1, y1, z1, x2 - x1, y2 - y1, z2 - z1, segment_length, length))
+            length += segment_length
+
+        def position_on_path(x, y, z):
+            best_distance, best_position = None, 0.
+            for x1, y1, z1, dx, dy, dz, segment_length, start in segments:
+                t = 0.
+                if segment_length:
+                    t = ((x - x1) * dx + (y - y1) * dy + (z - z1) * dz) / segment_length ** 2
+                    t = min(max(t, 0.), 1.)
+                distance = ((x1 + t * dx - x) ** 2 + (y1 + t * dy - y) ** 2 +
+                            (z1 + t * dz - z) ** 2)
+                if best_distance is None or distance < best_distance:
+                    best_distance, best_position = distance, start + t * segment_length
+            return best_position
+
+        # Quads without a size override use the size of their sprite.
+        sprite_size = max([max(width, height) for x, y, width, height
+                           in self.anm.sprites.values()] or [0.])
+
+        chunks = {}
+        order = 0
+        for ox, oy, oz, model_id, model in self.object_instances:
+            for ox2, oy2, oz2, width_override, height_override, sprite in model:
+                x, y, z = ox + ox2, oy + oy2, oz + oz2
+                # The quad can be rotated in any direction around its origin.
+                size = (max(width_override, height_override) or sprite_size) + margin
+                box = (x - size, y - size, z - size, x + size, y + size, z + size)
+                index = int(floor(position_on_path(x, y, z) / chunk_length))
+                if index not in chunks:
+                    chunks[index] = BackgroundChunk()
+                chunks[index].add(order, x, y, z, sprite, box)
+                order += 1
+
+        self.chunks = [chunks[index] for index in sorted(chunks)]
+
+
+    def visible_chunks(self, aspect):
+        """Return the indices of the chunks which may be seen by the camera,
+        in its current position, with a viewport of ratio aspect."""
+
+        matrix = background_matrix(self.position_interpolator.values,
+                                   self.position2_interpolator.values, aspect)
+        planes = frustum_planes(matrix)
+        return [i for i, chunk in enumerate(self.chunks)
+                if box_visible(planes, chunk.box)]
+
+
     def update(self, frame):
         for frame_num, message_type, args in self.stage.script:
             if self.last_frame < frame_num <= frame:
@@ -17,7 +17,7 @@ cimport cython
 from libc.math cimport cos, sin, atan2, M_PI as pi
 
 from pytouhou.vm import ANMRunner
-from pytouhou.game.sprite cimport Sprite
+from pytouhou.game.sprite cimport Sprite, DIRTY_TRANSFORM
 
 
 cdef class Bullet(Element):
@@ -176,7 +176,7 @@ cdef class Bullet(Element):
             self.speed = (self.dx ** 2 + self.dy ** 2) ** 0.5
             self.angle = self.sprite.angle = atan2(self.dy, self.dx)
             if self.sprite.automatic_orientation:
-                self.sprite.changed = True
+                self.sprite.dirty |= DIRTY_TRANSFORM
             if self.frame == self.attributes[0]: #TODO: include last frame, or not?
                 self.flags &= ~16
         elif self.flags & 32:
@@ -189,7 +189,7 @@ cdef class Bullet(Element):
             self.dy = sin(self.angle) * self.speed
             self.sprite.angle = self.angle
             if self.sprite.automatic_orientation:
-                self.sprite.changed = True
+                self.sprite.dirty |= DIRTY_TRANSFORM
             if self.frame == self.attributes[0]:
                 self.flags &= ~32
         elif self.flags & 448:
@@ -214,7 +214,7 @@ cdef class Bullet(Element):
                     self.dy = sin(self.angle) * self.speed
                     self.sprite.angle = self.angle
                     if self.sprite.automatic_orientation:
-                        self.sprite.changed = True
+                        self.sprite.dirty |= DIRTY_TRANSFORM
 
                 if count >= 0:
                     self.speed_interpolator = Interpolator((self.speed,), self.frame,
@@ -256,7 +256,7 @@ cdef class Bullet(Element):
                     self.removed = False
                 self.sprite.angle = self.angle
                 if self.sprite.automatic_orientation:
-                    self.sprite.changed = True
+                    self.sprite.dirty |= DIRTY_TRANSFORM
                 self.dx = cos(self.angle) * self.speed
                 self.dy = sin(self.angle) * self.speed
                 self.attributes[0] -= 1
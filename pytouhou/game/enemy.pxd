@@ -1,7 +1,7 @@
 from pytouhou.game.element cimport Element
 from pytouhou.game.game cimport Game
 from pytouhou.game.player cimport Player
-from pytouhou.utils.interpolator cimport Interpolator
+from pytouhou.utils.interpolator cimport Formula
 
 cdef class Callback:
     cdef function
@@ -19,11 +19,13 @@ cdef class Enemy(Element):
     cdef public Callback death_callback, boss_callback, low_life_callback, timeout_callback
     cdef public dict laser_by_id
     cdef public list aux_anm
-    cdef public Interpolator interpolator, speed_interpolator
+    cdef public long move_slot, speed_slot  # In the InterpolatorBanks of the game.
     cdef public object _anms, process
 
     cdef Game _game
     cdef double[2] hitbox_half_size
+    cdef Player _target
+    cdef double _target_x, _target_y
 
     cpdef play_sound(self, index)
     cpdef set_hitbox(self, double width, double height)
@@ -39,15 +41,17 @@ cdef class Enemy(Element):
                     grazing_delay, grazing_extra_duration, unknown,
                     tuple offset=*)
     cpdef Player select_player(self, list players=*)
+    cdef bint update_target(self) except True
     cpdef double get_angle(self, Element target, tuple pos=*) except 42
     cpdef set_anim(self, index)
     cdef bint die_anim(self) except True
     cdef bint drop_particles(self, long number, long color) except True
     cpdef set_aux_anm(self, long number, long index)
     cpdef set_pos(self, double x, double y, double z)
-    cpdef move_to(self, unsigned long duration, double x, double y, double z, formula)
-    cpdef stop_in(self, unsigned long duration, formula)
+    cpdef move_to(self, unsigned long duration, double x, double y, double z, Formula formula)
+    cpdef stop_in(self, unsigned long duration, Formula formula)
     cpdef set_boss(self, bint enable)
+    cdef bint release_slots(self) except True
     cdef bint is_visible(self, long screen_width, long screen_height) except -1
     cdef bint check_collisions(self) except True
     cdef bint handle_callbacks(self) except True
@@ -13,12 +13,30 @@
 ##
 
 from libc.math cimport cos, sin, atan2, M_PI as pi
+from libc.stdlib cimport malloc, free
 
 from pytouhou.vm import ANMRunner
 from pytouhou.game.sprite import Sprite
 from pytouhou.game.bullet cimport Bullet, LAUNCHED
 from pytouhou.game.laser cimport Laser, PlayerLaser
 from pytouhou.game.effect cimport Effect
+from pytouhou.utils.maths cimport ipow
+
+
+cdef Player nearest_player(list players, double x, double y):
+    cdef Player player, nearest = None
+    cdef double distance, nearest_distance = 0.
+
+    # Ties go to the lowest character, then to the first player.  The
+    # squares are rounded like the ** 2 this replaced, see ipow().
+    for player in players:
+        distance = ipow(player.x - x, 2) + ipow(player.y - y, 2)
+        if (nearest is None or distance < nearest_distance or
+                distance == nearest_distance and player.character < nearest.character):
+            nearest = player
+            nearest_distance = distance
+    return nearest
+
 
 
 cdef class Callback:
@@ -51,6 +69,7 @@ cdef class Enemy(Element):
         self._type = _type
 
         self.process = None
+        self._target = None
         self.visible = True
         self.was_visible = False
         self.bonus_dropped = bonus_dropped
@@ -89,8 +108,8 @@ cdef class Enemy(Element):
         self.death_anim = 0
         self.movement_dependant_sprites = None
         self.direction = 0
-        self.interpolator = None #TODO
-        self.speed_interpolator = None
+        self.move_slot = -1
+        self.speed_slot = -1
         self.update_mode = 0
         self.angle = 0.
         self.speed = 0.
@@ -165,8 +184,12 @@ cdef class Enemy(Element):
 
 
     cpdef fire(self, offset=None, bullet_attributes=None, tuple launch_pos=None):
-        cdef unsigned long type_, bullets_per_shot, number_of_shots
-        cdef double speed, speed2, launch_angle, angle
+        cdef unsigned long type_, bullets_per_shot, number_of_shots, shot_nb, bullet_nb
+        cdef double speed, speed2, launch_angle, angle, bullet_angle, shot_speed, angle_step
+        cdef double *angles
+        cdef double *speeds
+        cdef double *draws
+        cdef long nb_bullets, nb_free, i
 
         (type_, type_idx, sprite_idx_offset, bullets_per_shot, number_of_shots,
          speed, speed2, launch_angle, angle, flags) = bullet_attributes or self.bullet_attributes
@@ -193,31 +216,62 @@ cdef class Enemy(Element):
         if type_ != 75:
             launch_angle -= angle * (bullets_per_shot - 1) / 2.
 
+        # Only the first bullets of the volley get fired once the game is
+        # full of them.
         bullets = self._game.bullets
-        nb_bullets_max = self._game.nb_bullets_max
+        nb_bullets = number_of_shots * bullets_per_shot
+        nb_free = self._game.nb_bullets_max - len(bullets)
+        if 0 <= nb_free < nb_bullets:
+            nb_bullets = nb_free
+        if nb_bullets <= 0:
+            return
+
+        # The angle and speed of every bullet, in firing order, and the random
+        # draws they use, in the order the game makes them.
+        angles = <double*>malloc(4 * nb_bullets * sizeof(double))
+        if angles == NULL:
+            raise MemoryError
+        speeds = angles + nb_bullets
+        draws = speeds + nb_bullets
+
+        try:
+            if type_ == 75: # 102h.exe@0x4138cf
+                self._game.prng.fill_double(draws, 2 * nb_bullets)
+            elif type_ == 74: # 102h.exe@0x4138cf
+                self._game.prng.fill_double(draws, nb_bullets)
 
-        for shot_nb in range(number_of_shots):
-            shot_speed = speed if shot_nb == 0 else speed + (speed2 - speed) * float(shot_nb) / float(number_of_shots)
-            bullet_angle = launch_angle
             if type_ in (69, 70, 71, 74):
-                launch_angle += angle
-            for bullet_nb in range(bullets_per_shot):
-                if nb_bullets_max is not None and len(bullets) == nb_bullets_max:
-                    break
-
-                if type_ == 75: # 102h.exe@0x4138cf
-                    bullet_angle = self._game.prng.rand_double() * (launch_angle - angle) + angle
-                if type_ in (74, 75): # 102h.exe@0x4138cf
-                    shot_speed = self._game.prng.rand_double() * (speed - speed2) + speed2
-                bullets.append(Bullet(launch_pos, bullet_type, sprite_idx_offset,
-                                      bullet_angle, shot_speed,
-                                      self.extended_bullet_attributes,
-                                      flags, player, self._game))
+                angle_step = 2. * pi / bullets_per_shot
+            else:
+                angle_step = angle
 
+            i = 0
+            for shot_nb in range(number_of_shots):
+                shot_speed = speed if shot_nb == 0 else speed + (speed2 - speed) * <double>shot_nb / <double>number_of_shots
+                bullet_angle = launch_angle
                 if type_ in (69, 70, 71, 74):
-                    bullet_angle += 2. * pi / bullets_per_shot
-                else:
-                    bullet_angle += angle
+                    launch_angle += angle
+                for bullet_nb in range(bullets_per_shot):
+                    if i == nb_bullets:
+                        break
+                    if type_ == 75:
+                        bullet_angle = draws[2 * i] * (launch_angle - angle) + angle
+                        shot_speed = draws[2 * i + 1] * (speed - speed2) + speed2
+                    elif type_ == 74:
+                        shot_speed = draws[i] * (speed - speed2) + speed2
+                    angles[i] = bullet_angle
+                    speeds[i] = shot_speed
+                    i += 1
+                    bullet_angle += angle_step
+
+            attributes = self.extended_bullet_attributes
+            game = self._game
+            bullets.extend([Bullet(launch_pos, bullet_type, sprite_idx_offset,
+                                   angles[i], speeds[i], attributes, flags,
+                                   player, game)
+                            for i in range(nb_bullets)])
+        finally:
+            free(angles)
 
 
     cpdef new_laser(self, unsigned long variant, laser_type, sprite_idx_offset,
@@ -244,9 +298,22 @@ cdef class Enemy(Element):
 
 
     cpdef Player select_player(self, list players=None):
-        if players is None:
-            players = self._game.players
-        return min(players, key=self.select_player_key)
+        if players is not None:
+            return nearest_player(players, self.x, self.y)
+
+        players = self._game.players
+        if len(players) == 1:
+            return players[0]
+
+        # The target is kept until either the enemy or the players move.
+        if self._target is None or self._target_x != self.x or self._target_y != self.y:
+            self.update_target()
+        return self._target
+
+
+    cdef bint update_target(self) except True:
+        self._target = nearest_player(self._game.players, self.x, self.y)
+        self._target_x, self._target_y = self.x, self.y
 
 
     cpdef double get_angle(self, Element target, tuple pos=None) except 42:
@@ -284,28 +351,47 @@ cdef class Enemy(Element):
     cpdef set_pos(self, double x, double y, double z):
         self.x, self.y = x, y
         self.update_mode = 1
-        self.interpolator = Interpolator((x, y), self._game.frame)
+        # An interpolation without any end, which would never run.
+        if self.move_slot >= 0:
+            self._game.enemy_moves.release(self.move_slot)
+            self.move_slot = -1
 
 
     cpdef move_to(self, unsigned long duration, double x, double y, double z,
-                  formula):
+                  Formula formula):
+        cdef double start[2]
+        cdef double end[2]
+
         frame = self._game.frame
-        self.speed_interpolator = None
+        self.release_slots()
         self.update_mode = 1
-        self.interpolator = Interpolator((self.x, self.y), frame,
-                                         (x, y), frame + duration - 1,
-                                         formula)
+        start[0], start[1] = self.x, self.y
+        end[0], end[1] = x, y
+        self.move_slot = self._game.enemy_moves.add_slot(start, frame, end,
+                                                         frame + duration - 1,
+                                                         formula)
 
         self.angle = atan2(y - self.y, x - self.x)
 
 
-    cpdef stop_in(self, unsigned long duration, formula):
+    cpdef stop_in(self, unsigned long duration, Formula formula):
+        cdef double start = self.speed, end = 0.
+
         frame = self._game.frame
-        self.interpolator = None
+        self.release_slots()
         self.update_mode = 1
-        self.speed_interpolator = Interpolator((self.speed,), frame,
-                                               (0.,), frame + duration - 1,
-                                               formula)
+        self.speed_slot = self._game.enemy_speeds.add_slot(&start, frame, &end,
+                                                           frame + duration - 1,
+                                                           formula)
+
+
+    cdef bint release_slots(self) except True:
+        if self.move_slot >= 0:
+            self._game.enemy_moves.release(self.move_slot)
+            self.move_slot = -1
+        if self.speed_slot >= 0:
+            self._game.enemy_speeds.release(self.speed_slot)
+            self.speed_slot = -1
 
 
     cpdef set_boss(self, bint enable):
@@ -504,20 +590,23 @@ cdef class Enemy(Element):
 
     cdef bint update(self) except True:
         cdef double x, y, speed
+        cdef double *values
 
-        if self.process is not None:
+        # The process tells on which frame it has something to do again.
+        if self.process is not None and self.process.wake_frame <= self._game.frame:
             self.process.run_iteration()
 
         x, y = self.x, self.y
 
         if self.update_mode == 1:
             speed = 0.
-            if self.interpolator:
-                self.interpolator.update(self._game.frame)
-                x, y = self.interpolator.values
-            if self.speed_interpolator:
-                self.speed_interpolator.update(self._game.frame)
-                speed, = self.speed_interpolator.values
+            # Most slots got updated by the game already, only the ones the
+            # process just created are computed there.
+            if self.move_slot >= 0 and self._game.enemy_moves.update_slot(self.move_slot, self._game.frame):
+                values = self._game.enemy_moves.get_values(self.move_slot)
+                x, y = values[0], values[1]
+            if self.speed_slot >= 0 and self._game.enemy_speeds.update_slot(self.speed_slot, self._game.frame):
+                speed = self._game.enemy_speeds.get_values(self.speed_slot)[0]
         else:
             speed = self.speed
             self.speed += self.acceleration
@@ -584,6 +673,3 @@ cdef class Enemy(Element):
 
         self.frame += 1
 
-
-    def select_player_key(self, player):
-        return ((player.x - self.x) ** 2 + (player.y - self.y) ** 2, player.character)
@@ -1,24 +1,35 @@
 from pytouhou.game.effect cimport Effect
+from pytouhou.game.particle cimport ParticleSystem
+from pytouhou.game.item cimport ItemSystem
 from pytouhou.game.player cimport Player
 from pytouhou.game.text cimport Text, NativeText
 from pytouhou.game.music cimport MusicPlayer
+from pytouhou.game.laser cimport LaserHitbox
 from pytouhou.utils.random cimport Random
+from pytouhou.utils.interpolator cimport InterpolatorBank
 
 cdef class Game:
     cdef public long width, height, nb_bullets_max, stage, rank, difficulty, difficulty_min, difficulty_max, frame
-    cdef public list bullet_types, laser_types, item_types, players, enemies, effects, bullets, lasers, cancelled_bullets, players_bullets, players_lasers, items, labels, faces, hints, bonus_list
+    cdef public list bullet_types, laser_types, item_types, players, enemies, effects, bullets, lasers, cancelled_bullets, players_bullets, players_lasers, labels, faces, hints, bonus_list
     cdef public object interface, boss, msg_runner
     cdef public dict texts
     cdef public MusicPlayer sfx_player
     cdef public Random prng
     cdef public double continues
     cdef public Effect spellcard_effect
+    cdef public ParticleSystem particles
+    cdef public ItemSystem items
+    cdef public InterpolatorBank enemy_moves, enemy_speeds
     cdef public tuple spellcard
     cdef public bint time_stop, msg_wait
     cdef public unsigned short deaths_count, next_bonus
+    cdef public long hash_interval
+    cdef public dict state_hashes
 
     cdef long difficulty_counter, last_keystate
     cdef bint friendly_fire
+    cdef LaserHitbox *laser_hitboxes
+    cdef long nb_laser_hitboxes
 
     cdef list msg_sprites(self)
     cdef list lasers_sprites(self)
@@ -42,9 +53,11 @@ cdef class Game:
     cpdef NativeText new_native_text(self, tuple pos, unicode text, align=*)
     cpdef Text new_hint(self, hint)
     cpdef new_face(self, side, effect)
+    cpdef unsigned long state_hash(self)
     cpdef run_iter(self, list keystates)
     cdef bint update_background(self) except True
     cdef bint update_enemies(self) except True
+    cdef bint filter_enemies(self) except True
     cdef bint update_msg(self, long keystate) except True
     cdef bint update_players(self, list keystates) except True
     cdef bint update_effects(self) except True
@@ -12,18 +12,42 @@
 ## GNU General Public License for more details.
 ##
 
-from pytouhou.vm import MSGRunner
+from libc.stdint cimport uint32_t, uint64_t
+from libc.string cimport memcpy
+from libc.stdlib cimport realloc, free
+from copy import deepcopy
+
+from pytouhou.vm import MSGRunner, handler_tables
 
 from pytouhou.game.element cimport Element
 from pytouhou.game.bullet cimport Bullet, LAUNCHED, CANCELLED
 from pytouhou.game.enemy cimport Enemy
-from pytouhou.game.item cimport Item
-from pytouhou.game.particle cimport Particle
-from pytouhou.game.laser cimport Laser, PlayerLaser
+from pytouhou.game.item cimport ItemSystem
+from pytouhou.game.particle cimport ParticleSystem
+from pytouhou.game.laser cimport Laser, PlayerLaser, LaserHitbox, box_contains
 from pytouhou.game.face import Face
 
 
+# 32-bit FNV-1a, fed byte by byte in a fixed order so that hashes don’t
+# depend on the endianness of the machine.
+cdef uint32_t hash_uint64(uint32_t h, uint64_t value) nogil:
+    cdef int i
+    for i in range(8):
+        h = (h ^ ((value >> (8 * i)) & 0xff)) * 16777619
+    return h
+
+
+cdef uint32_t hash_double(uint32_t h, double value) nogil:
+    cdef uint64_t bits
+    memcpy(&bits, &value, sizeof(double))
+    return hash_uint64(h, bits)
+
+
 cdef class Game:
+    def __dealloc__(self):
+        free(self.laser_hitboxes)
+
+
     def __init__(self, players, long stage, long rank, long difficulty, bullet_types,
                  laser_types, item_types, long nb_bullets_max=0, long width=384,
                  long height=448, Random prng=None, interface=None, hints=None,
@@ -37,13 +61,17 @@ cdef class Game:
 
         self.players = players
         self.enemies = []
+        # Movements of the enemies, following the game frame.
+        self.enemy_moves = InterpolatorBank(2)
+        self.enemy_speeds = InterpolatorBank(1)
         self.effects = []
+        self.particles = ParticleSystem(nb_bullets_max)
         self.bullets = []
         self.lasers = []
         self.cancelled_bullets = []
         self.players_bullets = []
         self.players_lasers = [None, None]
-        self.items = []
+        self.items = ItemSystem(item_types, nb_bullets_max)
         self.labels = []
         self.faces = [None, None]
         self.texts = {}
@@ -76,6 +104,72 @@ cdef class Game:
         self.friendly_fire = friendly_fire
         self.last_keystate = 0
 
+        # Hash of the state every hash_interval frames, 0 disabling it.
+        self.hash_interval = 60
+        self.state_hashes = {}
+
+
+    def shared_objects(self):
+        """Return the objects a saved state may refer to but must not copy,
+        as they either never change or outlive the simulation."""
+        shared = [self, self.interface, self.sfx_player,
+                  getattr(self, 'music', None), self.prng, self.bullet_types,
+                  self.laser_types, self.item_types, self.hints]
+        shared.extend(self.bullet_types)
+        shared.extend(self.laser_types)
+        shared.extend(self.item_types)
+        shared.extend(handler_tables)
+        return shared
+
+
+    def save_state(self):
+        """Return a copy of everything the simulation changes, which
+        load_state() can later rewind the game to."""
+        memo = {id(obj): obj for obj in self.shared_objects()}
+
+        # Attributes of subclasses pointing to shared objects are left as is.
+        attributes = getattr(self, '__dict__', None)
+        if attributes is not None:
+            attributes = {key: value for key, value in attributes.items()
+                          if id(value) not in memo}
+
+        state = (self.rank, self.difficulty, self.difficulty_min,
+                 self.difficulty_max, self.difficulty_counter, self.frame,
+                 self.continues, self.time_stop, self.msg_wait,
+                 self.deaths_count, self.next_bonus, self.last_keystate,
+                 self.players, self.enemies, self.enemy_moves,
+                 self.enemy_speeds, self.effects, self.particles,
+                 self.bullets, self.lasers, self.cancelled_bullets,
+                 self.players_bullets, self.players_lasers, self.items,
+                 self.labels, self.faces, self.bonus_list, self.texts,
+                 self.boss, self.msg_runner, self.spellcard_effect,
+                 self.spellcard, attributes)
+        return self.prng.seed, self.prng.counter, deepcopy(state, memo)
+
+
+    def load_state(self, state):
+        seed, counter, saved = state
+        memo = {id(obj): obj for obj in self.shared_objects()}
+
+        # Copy it again, so that the same state can be loaded many times.
+        (self.rank, self.difficulty, self.difficulty_min, self.difficulty_max,
+         self.difficulty_counter, self.frame, self.continues, self.time_stop,
+         self.msg_wait, self.deaths_count, self.next_bonus,
+         self.last_keystate, players, self.enemies, self.enemy_moves,
+         self.enemy_speeds, self.effects, self.particles, self.bullets, self.lasers, self.cancelled_bullets,
+         self.players_bullets, self.players_lasers, self.items, self.labels,
+         self.faces, self.bonus_list, self.texts, self.boss, self.msg_runner,
+         self.spellcard_effect, self.spellcard,
+         attributes) = deepcopy(saved, memo)
+
+        # Those are shared with the next stages, so they have to be modified
+        # in place.
+        self.prng.seed = seed
+        self.prng.counter = counter
+        self.players[:] = players
+        if attributes is not None:
+            self.__dict__.update(attributes)
+
 
     cdef list msg_sprites(self):
         return [face for face in self.faces if face is not None] if self.msg_runner is not None and not self.msg_runner.ended else []
@@ -133,18 +227,13 @@ cdef class Game:
     cpdef drop_bonus(self, double x, double y, long _type, end_pos=None, player=None):
         if _type > 6:
             return
-        if len(self.items) >= self.nb_bullets_max:
+        if self.items.nb_items >= self.nb_bullets_max:
             return #TODO: check
-        item_type = self.item_types[_type]
-        self.items.append(Item((x, y), _type, item_type, self, end_pos=end_pos,
-                               player=player))
+        self.items.add_item(x, y, _type, end_pos, player)
 
 
     cdef bint autocollect(self, Player player) except True:
-        cdef Item item
-
-        for item in self.items:
-            item.autocollect(player)
+        self.items.autocollect(player)
 
 
     cdef bint cancel_bullets(self) except True:
@@ -167,19 +256,13 @@ cdef class Game:
         cdef Player player
         cdef Bullet bullet
         cdef Laser laser
-        cdef Item item
 
-        player = min(self.players, key=select_player_key)
-        item_type = self.item_types[6]
-        items = [Item((bullet.x, bullet.y), 6, item_type, self)
-                 for bullet in self.bullets]
+        player = lowest_score_player(self.players)
+        positions = [(bullet.x, bullet.y) for bullet in self.bullets]
         for laser in self.lasers:
-            items.extend([Item(pos, 6, item_type, self)
-                          for pos in laser.get_bullets_pos()])
+            positions.extend(laser.get_bullets_pos())
             laser.cancel()
-        for item in items:
-            item.autocollect(player)
-        self.items.extend(items)
+        self.items.add_stars(positions, player)
         self.bullets = []
 
 
@@ -215,15 +298,16 @@ cdef class Game:
 
 
     cpdef new_effect(self, pos, long anim, anm=None, long number=1):
-        number = min(number, self.nb_bullets_max - len(self.effects))
+        number = min(number, self.nb_bullets_max - len(self.effects) - self.particles.nb_particles)
         for i in range(number):
             self.effects.append(Effect(pos, anim, anm or self.etama[1]))
 
 
     cpdef new_particle(self, pos, long anim, long amp, long number=1, bint reverse=False, long duration=24):
-        number = min(number, self.nb_bullets_max - len(self.effects))
-        for i in range(number):
-            self.effects.append(Particle(pos, anim, self.etama[1], amp, self, reverse=reverse, duration=duration))
+        number = min(number, self.nb_bullets_max - len(self.effects) - self.particles.nb_particles)
+        if number > 0:
+            x, y = pos
+            self.particles.add(x, y, anim, self.etama[1], amp, self.prng, number, reverse, duration)
 
 
     cpdef new_enemy(self, pos, life, instr_type, bonus_dropped, die_score):
@@ -268,6 +352,35 @@ cdef class Game:
         return face
 
 
+    cpdef unsigned long state_hash(self):
+        """Return a hash of the parts of the state telling two simulations
+        apart the soonest: the PRNG, the players, the enemies and the
+        bullets."""
+
+        cdef uint32_t h = 2166136261
+        cdef Player player
+        cdef Enemy enemy
+        cdef Bullet bullet
+
+        h = hash_uint64(h, self.frame)
+        h = hash_uint64(h, self.prng.seed)
+        h = hash_uint64(h, self.prng.counter)
+        for player in self.players:
+            h = hash_double(h, player.x)
+            h = hash_double(h, player.y)
+            h = hash_uint64(h, player.lives)
+            h = hash_uint64(h, player.score)
+        h = hash_uint64(h, len(self.enemies))
+        for enemy in self.enemies:
+            h = hash_double(h, enemy.x)
+            h = hash_double(h, enemy.y)
+        h = hash_uint64(h, len(self.bullets))
+        for bullet in self.bullets:
+            h = hash_double(h, bullet.x)
+            h = hash_double(h, bullet.y)
+        return h
+
+
     cpdef run_iter(self, list keystates):
         cdef Laser laser
         cdef long i
@@ -281,11 +394,12 @@ cdef class Game:
             self.modify_difficulty(+100)
 
         # 3. Filter out destroyed enemies
-        self.enemies = filter_removed(self.enemies)
+        self.filter_enemies()
         self.effects = filter_removed(self.effects)
+        self.particles.filter_removed()
         self.bullets = filter_removed(self.bullets)
         self.cancelled_bullets = filter_removed(self.cancelled_bullets)
-        self.items = filter_removed(self.items)
+        self.items.filter_removed()
 
         # 4. Let's play!
         # In the original game, updates are done in prioritized functions called "chains"
@@ -316,6 +430,10 @@ cdef class Game:
         # 5. Clean up
         self.cleanup()
 
+        # 6. Keep a trace of the state, to notice desynchronisations.
+        if self.hash_interval > 0 and self.frame % self.hash_interval == 0:
+            self.state_hashes[self.frame] = self.state_hash()
+
         self.frame += 1
 
 
@@ -330,10 +448,36 @@ cdef class Game:
     cdef bint update_enemies(self) except True:
         cdef Enemy enemy
 
+        # The players just moved, so find the one each enemy targets in a
+        # single pass, which their scripts and fire() then read until either
+        # of them moves again.  With a single player there is nothing to do.
+        if len(self.players) > 1:
+            for enemy in self.enemies:
+                enemy.update_target()
+
+        # Their processes may still replace them, but most movements can be
+        # advanced at once.
+        self.enemy_moves.update_all(self.frame)
+        self.enemy_speeds.update_all(self.frame)
+
         for enemy in self.enemies:
             enemy.update()
 
 
+    cdef bint filter_enemies(self) except True:
+        """Filter out the removed enemies, freeing their movements."""
+
+        cdef Enemy enemy
+
+        enemies = []
+        for enemy in self.enemies:
+            if enemy.removed:
+                enemy.release_slots()
+            else:
+                enemies.append(enemy)
+        self.enemies = enemies
+
+
     cdef bint update_msg(self, long keystate) except True:
         cdef long k
 
@@ -378,6 +522,7 @@ cdef class Game:
 
         for effect in self.effects:
             effect.update()
+        self.particles.update()
 
 
     cdef bint update_hints(self) except True:
@@ -395,11 +540,13 @@ cdef class Game:
     cdef bint update_bullets(self) except True:
         cdef Player player
         cdef Bullet bullet
-        cdef Item item
         cdef PlayerLaser player_laser
         cdef Laser laser
         cdef PlayerLaser plaser
-        cdef double player_pos[2]
+        cdef LaserHitbox *hitboxes
+        cdef LaserHitbox *hitbox
+        cdef long i, nb_lasers
+        cdef double x, y
 
         if self.time_stop:
             return False
@@ -414,15 +561,25 @@ cdef class Game:
             if player_laser is not None:
                 player_laser.update()
 
-        for item in self.items:
-            item.update()
+        self.items.update(self.players)
+
+        # Lasers don’t move while the players get checked against them, so
+        # compute where they hit once for all of them.
+        nb_lasers = len(self.lasers)
+        if nb_lasers > self.nb_laser_hitboxes:
+            hitboxes = <LaserHitbox*>realloc(self.laser_hitboxes, nb_lasers * sizeof(LaserHitbox))
+            if hitboxes == NULL:
+                raise MemoryError
+            self.laser_hitboxes = hitboxes
+            self.nb_laser_hitboxes = nb_lasers
+        for i, laser in enumerate(self.lasers):
+            laser.get_hitbox(&self.laser_hitboxes[i])
 
         for player in self.players:
             if not player.touchable:
                 continue
 
             px, py = player.x, player.y
-            player_pos[:] = [px, py]
             phalf_size = <double>player.sht.hitbox
             px1, px2 = px - phalf_size, px + phalf_size
             py1, py2 = py - phalf_size, py + phalf_size
@@ -431,11 +588,13 @@ cdef class Game:
             gx1, gx2 = px - ghalf_size, px + ghalf_size
             gy1, gy2 = py - ghalf_size, py + ghalf_size
 
-            for laser in self.lasers:
-                if laser.check_collision(player_pos):
+            for i in range(nb_lasers):
+                hitbox = &self.laser_hitboxes[i]
+                x, y = px - hitbox.base_pos[0], py - hitbox.base_pos[1]
+                if hitbox.collidable and box_contains(&hitbox.hit, x, y):
                     if player.invulnerable_time == 0:
                         player.collide()
-                elif laser.check_grazing(player_pos):
+                elif hitbox.grazable and box_contains(&hitbox.graze, x, y):
                     player.graze += 1 #TODO
                     player.score += 500 #TODO
                     player.play_sound('graze')
@@ -508,20 +667,12 @@ cdef class Game:
                 self.autocollect(player)
 
             ihalf_size = <double>player.sht.item_hitbox
-            for item in self.items:
-                bx, by = item.x, item.y
-                bx1, bx2 = bx - ihalf_size, bx + ihalf_size
-                by1, by2 = by - ihalf_size, by + ihalf_size
-
-                if not (bx2 < px1 or bx1 > px2
-                        or by2 < py1 or by1 > py2):
-                    item.on_collect(player)
+            self.items.collect(self, player, px1, px2, py1, py2, ihalf_size)
 
 
     cpdef cleanup(self):
         cdef Enemy enemy
         cdef Bullet bullet
-        cdef Item item
         cdef PlayerLaser laser
         cdef long i
 
@@ -533,7 +684,7 @@ cdef class Game:
                 # Filter out-of-screen enemy
                 enemy.removed = True
 
-        self.enemies = filter_removed(self.enemies)
+        self.filter_enemies()
 
         # Filter out-of-scren bullets
         cancelled_bullets = []
@@ -570,15 +721,11 @@ cdef class Game:
         self.lasers = filter_removed(self.lasers)
 
         # Filter out-of-scren items
-        items = []
-        for item in self.items:
-            if item.y < self.height:
-                items.append(item)
-            else:
-                self.modify_difficulty(-3)
-        self.items = items
+        for i in range(self.items.filter_below(self.height)):
+            self.modify_difficulty(-3)
 
         self.effects = filter_removed(self.effects)
+        self.particles.filter_removed()
         self.labels = filter_removed(self.labels)
         self.texts = {key: text for key, text in self.texts.items() if not text.removed}
 
@@ -597,5 +744,12 @@ cdef list filter_removed(list elements):
     return filtered
 
 
-def select_player_key(player):
-    return (player.score, player.character)
+cdef Player lowest_score_player(list players):
+    cdef Player player, lowest = None
+
+    # Ties go to the lowest character, then to the first player.
+    for player in players:
+        if (lowest is None or player.score < lowest.score or
+                player.score == lowest.score and player.character < lowest.character):
+            lowest = player
+    return lowest
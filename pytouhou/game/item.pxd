@@ -1,28 +1,44 @@
-from pytouhou.game.element cimport Element
 from pytouhou.game.game cimport Game
 from pytouhou.game.player cimport Player
 from pytouhou.game.itemtype cimport ItemType
-from pytouhou.utils.interpolator cimport Interpolator
 
 
-cdef class Indicator(Element):
-    cdef Item _item
+cdef enum:
+    ITEM_REMOVED = 1
+    ITEM_MOVING = 2
 
-    cdef void update(self) nogil
 
+cdef class ItemSystem:
+    cdef readonly long capacity, nb_items
+    cdef public list item_types
 
-cdef class Item(Element):
-    cdef public ItemType _item_type
+    # Current, start and end position of every item, as x, y pairs, then
+    # the angle and speed they move along.
+    cdef double *positions
+    cdef double *start_positions
+    cdef double *end_positions
+    cdef double *angles
+    cdef double *speeds
+    cdef unsigned long *frames
 
-    cdef unsigned long frame
-    cdef long _type
-    cdef double angle, speed
-    cdef Game _game
-    cdef Player player
-    cdef Element target
-    cdef Indicator indicator
-    cdef Interpolator speed_interpolator, pos_interpolator
+    # Index in item_types of every item, then the number of the only player
+    # allowed to collect it and of the player it flies to, or -1.
+    cdef long *types
+    cdef long *owners
+    cdef long *targets
+    cdef unsigned char *flags
 
+    cdef bint allocate(self, long capacity) except True
+    cdef long add(self, double x, double y, long _type, long owner) except -1
+    cdef bint add_stars(self, list positions, Player target) except True
     cdef bint autocollect(self, Player player) except True
-    cdef bint on_collect(self, Player player) except True
-    cpdef update(self)
+    cdef bint collect(self, Game game, Player player, double px1, double px2,
+                      double py1, double py2, double half_size) except True
+    cdef bint on_collect(self, Game game, long i, Player player) except True
+    cdef long next_hit(self, long start, double px1, double px2, double py1,
+                       double py2, double half_size) nogil
+    cdef void update_positions(self, double *player_positions) nogil
+    cpdef update(self, list players)
+    cpdef filter_removed(self)
+    cdef long filter_below(self, double height) except -1
+    cdef void move(self, long i, long j) nogil
@@ -12,76 +12,235 @@
 ## GNU General Public License for more details.
 ##
 
-from libc.math cimport cos, sin, atan2, M_PI as pi
-
+cimport cython
 
-cdef class Indicator(Element):
-    def __init__(self, Item item):
-        Element.__init__(self)
+from libc.math cimport cos, sin, atan2, M_PI as pi
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+
+from pytouhou.game.sprite cimport Sprite
+
+
+@cython.cdivision(True)
+cdef double fall_speed(unsigned long frame) nogil:
+    #TODO: find the formulae in the binary.
+    # The speed goes from -2 to 0 during the first 60 frames, then from 0 to 3
+    # during the next 120, computed as Interpolator would, one frame early.
+    if frame < 60:
+        if frame + 1 >= 60:
+            return 0.
+        return -2. + <double>frame / 60. * 2.
+    if frame + 1 >= 180:
+        return 3.
+    return <double>(frame - 60) / 120. * 3.
+
+
+
+cdef class ItemSystem:
+    """Items of a game, stored as one array per attribute.
+
+    An item either moves to its end position during its first 60 frames, or
+    falls right away, until a player autocollects it, from then on flying to
+    that player.  They all get moved and tested against a player in a single
+    loop each, the effects of the collected ones then being applied in the
+    order of the items, like they were when each item was its own object.
+
+    Above the top of the screen, the indicator sprite of its type gets drawn
+    instead of an item.
+    """
+
+    def __init__(self, list item_types, long capacity=0):
+        self.item_types = item_types
+        self.nb_items = 0
+        self.allocate(capacity)
+
+
+    def __dealloc__(self):
+        free(self.positions)
+        free(self.frames)
+        free(self.types)
+        free(self.flags)
+
+
+    def __len__(self):
+        return self.nb_items
+
+
+    def __deepcopy__(self, memo):
+        cdef ItemSystem items = ItemSystem.__new__(ItemSystem)
+
+        memo[id(self)] = items
+        items.item_types = self.item_types
+        items.allocate(self.nb_items)
+        memcpy(items.positions, self.positions, 2 * self.nb_items * sizeof(double))
+        memcpy(items.start_positions, self.start_positions, 2 * self.nb_items * sizeof(double))
+        memcpy(items.end_positions, self.end_positions, 2 * self.nb_items * sizeof(double))
+        memcpy(items.angles, self.angles, self.nb_items * sizeof(double))
+        memcpy(items.speeds, self.speeds, self.nb_items * sizeof(double))
+        memcpy(items.frames, self.frames, self.nb_items * sizeof(unsigned long))
+        memcpy(items.types, self.types, self.nb_items * sizeof(long))
+        memcpy(items.owners, self.owners, self.nb_items * sizeof(long))
+        memcpy(items.targets, self.targets, self.nb_items * sizeof(long))
+        memcpy(items.flags, self.flags, self.nb_items * sizeof(unsigned char))
+        items.nb_items = self.nb_items
+        return items
+
+
+    cdef bint allocate(self, long capacity) except True:
+        """Make room for capacity items, keeping the current ones."""
+
+        cdef double *positions
+        cdef unsigned long *frames
+        cdef long *types
+        cdef unsigned char *flags
+        cdef long n = self.nb_items
+
+        # A single allocation for each type, the arrays of a type being
+        # slices of it.
+        positions = <double*>malloc(8 * capacity * sizeof(double))
+        frames = <unsigned long*>malloc(capacity * sizeof(unsigned long))
+        types = <long*>malloc(3 * capacity * sizeof(long))
+        flags = <unsigned char*>malloc(capacity * sizeof(unsigned char))
+        if capacity and (positions == NULL or frames == NULL or types == NULL or
+                         flags == NULL):
+            free(positions)
+            free(frames)
+            free(types)
+            free(flags)
+            raise MemoryError
+
+        if n:
+            memcpy(positions, self.positions, 2 * n * sizeof(double))
+            memcpy(positions + 2 * capacity, self.start_positions, 2 * n * sizeof(double))
+            memcpy(positions + 4 * capacity, self.end_positions, 2 * n * sizeof(double))
+            memcpy(positions + 6 * capacity, self.angles, n * sizeof(double))
+            memcpy(positions + 7 * capacity, self.speeds, n * sizeof(double))
+            memcpy(frames, self.frames, n * sizeof(unsigned long))
+            memcpy(types, self.types, n * sizeof(long))
+            memcpy(types + capacity, self.owners, n * sizeof(long))
+            memcpy(types + 2 * capacity, self.targets, n * sizeof(long))
+            memcpy(flags, self.flags, n * sizeof(unsigned char))
+        free(self.positions)
+        free(self.frames)
+        free(self.types)
+        free(self.flags)
+
+        self.positions = positions
+        self.start_positions = positions + 2 * capacity
+        self.end_positions = positions + 4 * capacity
+        self.angles = positions + 6 * capacity
+        self.speeds = positions + 7 * capacity
+        self.frames = frames
+        self.types = types
+        self.owners = types + capacity
+        self.targets = types + 2 * capacity
+        self.flags = flags
+        self.capacity = capacity
+
+
+    cdef long add(self, double x, double y, long _type, long owner) except -1:
+        """Append a falling item, which only owner can collect if not -1,
+        and return its index."""
+
+        cdef long i = self.nb_items
+
+        if i == self.capacity:
+            self.allocate(max(2 * self.capacity, 16))
+
+        self.positions[2*i], self.positions[2*i+1] = x, y
+        self.angles[i] = pi/2
+        self.speeds[i] = 0.
+        self.frames[i] = 0
+        self.types[i] = _type
+        self.owners[i] = owner
+        self.targets[i] = -1
+        self.flags[i] = 0
+        self.nb_items += 1
+
+        # Every item of a type shares its sprite.
+        (<ItemType>self.item_types[_type]).sprite.angle = pi/2
+        return i
+
+
+    def add_item(self, double x, double y, long _type, end_pos=None, Player player=None):
+        """Append an item, moving to end_pos if given before falling, and
+        which only player can collect if given."""
+
+        cdef long i
+
+        i = self.add(x, y, _type, player.number if player is not None else -1)
+        if end_pos:
+            self.flags[i] = ITEM_MOVING
+            self.start_positions[2*i], self.start_positions[2*i+1] = x, y
+            self.end_positions[2*i], self.end_positions[2*i+1] = end_pos[0], end_pos[1]
 
-        self._item = item
-        self.sprite = item._item_type.indicator_sprite.copy()
 
-        self.x = self._item.x
-        self.y = self.sprite._texcoords[3] / 2.
+    cdef bint add_stars(self, list positions, Player target) except True:
+        """Append a star item at each position, all of them already
+        autocollected by target, as a spellcard can turn hundreds of bullets
+        into star items at once."""
 
+        cdef long i
+        cdef double speed = target.sht.autocollection_speed
 
-    cdef void update(self) nogil:
-        #TODO: alpha
-        self.x = self._item.x
+        if self.nb_items + len(positions) > self.capacity:
+            self.allocate(max(2 * self.capacity, self.nb_items + len(positions)))
+        for x, y in positions:
+            i = self.add(x, y, 6, -1)
+            self.targets[i] = target.number
+            self.speeds[i] = speed
 
 
+    cdef bint autocollect(self, Player player) except True:
+        cdef long i
+        cdef double speed = player.sht.autocollection_speed
 
-cdef class Item(Element):
-    def __init__(self, start_pos, long _type, ItemType item_type, Game game,
-                 double angle=pi/2, player=None, end_pos=None,
-                 target=None):
-        Element.__init__(self, start_pos)
+        for i in range(self.nb_items):
+            if self.targets[i] < 0 and self.owners[i] < 0:
+                self.targets[i] = player.number
+                self.speeds[i] = speed
 
-        self._game = game
-        self._type = _type
-        self._item_type = item_type
-        self.sprite = item_type.sprite
 
-        self.frame = 0
-        self.angle = angle
-        self.indicator = None
+    cdef long next_hit(self, long start, double px1, double px2, double py1,
+                       double py2, double half_size) nogil:
+        """Return the index of the first item from start whose hitbox
+        overlaps with the player’s, or nb_items."""
 
-        # The only player allowed to collect that item. If not None,
-        # autocollection is disabled too.
-        self.player = player
+        cdef long i
+        cdef double x, y
 
-        # The player who has autocollected that item.
-        # TODO: do we allow stealing in case another player is in the way?
-        self.target = target
+        for i in range(start, self.nb_items):
+            x, y = self.positions[2*i], self.positions[2*i+1]
+            if not (x + half_size < px1 or x - half_size > px2
+                    or y + half_size < py1 or y - half_size > py2):
+                return i
+        return self.nb_items
 
-        #TODO: find the formulae in the binary.
-        self.speed_interpolator = None
-        if end_pos:
-            self.pos_interpolator = Interpolator(start_pos, 0,
-                                                 end_pos, 60)
-        else:
-            self.speed_interpolator = Interpolator((-2.,), 0,
-                                                   (0.,), 60)
 
-        self.sprite.angle = angle
+    cdef bint collect(self, Game game, Player player, double px1, double px2,
+                      double py1, double py2, double half_size) except True:
+        """Collect every item player touches.
 
+        Collecting can turn the bullets into star items, which then get
+        tested too.
+        """
 
-    property objects:
-        def __get__(self):
-            if self.indicator is not None:
-                return [self.indicator]
-            return [self]
+        cdef long i = 0
 
+        while True:
+            with nogil:
+                i = self.next_hit(i, px1, px2, py1, py2, half_size)
+            if i >= self.nb_items:
+                break
+            self.on_collect(game, i, player)
+            i += 1
 
-    cdef bint autocollect(self, Player player) except True:
-        if self.target is None and self.player is None:
-            self.target = player
-            self.speed = player.sht.autocollection_speed
 
+    cdef bint on_collect(self, Game game, long i, Player player) except True:
+        cdef long _type = self.types[i]
+        cdef double x = self.positions[2*i], y = self.positions[2*i+1]
 
-    cdef bint on_collect(self, Player player) except True:
-        if not (self.player is None or self.player is player):
+        if not (self.owners[i] < 0 or self.owners[i] == player.number):
             return False
 
         old_power = player.power
@@ -90,21 +249,21 @@ cdef class Item(Element):
         color = 'white'
         player.play_sound('item00')
 
-        if self._type == 0 or self._type == 2: # power or big power
+        if _type == 0 or _type == 2: # power or big power
             if old_power < 128:
                 player.power_bonus = 0
                 score = 10
-                player.power += (1 if self._type == 0 else 8)
+                player.power += (1 if _type == 0 else 8)
                 if player.power > 128:
                     player.power = 128
                 for level in (8, 16, 32, 48, 64, 96):
                     if old_power < level and player.power >= level:
-                        label = self._game.new_label((self.x, self.y), b':') # Actually a “PowerUp” character.
+                        label = game.new_label((x, y), b':') # Actually a “PowerUp” character.
                         color = 'blue'
                         label.set_color(color)
                         labeled = True
             else:
-                bonus = player.power_bonus + (1 if self._type == 0 else 8)
+                bonus = player.power_bonus + (1 if _type == 0 else 8)
                 if bonus > 30:
                     bonus = 30
                 if bonus < 9:
@@ -117,78 +276,159 @@ cdef class Item(Element):
                     score = 51200
                     color = 'yellow'
                 player.power_bonus = bonus
-            self._game.modify_difficulty(+1)
+            game.modify_difficulty(+1)
 
-        elif self._type == 1: # point
+        elif _type == 1: # point
             player.points += 1
             poc = <long>player.sht.point_of_collection
             if player.y < poc:
                 score = 100000
-                self._game.modify_difficulty(+30)
+                game.modify_difficulty(+30)
                 color = 'yellow'
             else:
-                score = (728 - <int>(self.y)) * 100 #TODO: check the formula some more.
-                self._game.modify_difficulty(+3)
+                score = (728 - <int>(y)) * 100 #TODO: check the formula some more.
+                game.modify_difficulty(+3)
 
-        elif self._type == 3: # bomb
+        elif _type == 3: # bomb
             if player.bombs < 8:
                 player.bombs += 1
-            self._game.modify_difficulty(+5)
+            game.modify_difficulty(+5)
 
-        elif self._type == 4: # full power
+        elif _type == 4: # full power
             score = 1000
             player.power = 128
 
-        elif self._type == 5: # 1up
+        elif _type == 5: # 1up
             if player.lives < 8:
                 player.lives += 1
-            self._game.modify_difficulty(+200)
+            game.modify_difficulty(+200)
             player.play_sound('extend')
 
-        elif self._type == 6: # star
+        elif _type == 6: # star
             score = 500
 
         if old_power < 128 and player.power == 128:
             #TODO: display “full power”.
-            self._game.change_bullets_into_star_items()
+            game.change_bullets_into_star_items()
 
         if score > 0:
             player.score += score
             if label is None:
-                label = self._game.new_label((self.x, self.y), str(score).encode())
+                label = game.new_label((x, y), str(score).encode())
                 if color != 'white':
                     label.set_color(color)
 
-        self.removed = True
-
-
-    cpdef update(self):
-        cdef bint offscreen
-
-        if self.frame == 60:
-            self.speed_interpolator = Interpolator((0.,), 60,
-                                                   (3.,), 180)
-
-        if self.target is not None:
-            self.angle = atan2(self.target.y - self.y, self.target.x - self.x)
-            self.x += cos(self.angle) * self.speed
-            self.y += sin(self.angle) * self.speed
-        elif self.speed_interpolator is None:
-            self.pos_interpolator.update(self.frame)
-            self.x, self.y = self.pos_interpolator.values
-        else:
-            self.speed_interpolator.update(self.frame)
-            self.speed, = self.speed_interpolator.values
-            dx, dy = cos(self.angle) * self.speed, sin(self.angle) * self.speed
-            self.x += dx
-            self.y += dy
-
-        offscreen = self.y < -self.sprite._texcoords[3] / 2.
-        if offscreen:
-            if self.indicator is None:
-                self.indicator = Indicator(self)
-            self.indicator.update()
-        else:
-            self.indicator = None
-
-        self.frame += 1
+        self.flags[i] |= ITEM_REMOVED
+
+
+    @cython.cdivision(True)
+    cdef void update_positions(self, double *player_positions) nogil:
+        cdef long i, target
+        cdef unsigned long frame
+        cdef double x, y, angle, speed, coeff
+
+        for i in range(self.nb_items):
+            x, y = self.positions[2*i], self.positions[2*i+1]
+            frame = self.frames[i]
+            target = self.targets[i]
+            if target >= 0:
+                angle = atan2(player_positions[2*target+1] - y, player_positions[2*target] - x)
+                self.angles[i] = angle
+                x += cos(angle) * self.speeds[i]
+                y += sin(angle) * self.speeds[i]
+            elif self.flags[i] & ITEM_MOVING and frame < 60:
+                # Same linear interpolation as Interpolator, which also
+                # reaches the end one frame early.
+                if frame + 1 >= 60:
+                    x, y = self.end_positions[2*i], self.end_positions[2*i+1]
+                else:
+                    coeff = <double>frame / 60.
+                    x = self.start_positions[2*i] + coeff * (self.end_positions[2*i] - self.start_positions[2*i])
+                    y = self.start_positions[2*i+1] + coeff * (self.end_positions[2*i+1] - self.start_positions[2*i+1])
+            else:
+                speed = fall_speed(frame)
+                self.speeds[i] = speed
+                x += cos(self.angles[i]) * speed
+                y += sin(self.angles[i]) * speed
+            self.positions[2*i], self.positions[2*i+1] = x, y
+            self.frames[i] = frame + 1
+
+
+    cpdef update(self, list players):
+        cdef Player player
+        cdef long i
+        cdef double *player_positions
+
+        # Players don’t move while items fly to them.
+        player_positions = <double*>malloc(2 * len(players) * sizeof(double))
+        if players and player_positions == NULL:
+            raise MemoryError
+        for i, player in enumerate(players):
+            player_positions[2*i], player_positions[2*i+1] = player.x, player.y
+        with nogil:
+            self.update_positions(player_positions)
+        free(player_positions)
+
+
+    cpdef filter_removed(self):
+        """Forget the collected items."""
+
+        cdef long i, j = 0
+
+        for i in range(self.nb_items):
+            if not self.flags[i] & ITEM_REMOVED:
+                self.move(i, j)
+                j += 1
+        self.nb_items = j
+
+
+    cdef long filter_below(self, double height) except -1:
+        """Forget the items which fell below height, and return how many."""
+
+        cdef long i, j = 0
+
+        for i in range(self.nb_items):
+            if self.positions[2*i+1] < height:
+                self.move(i, j)
+                j += 1
+        i = self.nb_items - j
+        self.nb_items = j
+        return i
+
+
+    cdef void move(self, long i, long j) nogil:
+        if i == j:
+            return
+        self.positions[2*j], self.positions[2*j+1] = self.positions[2*i], self.positions[2*i+1]
+        self.start_positions[2*j], self.start_positions[2*j+1] = self.start_positions[2*i], self.start_positions[2*i+1]
+        self.end_positions[2*j], self.end_positions[2*j+1] = self.end_positions[2*i], self.end_positions[2*i+1]
+        self.angles[j] = self.angles[i]
+        self.speeds[j] = self.speeds[i]
+        self.frames[j] = self.frames[i]
+        self.types[j] = self.types[i]
+        self.owners[j] = self.owners[i]
+        self.targets[j] = self.targets[i]
+        self.flags[j] = self.flags[i]
+
+
+    def get_sprites(self):
+        """Return the sprite and position of every visible item, or of its
+        indicator, for the renderers which can’t read the arrays directly."""
+
+        cdef ItemType item_type
+        cdef Sprite sprite
+        cdef long i
+        cdef double x, y
+
+        sprites = []
+        for i in range(self.nb_items):
+            item_type = self.item_types[self.types[i]]
+            sprite = item_type.sprite
+            x, y = self.positions[2*i], self.positions[2*i+1]
+            # Items only get their indicator from their first update on.
+            if self.frames[i] and y < -sprite._texcoords[3] / 2.:
+                sprite = item_type.indicator_sprite
+                y = sprite._texcoords[3] / 2.
+            if sprite is not None and sprite.visible:
+                sprites.append((sprite, x, y))
+        return sprites
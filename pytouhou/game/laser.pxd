@@ -6,6 +6,24 @@ cdef enum State:
     STARTING, STARTED, STOPPING
 
 
+# Rectangle, as one of its corners and its two sides from that corner, along
+# with their squared lengths.
+ctypedef struct Box:
+    double corner[2]
+    double side1[2]
+    double side2[2]
+    double length1, length2
+
+# Where a laser hits and grazes the players during a frame, relative to its
+# base position.
+ctypedef struct LaserHitbox:
+    double base_pos[2]
+    bint collidable, grazable
+    Box hit, graze
+
+cdef bint box_contains(Box *box, double x, double y) nogil
+
+
 cdef class LaserLaunchAnim(Element):
     cdef Laser _laser
 
@@ -25,9 +43,7 @@ cdef class Laser(Element):
 
     cdef bint set_anim(self, long sprite_idx_offset=*) except True
     cpdef set_base_pos(self, double x, double y)
-    cdef bint _check_collision(self, double point[2], double border_size)
-    cdef bint check_collision(self, double point[2])
-    cdef bint check_grazing(self, double point[2])
+    cdef void get_hitbox(self, LaserHitbox *hitbox) nogil
     #def get_bullets_pos(self)
     cpdef cancel(self)
     cpdef update(self)
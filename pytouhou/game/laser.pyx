@@ -15,9 +15,40 @@
 from libc.math cimport cos, sin, M_PI as pi
 
 from pytouhou.game.game cimport Game
+from pytouhou.game.sprite cimport DIRTY_TRANSFORM
 from pytouhou.vm import ANMRunner
 
 
+cdef bint box_contains(Box *box, double x, double y) nogil:
+    cdef double vx, vy, dot1, dot2
+
+    vx, vy = x - box.corner[0], y - box.corner[1]
+    dot1 = vx * box.side1[0] + vy * box.side1[1]
+    dot2 = vx * box.side2[0] + vy * box.side2[1]
+    return 0 <= dot1 <= box.length1 and 0 <= dot2 <= box.length2
+
+
+cdef void set_box(Box *box, double dx, double dy, double start_offset,
+                  double end_offset, double width, double border_size) nogil:
+    cdef double dx2, dy2, offset, half_width, c1x, c1y, c2x, c2y, c3x, c3y
+
+    dx2, dy2 = -dy, dx
+    offset = start_offset - border_size / 2.
+    end_offset = end_offset + border_size / 2.
+    half_width = width / 4. + border_size / 2.
+
+    c1x, c1y = dx * offset - dx2 * half_width, dy * offset - dy2 * half_width
+    c2x, c2y = dx * offset + dx2 * half_width, dy * offset + dy2 * half_width
+    c3x, c3y = dx * end_offset + dx2 * half_width, dy * end_offset + dy2 * half_width
+
+    box.corner[0], box.corner[1] = c2x, c2y
+    box.side1[0], box.side1[1] = c1x - c2x, c1y - c2y
+    box.side2[0], box.side2[1] = c3x - c2x, c3y - c2y
+    box.length1 = box.side1[0] * box.side1[0] + box.side1[1] * box.side1[1]
+    box.length2 = box.side2[0] * box.side2[0] + box.side2[1] * box.side2[1]
+
+
+
 cdef class LaserLaunchAnim(Element):
     def __init__(self, Laser laser, anm, unsigned long index):
         Element.__init__(self, (0, 0))
@@ -40,7 +71,7 @@ cdef class LaserLaunchAnim(Element):
 
         scale = laser.width / 10. - (offset - laser.start_offset) #TODO: check
         self.sprite._rescale[:] = [scale, scale]
-        self.sprite.changed = True
+        self.sprite.dirty |= DIRTY_TRANSFORM
 
         if laser.removed or scale <= 0.:
             self.removed = True
@@ -100,48 +131,23 @@ cdef class Laser(Element):
         self.base_pos[:] = [x, y]
 
 
-    cdef bint _check_collision(self, double point[2], double border_size):
-        cdef double c1[2]
-        cdef double c2[2]
-        cdef double c3[2]
+    cdef void get_hitbox(self, LaserHitbox *hitbox) nogil:
+        cdef double dx, dy, length, offset
 
-        x, y = point[0] - self.base_pos[0], point[1] - self.base_pos[1]
-        dx, dy = cos(self.angle), sin(self.angle)
-        dx2, dy2 = -dy, dx
+        hitbox.base_pos[0], hitbox.base_pos[1] = self.base_pos[0], self.base_pos[1]
 
-        length = <double>min(self.end_offset - self.start_offset, self.max_length)
-        offset = self.end_offset - length - border_size / 2.
-        end_offset = self.end_offset + border_size / 2.
-        half_width = self.width / 4. + border_size / 2.
-
-        c1[:] = [dx * offset - dx2 * half_width, dy * offset - dy2 * half_width]
-        c2[:] = [dx * offset + dx2 * half_width, dy * offset + dy2 * half_width]
-        c3[:] = [dx * end_offset + dx2 * half_width, dy * end_offset + dy2 * half_width]
-        vx, vy = x - c2[0], y - c2[1]
-        v1x, v1y = c1[0] - c2[0], c1[1] - c2[1]
-        v2x, v2y = c3[0] - c2[0], c3[1] - c2[1]
-
-        return (0 <= vx * v1x + vy * v1y <= v1x * v1x + v1y * v1y
-                and 0 <= vx * v2x + vy * v2y <= v2x * v2x + v2y * v2y)
-
-
-    cdef bint check_collision(self, double point[2]):
-        if self.state != STARTED:
-            return False
+        hitbox.collidable = self.state == STARTED
 
-        return self._check_collision(point, 2.5)
-
-
-    cdef bint check_grazing(self, double point[2]):
         #TODO: quadruple check!
-        if self.state == STOPPING and self.frame >= self.grazing_extra_duration:
-            return False
-        if self.state == STARTING and self.frame <= self.grazing_delay:
-            return False
-        if self.frame % 12 != 0:
-            return False
+        hitbox.grazable = not (self.state == STOPPING and self.frame >= self.grazing_extra_duration
+                               or self.state == STARTING and self.frame <= self.grazing_delay
+                               or self.frame % 12 != 0)
 
-        return self._check_collision(point, 96 + 2.5)
+        dx, dy = cos(self.angle), sin(self.angle)
+        length = min(self.end_offset - self.start_offset, self.max_length)
+        offset = self.end_offset - length
+        set_box(&hitbox.hit, dx, dy, offset, self.end_offset, self.width, 2.5)
+        set_box(&hitbox.graze, dx, dy, offset, self.end_offset, self.width, 96 + 2.5)
 
 
     def get_bullets_pos(self):
@@ -190,11 +196,12 @@ cdef class Laser(Element):
         self.x = self.base_pos[0] + offset * cos(self.angle)
         self.y = self.base_pos[1] + offset * sin(self.angle)
         self.sprite.visible = (width > 0 and length > 0)
-        self.sprite.width_override = width
-        self.sprite.height_override = length
+        if <float>width != self.sprite.width_override or <float>length != self.sprite.height_override:
+            self.sprite.width_override = width
+            self.sprite.height_override = length
+            self.sprite.dirty |= DIRTY_TRANSFORM
 
         self.sprite.update_orientation(pi/2. - self.angle, True)
-        self.sprite.changed = True #TODO
 
         self.frame += 1
 
@@ -246,8 +253,9 @@ cdef class PlayerLaser(Element):
             self.cancel()
 
         self.sprite.visible = (length > 0)
-        self.sprite.height_override = length
-        self.sprite.changed = True #TODO
+        if <float>length != self.sprite.height_override:
+            self.sprite.height_override = length
+            self.sprite.dirty |= DIRTY_TRANSFORM
 
         self.x = self.origin.x + self.offset * cos(self.angle)
         self.y = self.origin.y / 2. + self.offset * sin(self.angle)
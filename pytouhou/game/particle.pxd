@@ -1,8 +1,29 @@
-from pytouhou.game.effect cimport Effect
-from pytouhou.utils.interpolator cimport Interpolator
+from pytouhou.utils.random cimport Random
 
-cdef class Particle(Effect):
-    cdef long frame, duration
-    cdef Interpolator pos_interpolator
+cdef class ParticleSystem:
+    cdef readonly long capacity, nb_particles
 
+    # Current, start and end position of every particle, as x, y pairs.
+    cdef double *positions
+    cdef double *start_positions
+    cdef double *end_positions
+    cdef unsigned long *frames
+    cdef unsigned long *durations
+
+    # Index in animations of the Effect every particle is drawn with, and
+    # scratch space for filter_removed().
+    cdef long *animation_ids
+    cdef long *new_ids
+    cdef public list animations
+
+    # Animations started on the current frame and not updated yet, the only
+    # ones new particles can share, by (anm, anim).
+    cdef dict open_animations
+
+    cdef bint allocate(self, long capacity) except True
+    cdef bint add(self, double x, double y, long anim, anm, long amp,
+                  Random prng, long number, bint reverse,
+                  long duration) except True
+    cdef void update_positions(self) nogil
     cpdef update(self)
+    cpdef filter_removed(self)
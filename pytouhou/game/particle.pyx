@@ -12,32 +12,199 @@
 ## GNU General Public License for more details.
 ##
 
-from pytouhou.game.game cimport Game
+cimport cython
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+from copy import deepcopy
 
+from pytouhou.game.effect cimport Effect
+from pytouhou.utils.interpolator cimport ease, FORMULA_DECELERATE
+from pytouhou.vm import ANMRunner
 
-cdef class Particle(Effect):
-    def __init__(self, pos, index, anm, long amp, Game game, bint reverse=False, long duration=24):
-        Effect.__init__(self, pos, index, anm)
 
-        self.frame = 0
-        self.duration = duration
+cdef class ParticleSystem:
+    """Particles of a game, at most capacity of them.
 
-        random_pos = (self.x + amp * game.prng.rand_double() - amp / 2,
-                      self.y + amp * game.prng.rand_double() - amp / 2)
+    A particle moves from where it got spawned to a random point nearby, or
+    the other way around, over its duration.  Particles spawned with the
+    same animation between two updates share the Effect playing it, which
+    the renderers then draw at each of their positions, unless its script
+    uses random instructions.  That is as far as sharing goes: an Effect
+    started on an earlier frame is further into its script, so every
+    animation gets one Effect per frame it got spawned on, not a single one.
+    A particle is removed along with its Effect.
 
-        if not reverse:
-            self.pos_interpolator = Interpolator((self.x, self.y), 0,
-                                                 random_pos, duration, formula=(lambda x: 2. * x - x ** 2))
-        else:
-            self.pos_interpolator = Interpolator(random_pos, 0,
-                                                 (self.x, self.y), duration, formula=(lambda x: 2. * x - x ** 2))
-            self.x, self.y = random_pos
+    The renderers draw all the particles after all the effects, instead of
+    in the order they got spawned in as when they were effects too.
+    """
+
+    def __init__(self, long capacity):
+        self.allocate(capacity)
+        self.nb_particles = 0
+        self.animations = []
+        self.open_animations = {}
+
+
+    def __dealloc__(self):
+        free(self.positions)
+        free(self.frames)
+        free(self.animation_ids)
+
+
+    def __len__(self):
+        return self.nb_particles
+
+
+    def __deepcopy__(self, memo):
+        cdef ParticleSystem particles = ParticleSystem.__new__(ParticleSystem)
+        cdef long capacity = self.capacity
+
+        particles.allocate(capacity)
+        memcpy(particles.positions, self.positions, 6 * capacity * sizeof(double))
+        memcpy(particles.frames, self.frames, 2 * capacity * sizeof(unsigned long))
+        memcpy(particles.animation_ids, self.animation_ids, capacity * sizeof(long))
+        particles.nb_particles = self.nb_particles
+        memo[id(self)] = particles
+        particles.animations = deepcopy(self.animations, memo)
+        particles.open_animations = dict(self.open_animations)
+        return particles
+
+
+    cdef bint allocate(self, long capacity) except True:
+        # A single allocation for each type, the arrays of a type being
+        # slices of it.
+        self.positions = <double*>malloc(6 * capacity * sizeof(double))
+        self.frames = <unsigned long*>malloc(2 * capacity * sizeof(unsigned long))
+        self.animation_ids = <long*>malloc(2 * capacity * sizeof(long))
+        if capacity and (self.positions == NULL or self.frames == NULL or
+                         self.animation_ids == NULL):
+            raise MemoryError
+        self.start_positions = self.positions + 2 * capacity
+        self.end_positions = self.positions + 4 * capacity
+        self.durations = self.frames + capacity
+        self.new_ids = self.animation_ids + capacity
+        self.capacity = capacity
+
+
+    cdef bint add(self, double x, double y, long anim, anm, long amp,
+                  Random prng, long number, bint reverse,
+                  long duration) except True:
+        cdef long i, animation_id
+        cdef double random_x, random_y
+
+        number = min(number, self.capacity - self.nb_particles)
+
+        key = (anm, anim)
+        shared = self.open_animations.get(key)
+        for i in range(self.nb_particles, self.nb_particles + number):
+            if shared is not None:
+                animation_id = shared
+            else:
+                animation_id = len(self.animations)
+                self.animations.append(Effect((0., 0.), anim, anm))
+                if ANMRunner.is_deterministic(anm, anim):
+                    shared = self.open_animations[key] = animation_id
+            self.animation_ids[i] = animation_id
+
+            random_x = x + amp * prng.rand_double() - amp / 2
+            random_y = y + amp * prng.rand_double() - amp / 2
+
+            if not reverse:
+                self.start_positions[2*i], self.start_positions[2*i+1] = x, y
+                self.end_positions[2*i], self.end_positions[2*i+1] = random_x, random_y
+            else:
+                self.start_positions[2*i], self.start_positions[2*i+1] = random_x, random_y
+                self.end_positions[2*i], self.end_positions[2*i+1] = x, y
+            self.positions[2*i] = self.start_positions[2*i]
+            self.positions[2*i+1] = self.start_positions[2*i+1]
+            self.frames[i] = 0
+            self.durations[i] = duration
+
+        self.nb_particles += max(number, 0)
+
+
+    @cython.cdivision(True)
+    cdef void update_positions(self) nogil:
+        cdef long i, j
+        cdef unsigned long frame, duration
+        cdef double coeff
+
+        for i in range(self.nb_particles):
+            frame = self.frames[i]
+            duration = self.durations[i]
+            if frame + 1 >= duration: #XXX: same bug as Interpolator.update
+                for j in range(2*i, 2*i+2):
+                    self.positions[j] = self.end_positions[j]
+            else:
+                coeff = ease(FORMULA_DECELERATE, <double>frame / <double>duration)
+                for j in range(2*i, 2*i+2):
+                    self.positions[j] = self.start_positions[j] + coeff * (self.end_positions[j] - self.start_positions[j])
+            self.frames[i] = frame + 1
 
 
     cpdef update(self):
-        Effect.update(self)
+        cdef Effect animation
+
+        for animation in self.animations:
+            animation.update()
+
+        # Every animation went one frame further than the ones new
+        # particles would start, so from now on they get their own, which
+        # keys the sharing on the frame they started on.
+        self.open_animations.clear()
+
+        with nogil:
+            self.update_positions()
+
+
+    cpdef filter_removed(self):
+        """Forget the particles whose animation ended."""
+
+        cdef Effect animation
+        cdef long i, j, animation_id, nb_particles = 0
+
+        animations = []
+        for i, animation in enumerate(self.animations):
+            if animation.removed:
+                self.new_ids[i] = -1
+            else:
+                self.new_ids[i] = len(animations)
+                animations.append(animation)
+
+        if len(animations) == len(self.animations):
+            return
+
+        for i in range(self.nb_particles):
+            animation_id = self.new_ids[self.animation_ids[i]]
+            if animation_id < 0:
+                continue
+            for j in range(2):
+                self.positions[2*nb_particles+j] = self.positions[2*i+j]
+                self.start_positions[2*nb_particles+j] = self.start_positions[2*i+j]
+                self.end_positions[2*nb_particles+j] = self.end_positions[2*i+j]
+            self.frames[nb_particles] = self.frames[i]
+            self.durations[nb_particles] = self.durations[i]
+            self.animation_ids[nb_particles] = animation_id
+            nb_particles += 1
+
+        self.nb_particles = nb_particles
+        self.animations = animations
+        self.open_animations = {key: self.new_ids[animation_id]
+                                for key, animation_id in self.open_animations.items()
+                                if self.new_ids[animation_id] >= 0}
+
+
+    def get_sprites(self):
+        """Return the sprite and position of every visible particle, for the
+        renderers which can’t read the arrays directly."""
 
-        self.pos_interpolator.update(self.frame)
-        self.x, self.y = self.pos_interpolator.values
+        cdef Effect animation
+        cdef long i
 
-        self.frame += 1
+        sprites = []
+        for i in range(self.nb_particles):
+            animation = self.animations[self.animation_ids[i]]
+            sprite = animation.sprite
+            if sprite is not None and sprite.visible:
+                sprites.append((sprite, self.positions[2*i], self.positions[2*i+1]))
+        return sprites
@@ -14,7 +14,7 @@
 
 from libc.math cimport M_PI as pi
 
-from pytouhou.game.sprite cimport Sprite
+from pytouhou.game.sprite cimport Sprite, DIRTY_TRANSFORM, DIRTY_COLOR, DIRTY_ALL
 from pytouhou.vm import ANMRunner
 from pytouhou.game.bullettype cimport BulletType
 from pytouhou.game.bullet cimport Bullet
@@ -207,11 +207,11 @@ cdef class Player(Element):
                 if m == 7 or self.invulnerable_time == 0:
                     for i in range(3):
                         self.sprite._color[i] = 255
-                    self.sprite.changed = True
+                    self.sprite.dirty |= DIRTY_COLOR
                 elif m == 1:
                     for i in range(3):
                         self.sprite._color[i] = 64
-                    self.sprite.changed = True
+                    self.sprite.dirty |= DIRTY_COLOR
 
             if keystate & 1 and self.fire_time == 0:
                 self.fire_time = 30
@@ -280,6 +280,7 @@ cdef class Player(Element):
                 self.sprite.mirrored = False
                 self.sprite.blendfunc = 0
                 self.sprite._rescale[:] = [0.75, 1.5]
+                self.sprite.dirty = DIRTY_ALL
                 self.sprite.fade(26, 96)
                 self.sprite.scale_in(26, 0., 2.5)
 
@@ -304,7 +305,7 @@ cdef class Player(Element):
                 self.touchable = True
                 self.invulnerable_time = 240
                 self.sprite.blendfunc = 0
-                self.sprite.changed = True
+                self.sprite.dirty |= DIRTY_COLOR
 
             elif time == 91: # start the bullet hell again
                 self.death_time = 0
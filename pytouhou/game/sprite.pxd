@@ -1,10 +1,18 @@
-from pytouhou.utils.interpolator cimport Interpolator
+from pytouhou.utils.interpolator cimport Interpolator, Formula
 from pytouhou.formats.animation cimport Animation
 
+# What has to be recomputed before the sprite can be rendered again.
+cpdef enum Dirty:
+    DIRTY_TRANSFORM = 1
+    DIRTY_TEXCOORDS = 2
+    DIRTY_COLOR = 4  # Includes the blendfunc.
+    DIRTY_ALL = 7
+
 cdef class Sprite:
     cdef public int blendfunc, frame
     cdef public float width_override, height_override, angle
-    cdef public bint removed, changed, visible, force_rotation
+    cdef public bint removed, visible, force_rotation
+    cdef public unsigned char dirty
     cdef public bint automatic_orientation, allow_dest_offset, mirrored
     cdef public bint corner_relative_placement
     cdef public Interpolator scale_interpolator, fade_interpolator
@@ -23,11 +31,11 @@ cdef class Sprite:
     cdef float _rotations_speed_3d[3]
     cdef unsigned char _color[4]
 
-    cpdef fade(self, unsigned int duration, alpha, formula=*)
-    cpdef scale_in(self, unsigned int duration, sx, sy, formula=*)
-    cpdef move_in(self, unsigned int duration, x, y, z, formula=*)
-    cpdef rotate_in(self, unsigned int duration, rx, ry, rz, formula=*)
-    cpdef change_color_in(self, unsigned int duration, r, g, b, formula=*)
+    cpdef fade(self, unsigned int duration, alpha, Formula formula=*)
+    cpdef scale_in(self, unsigned int duration, sx, sy, Formula formula=*)
+    cpdef move_in(self, unsigned int duration, x, y, z, Formula formula=*)
+    cpdef rotate_in(self, unsigned int duration, rx, ry, rz, Formula formula=*)
+    cpdef change_color_in(self, unsigned int duration, r, g, b, Formula formula=*)
     cpdef update_orientation(self, double angle_base=*, bint force_rotation=*)
     cpdef Sprite copy(self)
     cpdef update(self)
@@ -14,6 +14,9 @@
 
 from libc.stdlib cimport free
 from libc.string cimport memcpy
+from copy import deepcopy
+
+from pytouhou.utils.interpolator cimport FORMULA_LINEAR
 
 
 cdef class Sprite:
@@ -25,7 +28,7 @@ cdef class Sprite:
     def __init__(self, width_override=0, height_override=0):
         self.anm = None
         self.removed = False
-        self.changed = True
+        self.dirty = DIRTY_ALL
         self.visible = True
 
         self.width_override = width_override
@@ -61,6 +64,12 @@ cdef class Sprite:
             self._color[i] = 255
 
 
+    property changed:
+        def __get__(self):
+            return self.dirty != 0
+        def __set__(self, bint value):
+            self.dirty = DIRTY_ALL if value else 0
+
     property scale_speed:
         def __get__(self):
             return (self._scale_speed[0], self._scale_speed[1])
@@ -72,18 +81,21 @@ cdef class Sprite:
             return (self._texoffsets[0], self._texoffsets[1])
         def __set__(self, value):
             self._texoffsets[:] = [value[0], value[1]]
+            self.dirty |= DIRTY_TEXCOORDS
 
     property rescale:
         def __get__(self):
             return (self._rescale[0], self._rescale[1])
         def __set__(self, value):
             self._rescale[:] = [value[0], value[1]]
+            self.dirty |= DIRTY_TRANSFORM
 
     property dest_offset:
         def __get__(self):
             return (self._dest_offset[0], self._dest_offset[1], self._dest_offset[2])
         def __set__(self, value):
             self._dest_offset[:] = [value[0], value[1], value[2]]
+            self.dirty |= DIRTY_TRANSFORM
 
     property rotations_speed_3d:
         def __get__(self):
@@ -96,6 +108,7 @@ cdef class Sprite:
             return (self._rotations_3d[0], self._rotations_3d[1], self._rotations_3d[2])
         def __set__(self, value):
             self._rotations_3d[:] = [value[0], value[1], value[2]]
+            self.dirty |= DIRTY_TRANSFORM
 
     property color:
         def __get__(self):
@@ -104,45 +117,51 @@ cdef class Sprite:
             self._color[0] = value[0]
             self._color[1] = value[1]
             self._color[2] = value[2]
+            self.dirty |= DIRTY_COLOR
 
     property alpha:
         def __get__(self):
             return self._color[3]
         def __set__(self, value):
             self._color[3] = value
+            self.dirty |= DIRTY_COLOR
 
     property texcoords:
         def __get__(self):
             return (self._texcoords[0], self._texcoords[1], self._texcoords[2], self._texcoords[3])
         def __set__(self, value):
+            # The size of the quad depends on the size of the texcoords.
+            if value[2] != self._texcoords[2] or value[3] != self._texcoords[3]:
+                self.dirty |= DIRTY_TRANSFORM
             self._texcoords[:] = [value[0], value[1], value[2], value[3]]
+            self.dirty |= DIRTY_TEXCOORDS
 
 
-    cpdef fade(self, unsigned int duration, alpha, formula=None):
+    cpdef fade(self, unsigned int duration, alpha, Formula formula=FORMULA_LINEAR):
         self.fade_interpolator = Interpolator((self._color[3],), self.frame,
                                               (alpha,), self.frame + duration,
                                               formula)
 
 
-    cpdef scale_in(self, unsigned int duration, sx, sy, formula=None):
+    cpdef scale_in(self, unsigned int duration, sx, sy, Formula formula=FORMULA_LINEAR):
         self.scale_interpolator = Interpolator(self.rescale, self.frame,
                                                (sx, sy), self.frame + duration,
                                                formula)
 
 
-    cpdef move_in(self, unsigned int duration, x, y, z, formula=None):
+    cpdef move_in(self, unsigned int duration, x, y, z, Formula formula=FORMULA_LINEAR):
         self.offset_interpolator = Interpolator(self.dest_offset, self.frame,
                                                 (x, y, z), self.frame + duration,
                                                 formula)
 
 
-    cpdef rotate_in(self, unsigned int duration, rx, ry, rz, formula=None):
+    cpdef rotate_in(self, unsigned int duration, rx, ry, rz, Formula formula=FORMULA_LINEAR):
         self.rotation_interpolator = Interpolator(self.rotations_3d, self.frame,
                                                   (rx, ry, rz), self.frame + duration,
                                                   formula)
 
 
-    cpdef change_color_in(self, unsigned int duration, r, g, b, formula=None):
+    cpdef change_color_in(self, unsigned int duration, r, g, b, Formula formula=FORMULA_LINEAR):
         self.color_interpolator = Interpolator(self.color, self.frame,
                                                (r, g, b), self.frame + duration,
                                                formula)
@@ -152,7 +171,7 @@ cdef class Sprite:
         if (self.angle != angle_base or self.force_rotation != force_rotation):
             self.angle = angle_base
             self.force_rotation = force_rotation
-            self.changed = True
+            self.dirty |= DIRTY_TRANSFORM
 
 
     cpdef Sprite copy(self):
@@ -163,7 +182,6 @@ cdef class Sprite:
         sprite.angle = self.angle
 
         sprite.removed = self.removed
-        sprite.changed = self.changed
         sprite.visible = self.visible
         sprite.force_rotation = self.force_rotation
         sprite.automatic_orientation = self.automatic_orientation
@@ -192,6 +210,18 @@ cdef class Sprite:
         return sprite
 
 
+    def __deepcopy__(self, memo):
+        # The rendering data isn’t copied, it will get computed again.
+        sprite = self.copy()
+        memo[id(self)] = sprite
+        sprite.scale_interpolator = deepcopy(self.scale_interpolator, memo)
+        sprite.fade_interpolator = deepcopy(self.fade_interpolator, memo)
+        sprite.offset_interpolator = deepcopy(self.offset_interpolator, memo)
+        sprite.rotation_interpolator = deepcopy(self.rotation_interpolator, memo)
+        sprite.color_interpolator = deepcopy(self.color_interpolator, memo)
+        return sprite
+
+
     cpdef update(self):
         self.frame += 1
 
@@ -199,34 +229,30 @@ cdef class Sprite:
         if sax or say or saz:
             ax, ay, az = self._rotations_3d[0], self._rotations_3d[1], self._rotations_3d[2] #XXX
             self._rotations_3d[:] = [ax + sax, ay + say, az + saz]
-            self.changed = True
+            self.dirty |= DIRTY_TRANSFORM
         elif self.rotation_interpolator:
             self.rotation_interpolator.update(self.frame)
             self.rotations_3d = self.rotation_interpolator.values
-            self.changed = True
 
         rsx, rsy = self._scale_speed[0], self._scale_speed[1] #XXX
         if rsx or rsy:
             rx, ry = self._rescale[0], self._rescale[1] #XXX
             self._rescale[:] = [rx + rsx, ry + rsy]
-            self.changed = True
+            self.dirty |= DIRTY_TRANSFORM
 
         if self.fade_interpolator:
             self.fade_interpolator.update(self.frame)
             self._color[3] = self.fade_interpolator.values[0]
-            self.changed = True
+            self.dirty |= DIRTY_COLOR
 
         if self.scale_interpolator:
             self.scale_interpolator.update(self.frame)
             self.rescale = self.scale_interpolator.values
-            self.changed = True
 
         if self.offset_interpolator:
             self.offset_interpolator.update(self.frame)
             self.dest_offset = self.offset_interpolator.values
-            self.changed = True
 
         if self.color_interpolator:
             self.color_interpolator.update(self.frame)
             self.color = self.color_interpolator.values
-            self.changed = True
@@ -154,7 +154,7 @@ class Text(GlyphCollection):
         self.timeout_update()
 
 
-    def fade(self, duration, alpha, formula=None):
+    def fade(self, duration, alpha, formula=FORMULA_LINEAR):
         self.fade_interpolator = Interpolator((self.alpha,), self.frame,
                                               (alpha,), self.frame + duration,
                                               formula)
@@ -284,13 +284,13 @@ class NativeText(Element):
         self.timeout_update()
 
 
-    def fade(self, duration, alpha, formula=None):
+    def fade(self, duration, alpha, formula=FORMULA_LINEAR):
         self.fade_interpolator = Interpolator((self.alpha,), self.frame,
                                               (alpha,), self.frame + duration,
                                               formula)
 
 
-    def move_in(self, duration, x, y, formula=None):
+    def move_in(self, duration, x, y, formula=FORMULA_LINEAR):
         self.offset_interpolator = Interpolator((self.x, self.y), self.frame,
                                                 (x, y), self.frame + duration,
                                                 formula)
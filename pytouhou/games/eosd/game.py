@@ -12,7 +12,7 @@
 ## GNU General Public License for more details.
 ##
 
-from pytouhou.utils.interpolator import Interpolator
+from pytouhou.utils.interpolator import Interpolator, Formula
 
 from pytouhou.game.game import Game as GameBase
 from pytouhou.game.bullettype import BulletType
@@ -97,6 +97,19 @@ class Common:
 
 
 class Game(GameBase):
+    @staticmethod
+    def get_resources(stage, common):
+        """List the resources this stage will request from the loader."""
+        return ([('anm', 'stg%denm.anm' % stage),
+                 ('anm', 'stg%denm2.anm' % stage),
+                 ('ecl', 'ecldata%d.ecl' % stage),
+                 ('anm', 'eff0%d.anm' % stage),
+                 ('msg', 'msg%d.dat' % stage)] +
+                [('anm', name) for name in common.enemy_face[stage - 1]] +
+                [('stage', 'stage%d.std' % stage),
+                 ('anm', 'stg%dbg.anm' % stage)])
+
+
     def __init__(self, resource_loader, stage, rank, difficulty,
                  common, prng, hints=None, friendly_fire=True,
                  nb_bullets_max=640):
@@ -108,7 +121,9 @@ class Game(GameBase):
         except KeyError:
             pass
         ecl = resource_loader.get_ecl('ecldata%d.ecl' % stage)
-        self.ecl_runners = [ECLMainRunner(main, ecl.subs, self) for main in ecl.mains]
+        compiled = resource_loader.compile_ecl(ecl)
+        self.ecl_runners = [ECLMainRunner(main, ecl.subs, self, compiled)
+                            for main in ecl.mains]
 
         self.spellcard_effect_anm = resource_loader.get_single_anm('eff0%d.anm' % stage)
 
@@ -152,6 +167,23 @@ class Game(GameBase):
             pass
 
 
+    def shared_objects(self):
+        shared = GameBase.shared_objects(self)
+        shared.extend([self.etama, self.enm_anm, self.spellcard_effect_anm,
+                       self.msg, self.msg_anm, self.std, self.background])
+        for runner in self.ecl_runners:
+            shared.extend([runner._main, runner._subs, runner._compiled])
+        shared.extend(self.msg.msgs.values())
+        for player in self.players:
+            shared.extend([player.sht, player.focused_sht])
+        return shared
+
+
+    def load_state(self, state):
+        GameBase.load_state(self, state)
+        self.interface.player_state = self.players[0] #XXX
+
+
 
 class Player(PlayerBase):
     def __init__(self, number, anm, shts, character, continues):
@@ -173,7 +205,7 @@ class Player(PlayerBase):
     def start_focusing(self):
         self.orb_dx_interpolator = Interpolator((24,), self._game.frame,
                                                 (8,), self._game.frame + 8,
-                                                lambda x: x ** 2)
+                                                Formula.FORMULA_ACCELERATE)
         self.orb_dy_interpolator = Interpolator((0,), self._game.frame,
                                                 (-32,), self._game.frame + 8)
         self.focused = True
@@ -182,7 +214,7 @@ class Player(PlayerBase):
     def stop_focusing(self):
         self.orb_dx_interpolator = Interpolator((8,), self._game.frame,
                                                 (24,), self._game.frame + 8,
-                                                lambda x: x ** 2)
+                                                Formula.FORMULA_ACCELERATE)
         self.orb_dy_interpolator = Interpolator((-32,), self._game.frame,
                                                 (0,), self._game.frame + 8)
         self.focused = False
@@ -13,43 +13,75 @@
 ##
 
 from math import radians
-from pytouhou.vm import spawn_enemy
+from pytouhou.vm import spawn_enemy, wait
 from pytouhou.game import NextStage
 
 
-def disk(enemy, game):
-    if enemy.frame == 0:
-        enemy.set_anim(0)
+# These subs are task classes rather than generators, so that the game can
+# still be copied, for netplay.  They go by enemy.frame, which a timeout
+# restarts, and like every sub they get called twice on its first value: once
+# on spawn, and once more on the first update.
 
-        enemy.set_hitbox(32, 32)
+class Disk:
+    def __init__(self, enemy, game):
+        self.enemy = enemy
+        self.spawned = False
 
-        enemy.death_anim = 1
+    def __next__(self):
+        enemy = self.enemy
+        if enemy.frame == 0:
+            enemy.set_anim(0)
 
-        enemy.update_mode = 0
-        enemy.angle, enemy.speed = radians(90), 1.5
+            enemy.set_hitbox(32, 32)
 
-    elif enemy.frame == 10000:
-        enemy.removed = True
+            enemy.death_anim = 1
 
+            enemy.update_mode = 0
+            enemy.angle, enemy.speed = radians(90), 1.5
 
-def boss(enemy, game):
-    if enemy.frame == 0:
-        enemy.set_anim(3)
-        enemy.set_hitbox(8, 32)
-        enemy.death_flags = 1
-        enemy.set_boss(True)
+        elif enemy.frame == 10000:
+            enemy.removed = True
+            raise StopIteration
 
-        enemy.timeout = 20 * 60
-        enemy.timeout_callback.enable(some_spellcard, (enemy, game))
+        if not self.spawned:
+            self.spawned = True
+            return wait(1)
+        return wait(10000 - enemy.frame)
 
-        enemy.low_life_trigger = 0x40
-        enemy.low_life_callback.enable(some_spellcard, (enemy, game))
 
-    elif enemy.frame == 10000:
-        enemy.removed = True
 
-    if enemy.frame % 10 == 0:
-        enemy.set_bullet_attributes(67, 0, 0, 3 if game.spellcard is not None else 1, 1, 6., 6., 0., radians(3), 0)
+class Boss:
+    def __init__(self, enemy, game):
+        self.enemy = enemy
+        self.game = game
+        self.spawned = False
+
+    def __next__(self):
+        enemy, game = self.enemy, self.game
+        if enemy.frame == 0:
+            enemy.set_anim(3)
+            enemy.set_hitbox(8, 32)
+            enemy.death_flags = 1
+            enemy.set_boss(True)
+
+            enemy.timeout = 20 * 60
+            enemy.timeout_callback.enable(some_spellcard, (enemy, game))
+
+            enemy.low_life_trigger = 0x40
+            enemy.low_life_callback.enable(some_spellcard, (enemy, game))
+
+        elif enemy.frame == 10000:
+            enemy.removed = True
+
+        if enemy.frame % 10 == 0:
+            enemy.set_bullet_attributes(67, 0, 0, 3 if game.spellcard is not None else 1, 1, 6., 6., 0., radians(3), 0)
+
+        if not self.spawned:
+            self.spawned = True
+            return wait(1)
+        # After a timeout this wakes up too early, and only waits some more.
+        return wait(10 - enemy.frame % 10)
+
 
 
 def some_spellcard(enemy, game):
@@ -74,18 +106,21 @@ def on_boss_death(enemy, game):
     raise NextStage
 
 
-def stage1(game):
-    if game.frame == 0x10:
-        spawn_enemy(game, disk, x=50., y=-32., life=20, score=300)
-    elif game.frame == 0x20:
-        spawn_enemy(game, disk, x=60., y=-32., life=20, score=300)
-    elif game.frame == 0x30:
-        spawn_enemy(game, disk, x=70., y=-32., life=20, score=300)
-    elif game.frame == 0x40:
-        spawn_enemy(game, disk, x=80., y=-32., life=20, score=300)
-    elif game.frame == 0x50:
-        spawn_enemy(game, disk, x=90., y=-32., life=20, score=300)
-    elif game.frame == 0x60:
-        spawn_enemy(game, disk, x=100., y=-32., life=20, score=300)
-    elif game.frame == 0x100:
-        spawn_enemy(game, boss, x=192., y=64., life=1000, item=-2, score=10000)
+
+class Stage1:
+    disks = (50., 60., 70., 80., 90., 100.)
+
+    def __init__(self, game):
+        self.game = game
+        self.step = 0
+
+    def __next__(self):
+        step = self.step
+        self.step += 1
+        if step == 0:
+            return wait(0x10)
+        elif step <= len(self.disks):
+            spawn_enemy(self.game, Disk, x=self.disks[step-1], y=-32., life=20, score=300)
+            return wait(0x10 if step < len(self.disks) else 0x100 - 0x60)
+        spawn_enemy(self.game, Boss, x=192., y=64., life=1000, item=-2, score=10000)
+        raise StopIteration
@@ -98,6 +98,18 @@ class Common:
 
 
 class Game(GameBase):
+    @staticmethod
+    def get_resources(stage, common):
+        """List the resources this stage will request from the loader."""
+        return ([('anm', 'stg%denm.anm' % stage),
+                 ('anm', 'stg%denm2.anm' % stage),
+                 ('anm', 'eff0%d.anm' % stage),
+                 ('msg', 'msg%d.dat' % stage)] +
+                [('anm', name) for name in common.enemy_face[stage - 1]] +
+                [('stage', 'stage%d.std' % stage),
+                 ('anm', 'stg%dbg.anm' % stage)])
+
+
     def __init__(self, resource_loader, stage, rank, difficulty,
                  common, prng, hints=None, friendly_fire=True,
                  nb_bullets_max=640):
@@ -109,7 +121,7 @@ class Game(GameBase):
         except KeyError:
             self.enm_anm = resource_loader.get_anm('stg%denm.anm' % stage)
 
-        self.ecl_runners = [PythonMainRunner(getattr(enemies, 'stage%d' % stage), self)]
+        self.ecl_runners = [PythonMainRunner(getattr(enemies, 'Stage%d' % stage), self)]
 
         self.spellcard_effect_anm = resource_loader.get_single_anm('eff0%d.anm' % stage)
 
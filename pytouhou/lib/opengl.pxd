@@ -22,6 +22,7 @@ cdef extern from 'epoxy/gl.h' nogil:
     ctypedef char GLchar
     ctypedef unsigned int GLsizei
     ctypedef unsigned int GLsizeiptr
+    ctypedef int GLintptr
     ctypedef unsigned int GLbitfield
     ctypedef void GLvoid
 
@@ -89,10 +90,15 @@ cdef extern from 'epoxy/gl.h' nogil:
     ctypedef enum GLenum_buffer 'GLenum':
         GL_ARRAY_BUFFER
         GL_ELEMENT_ARRAY_BUFFER
+        GL_PIXEL_PACK_BUFFER
 
     ctypedef enum GLenum_usage 'GLenum':
         GL_STATIC_DRAW
         GL_DYNAMIC_DRAW
+        GL_STREAM_READ
+
+    ctypedef enum GLenum_access 'GLenum':
+        GL_READ_ONLY
 
     ctypedef enum GLenum_shader 'GLenum':
         GL_VERTEX_SHADER
@@ -174,6 +180,9 @@ cdef extern from 'epoxy/gl.h' nogil:
     void glDeleteBuffers(GLsizei n, const GLuint * buffers)
     void glBindBuffer(GLenum_buffer target, GLuint buffer_)
     void glBufferData(GLenum_buffer target, GLsizeiptr size, const GLvoid *data, GLenum_usage usage)
+    void glBufferSubData(GLenum_buffer target, GLintptr offset, GLsizeiptr size, const GLvoid *data)
+    void *glMapBuffer(GLenum_buffer target, GLenum_access access)
+    GLboolean glUnmapBuffer(GLenum_buffer target)
 
     GLuint glCreateProgram()
     GLuint glCreateShader(GLenum_shader shaderType)
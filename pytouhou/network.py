@@ -1,93 +1,712 @@
-import socket
-from struct import Struct
-from select import select
-from time import time
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
 
+"""Netplay between players, with rollback, and spectators.
+
+Every player runs the whole simulation.  Local inputs are sent to every
+other player as soon as they are read, and applied input_delay frames
+later.  When the input of a remote player for a frame isn’t known yet, it
+is predicted to be the last one received, and the game goes on without
+waiting: the state is saved before every frame simulated with a prediction,
+so that when the actual input differs, the game is rewound to that frame
+and simulated again up to the present, with sounds muted.
+
+Each datagram carries a sequence number, the number of frames received
+from its destination so far, and every local input the destination didn’t
+acknowledge yet, so that any datagram makes up for the ones lost before it.
+It also carries the latest hash of the game state on a confirmed frame, so
+that players notice when their simulations diverge.
+
+Spectators don’t play: they ask one of the players for the inputs every
+player agreed on, and run the game with them, without any prediction.
+
+All the networking happens in a Transport, running an asyncio event loop in
+its own thread, so that the game never blocks on a socket: it only picks
+the datagrams received so far, and waits for some only when it has to.
+"""
+
+import asyncio
+from collections import deque
+from random import Random
+from struct import Struct, error as StructError
+from threading import Thread, Condition
+
+from pytouhou.game import NextStage, GameOver
+from pytouhou.game.music import MusicPlayer
 from pytouhou.utils.helpers import get_logger
 
 logger = get_logger(__name__)
 
-MSG_STRUCT = Struct('!HHH')
+# Kinds of datagrams, their first byte.
+INPUTS = 1  # From a player to another one.
+SPECTATE = 2  # From a spectator to the player it watches.
+CONFIRMED = 3  # From a player to its spectators.
+
+# Kind, sequence number, stage, player, frames of the destination received,
+# frame of the state hash plus one (0 if none), state hash, first frame,
+# number of inputs.
+INPUTS_STRUCT = Struct('!BIBBIIIIB')
+# Kind, stage, frames received.
+SPECTATE_STRUCT = Struct('!BBI')
+# Kind, sequence number, stage, number of players, first frame, number of
+# frames.
+CONFIRMED_STRUCT = Struct('!BIBBIB')
+INPUT_STRUCT = Struct('!H')
+
+MAX_INPUTS = 255
+# Keep datagrams of confirmed inputs under the usual MTU.
+MAX_CONFIRMED_SIZE = 1200
+
+
+class TransportProtocol(asyncio.DatagramProtocol):
+    def __init__(self, transport):
+        self.transport = transport
+
+
+    def connection_made(self, transport):
+        self.transport.endpoint = transport
+
+
+    def datagram_received(self, data, addr):
+        with self.transport.condition:
+            self.transport.received.append((data, addr))
+            self.transport.condition.notify()
+
+
+    def error_received(self, exc):
+        # Most likely an ICMP error, some peer not being there (yet).
+        logger.debug('Network error: %s', exc)
+
+
+    def pause_writing(self):
+        self.transport.paused = True
+
+
+    def resume_writing(self):
+        self.transport.paused = False
+
+
+
+class Transport:
+    """UDP socket served by an asyncio event loop, in its own thread.
+
+    Datagrams received are queued until the game picks them with receive(),
+    and send() only hands datagrams over to the event loop, so neither ever
+    blocks.  Datagrams sent as droppable get dropped while the socket buffer
+    is full, instead of piling up.
+
+    To try netplay in bad conditions on the loopback, the event loop can
+    also delay every datagram by latency seconds, plus a random jitter of up
+    to that many seconds which can reorder them, and drop a ratio of loss of
+    them.
+
+    Instance variables:
+    nb_sent -- number of datagrams sent
+    nb_dropped -- number of datagrams dropped, either by the simulated loss
+                  or because the socket buffer was full
+    """
+
+    def __init__(self, port, latency=0., jitter=0., loss=0., seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = Random(seed)
+
+        self.received = deque()
+        self.condition = Condition()
+        self.endpoint = None
+        self.paused = False
+        self.nb_sent = 0
+        self.nb_dropped = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            lambda: TransportProtocol(self), local_addr=('0.0.0.0', port)))
+        self.thread = Thread(target=self.loop.run_forever, name='network',
+                             daemon=True)
+        self.thread.start()
+
+
+    def send(self, datagrams):
+        """Send a batch of (data, addr, droppable) datagrams."""
+
+        if datagrams:
+            self.loop.call_soon_threadsafe(self.send_batch, datagrams)
+
+
+    def send_batch(self, datagrams):
+        # Only ever called from the event loop.
+        for data, addr, droppable in datagrams:
+            if (droppable and self.paused) or self.random.random() < self.loss:
+                self.nb_dropped += 1
+                continue
+            delay = self.latency + self.random.uniform(0., self.jitter)
+            if delay > 0:
+                self.loop.call_later(delay, self.send_now, data, addr)
+            else:
+                self.send_now(data, addr)
+
+
+    def send_now(self, data, addr):
+        if self.endpoint.is_closing():
+            # Delayed until after close().
+            return
+        self.endpoint.sendto(data, addr)
+        self.nb_sent += 1
+
+
+    def receive(self):
+        """Return every (data, addr) received since the last call."""
+
+        with self.condition:
+            received = list(self.received)
+            self.received.clear()
+        return received
+
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a datagram to be received."""
+
+        with self.condition:
+            if not self.received:
+                self.condition.wait(timeout)
+
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.endpoint.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+
 
 class Network:
-    def __init__(self, port=8080, dest=None, selected_player=0):
-        self.frame = 0
-        self.keystate = 0
-        self.old_keystate = 0
-        self.remote_keystate = 0
+    """Drop-in replacement of Game.run_iter for the GameRunner, running the
+    game along with remote players.
+
+    dests are the addresses of other players to contact first, the remaining
+    ones have to contact us instead: with more than two players, each one
+    has to be given the addresses of the players after it.
+
+    A player falling behind makes the others stall once they get
+    max_rollback frames ahead of it.  Up to max_spectators spectators can
+    watch the game from this player, those falling more than
+    spectator_window frames behind get dropped.
+
+    Instance variables:
+    nb_rollbacks -- number of times a misprediction rewound the game
+    nb_resimulated -- number of frames simulated again because of those
+    nb_stalls -- number of frames skipped waiting for a remote player
+    desync -- first and last frame between which the simulations diverged
+    """
 
+    def __init__(self, port=8080, dests=(), selected_player=0, nb_players=2,
+                 input_delay=2, max_rollback=8, max_spectators=64,
+                 spectator_window=600, latency=0., jitter=0., loss=0.):
+        assert nb_players >= 2
         self.selected_player = selected_player
+        self.nb_players = nb_players
+        self.remote_players = [player for player in range(nb_players)
+                               if player != selected_player]
+        self.input_delay = input_delay
+        self.max_rollback = max_rollback
+        self.max_spectators = max_spectators
+        self.spectator_window = spectator_window
+
+        self.contacts = list(dests)
+        self.peers = {}
+        self.remote_sequences = {}
+        self.spectators = {}
+        self.frame_struct = Struct('!%dH' % nb_players)
+        self.max_confirmed = min(MAX_INPUTS, MAX_CONFIRMED_SIZE // self.frame_struct.size)
+
+        self.transport = Transport(port, latency, jitter, loss)
+        self.outgoing = []
+
+        # Stands for the sound players while simulating frames again.
+        self.muted_player = MusicPlayer()
+
+        self.sequence = 0
+        self.iteration = 0
+        self.nb_rollbacks = 0
+        self.nb_resimulated = 0
+        self.nb_stalls = 0
+        self.desync = None
 
-        self.remote_addr = dest
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        self.sock.bind(('', port))
+        self.game = None
+        self.stage = None
+        self.previous_stage = None
+        self.previous_confirmed = None
 
 
-    def read_message(self):
-        message = None
+    def start(self, game):
+        """Forget everything about the previous stage, but the inputs the
+        other players and spectators may still need to finish it."""
 
-        start_time = time()
-        delta = 1./60.
+        if self.game is not None:
+            self.previous_stage = self.stage, dict(self.acknowledged), self.local_inputs
+            self.previous_confirmed = self.stage, self.confirmed_inputs, self.nb_confirmed
+            self.moved_on = set()
 
-        rlist, _, _ = select([self.sock], [], [], delta)
-        while rlist:
-            msg, addr = rlist[0].recvfrom(MSG_STRUCT.size)
-            # Check whether the message comes from the right address
-            if self.frame == 0 or addr == self.remote_addr:
-                self.remote_addr = addr
+        self.game = game
+        self.stage = game.stage
+        start = game.frame
 
-                frame, keystate, old_keystate = MSG_STRUCT.unpack(msg)
+        # Nobody can give any input for the first input_delay frames.
+        initial = {frame: 0 for frame in range(start, start + self.input_delay)}
+        self.local_inputs = dict(initial)
+        self.remote_inputs = {player: dict(initial) for player in self.remote_players}
+        self.remote_received = {player: start + self.input_delay for player in self.remote_players}
+        self.acknowledged = dict(self.remote_received)
 
-                # Check for well-formedness
-                if frame in (self.frame, self.frame + 1):
-                    message = (frame, keystate, old_keystate)
+        self.confirmed_inputs = {}
+        self.nb_confirmed = start
+
+        self.predictions = {}
+        self.states = {}
+        self.mispredicted = None
+
+        self.hashed = start
+        self.last_hash = None
+        self.local_hashes = {}
+        self.remote_hashes = {}
+        self.synced = start - 1
+
+
+    def get_confirmed(self):
+        """Return the first frame for which some input is still unknown."""
+
+        return min(self.remote_received.values())
+
+
+    def send_inputs(self, addr, stage, received, last_hash, first, local_inputs):
+        inputs = []
+        for frame in range(first, first + MAX_INPUTS):
+            keystate = local_inputs.get(frame)
+            if keystate is None:
+                break
+            inputs.append(INPUT_STRUCT.pack(keystate))
+
+        hash_frame, state_hash = last_hash if last_hash is not None else (-1, 0)
+
+        self.sequence += 1
+        header = INPUTS_STRUCT.pack(INPUTS, self.sequence, stage,
+                                    self.selected_player, received,
+                                    hash_frame + 1, state_hash, first,
+                                    len(inputs))
+        self.outgoing.append((header + b''.join(inputs), addr, False))
+
+
+    def send(self):
+        if self.previous_stage is not None:
+            stage, acknowledged, local_inputs = self.previous_stage
+            for player, addr in self.peers.items():
+                if player not in self.moved_on:
+                    self.send_inputs(addr, stage, 0, None, acknowledged[player],
+                                     local_inputs)
+
+        for player, addr in self.peers.items():
+            self.send_inputs(addr, self.stage, self.remote_received[player],
+                             self.last_hash, self.acknowledged[player],
+                             self.local_inputs)
+
+        # Players we know the address of, but didn’t hear from yet.
+        known = set(self.peers.values())
+        for addr in self.contacts:
+            if addr not in known:
+                self.send_inputs(addr, self.stage, 0, self.last_hash,
+                                 min(self.acknowledged.values()),
+                                 self.local_inputs)
+
+
+    def send_confirmed(self):
+        for addr, spectator in list(self.spectators.items()):
+            stage, received, last_heard = spectator
+            if self.iteration - last_heard > self.spectator_window:
+                logger.info('Spectator %s left.', addr)
+                del self.spectators[addr]
+                continue
+
+            if stage == self.stage:
+                confirmed_inputs, nb_confirmed = self.confirmed_inputs, self.nb_confirmed
+            elif self.previous_confirmed is not None and stage == self.previous_confirmed[0]:
+                _, confirmed_inputs, nb_confirmed = self.previous_confirmed
             else:
-                logger.error('Mismatch, got a message from %s, waiting for %s.', self.remote_addr, addr)
+                continue
 
-            # If no valid message has been read, wait for one as long as possible
-            # else, read as much as we can without blocking.
-            delta = 0 if message else max(0, 1./60. - (time() - start_time))
-            rlist, _, _ = select(rlist, [], [], delta)
+            # Don’t keep inputs around forever for a spectator which can’t
+            # keep up.
+            if nb_confirmed - received > self.spectator_window:
+                logger.warn('Spectator %s fell too far behind, dropping it.', addr)
+                del self.spectators[addr]
+                continue
 
-        return message
+            frames = [confirmed_inputs[frame] for frame
+                      in range(received, min(nb_confirmed, received + self.max_confirmed))]
+            if not frames:
+                continue
 
+            self.sequence += 1
+            header = CONFIRMED_STRUCT.pack(CONFIRMED, self.sequence, stage,
+                                           self.nb_players, received,
+                                           len(frames))
+            self.outgoing.append((header + b''.join(frames), addr, True))
 
-    def send_message(self):
-        if self.remote_addr is not None:
-            self.sock.sendto(MSG_STRUCT.pack(self.frame, self.keystate, self.old_keystate), self.remote_addr)
 
+    def flush(self):
+        self.transport.send(self.outgoing)
+        self.outgoing = []
 
-    def run_game_iter(self, game, keystate, other_keystate):
-        keystates = [other_keystate, other_keystate]
-        keystates[self.selected_player] = keystate
-        game.run_iter(keystates)
+
+    def receive(self):
+        for data, addr in self.transport.receive():
+            try:
+                if data[0] == INPUTS:
+                    self.receive_inputs(data, addr)
+                elif data[0] == SPECTATE:
+                    self.receive_spectate(data, addr)
+                else:
+                    logger.warn('Ignoring a message of unknown kind from %s.', addr)
+            except (StructError, IndexError):
+                logger.warn('Ignoring a malformed message from %s.', addr)
+
+
+    def receive_inputs(self, data, addr):
+        (_, sequence, stage, player, acknowledged, hash_frame, state_hash,
+         first, nb_inputs) = INPUTS_STRUCT.unpack_from(data)
+        inputs = Struct('!%dH' % nb_inputs).unpack_from(data, INPUTS_STRUCT.size)
+
+        if player not in self.remote_inputs:
+            logger.warn('Ignoring a message from %s, claiming to be player %d.', addr, player)
+            return
+        known = self.peers.get(player)
+        if known is None:
+            logger.info('Player %d joined from %s.', player, addr)
+            self.peers[player] = addr
+        elif addr != known:
+            logger.warn('Ignoring a message from %s, player %d being at %s.', addr, player, known)
+            return
+
+        # Stale datagrams can’t tell anything newer ones didn’t.
+        if stage != self.stage or sequence <= self.remote_sequences.get(player, 0):
+            return
+        self.remote_sequences[player] = sequence
+
+        if self.previous_stage is not None:
+            # This player is done with the previous stage too.
+            self.moved_on.add(player)
+            if self.moved_on.issuperset(self.peers):
+                self.previous_stage = None
+
+        self.acknowledged[player] = max(self.acknowledged[player], acknowledged)
+        if hash_frame > 0:
+            self.remote_hashes.setdefault(hash_frame - 1, {})[player] = state_hash
+
+        remote_inputs = self.remote_inputs[player]
+        for frame, keystate in enumerate(inputs, first):
+            if frame < self.remote_received[player]:
+                continue
+            elif frame > self.remote_received[player]:
+                break
+            remote_inputs[frame] = keystate
+            self.remote_received[player] += 1
+            predicted = self.predictions.pop((player, frame), None)
+            if (predicted is not None and predicted != keystate and
+                    (self.mispredicted is None or frame < self.mispredicted)):
+                self.mispredicted = frame
+
+
+    def receive_spectate(self, data, addr):
+        _, stage, received = SPECTATE_STRUCT.unpack_from(data)
+        spectator = self.spectators.get(addr)
+        if spectator is None:
+            if len(self.spectators) >= self.max_spectators:
+                logger.debug('Refusing spectator %s, already %d of them.', addr, len(self.spectators))
+                return
+            logger.info('Spectator %s joined.', addr)
+        elif spectator[0] == stage:
+            received = max(received, spectator[1])
+        self.spectators[addr] = [stage, received, self.iteration]
+
+
+    def wait(self, timeout):
+        """Wait for a remote player to send something."""
+
+        self.transport.wait(timeout)
+        self.receive()
+
+
+    def simulate(self, game):
+        """Simulate one frame, and return whether it could be."""
+
+        frame = game.frame
+        keystates = []
+        predicted = False
+        for player in range(self.nb_players):
+            if player == self.selected_player:
+                keystate = self.local_inputs[frame]
+            else:
+                keystate = self.remote_inputs[player].get(frame)
+                if keystate is None:
+                    # Predict this player keeps doing the same thing.
+                    keystate = self.remote_inputs[player][self.remote_received[player] - 1]
+                    self.predictions[player, frame] = keystate
+                    predicted = True
+            keystates.append(keystate)
+
+        if predicted:
+            self.states[frame] = game.save_state()
+
+        try:
+            game.run_iter(keystates)
+        except (NextStage, GameOver):
+            if not predicted:
+                raise
+            # Only end the stage once every player agrees on how it ended.
+            game.load_state(self.states[frame])
+            self.discard(frame)
+            return False
+        return True
+
+
+    def rollback(self, game):
+        frame = game.frame
+        start = self.mispredicted
+        self.mispredicted = None
+
+        game.load_state(self.states[start])
+
+        sfx_player, music = game.sfx_player, game.music
+        game.sfx_player = game.music = self.muted_player
+        try:
+            while game.frame < frame:
+                if not self.simulate(game):
+                    break
+        finally:
+            game.sfx_player, game.music = sfx_player, music
+
+        self.nb_rollbacks += 1
+        self.nb_resimulated += frame - start
+        logger.debug('Rolled back %d frames at frame %d.', frame - start, frame)
+
+
+    def discard(self, frame):
+        """Drop the predictions made from frame on, which didn’t get
+        simulated after all."""
+
+        for key in [key for key in self.predictions if key[1] >= frame]:
+            del self.predictions[key]
+        for old in [old for old in self.states if old >= frame]:
+            del self.states[old]
+
+
+    def confirm(self):
+        """Pack the inputs every player agreed on, for the spectators."""
+
+        end = min(self.get_confirmed(), max(self.local_inputs) + 1)
+        while self.nb_confirmed < end:
+            frame = self.nb_confirmed
+            keystates = [self.local_inputs[frame] if player == self.selected_player
+                         else self.remote_inputs[player][frame]
+                         for player in range(self.nb_players)]
+            self.confirmed_inputs[frame] = self.frame_struct.pack(*keystates)
+            self.nb_confirmed += 1
+
+        # Keep a window of them, for the spectators lagging behind or
+        # joining a bit late.
+        oldest = self.nb_confirmed - self.spectator_window
+        for old in [old for old in self.confirmed_inputs if old < oldest]:
+            del self.confirmed_inputs[old]
+
+
+    def forget(self, frame):
+        """Drop what can’t be needed anymore, once every input before the
+        confirmed frame is known, every local input got acknowledged and
+        confirmed, and the game is at frame."""
+
+        confirmed = min(self.get_confirmed(), frame)
+        oldest = min(confirmed, min(self.acknowledged.values()), self.nb_confirmed)
+        for old in [old for old in self.states if old < confirmed]:
+            del self.states[old]
+        for old in [old for old in self.local_inputs if old < oldest]:
+            del self.local_inputs[old]
+        for player, remote_inputs in self.remote_inputs.items():
+            last = min(self.remote_received[player] - 1, confirmed, self.nb_confirmed)
+            for old in [old for old in remote_inputs if old < last]:
+                del remote_inputs[old]
+
+
+    def check_hashes(self, game):
+        """Compare the state hashes of the frames every player agrees on."""
+
+        # Hashes are final once no rollback can go back before them.
+        confirmed = min(self.get_confirmed(), game.frame)
+        while self.hashed < confirmed:
+            state_hash = game.state_hashes.get(self.hashed)
+            if state_hash is not None:
+                self.local_hashes[self.hashed] = state_hash
+                self.last_hash = self.hashed, state_hash
+            self.hashed += 1
+
+        for frame in sorted(self.remote_hashes):
+            state_hash = self.local_hashes.get(frame)
+            if state_hash is None:
+                if frame >= self.hashed:
+                    break
+            else:
+                for player, remote_hash in sorted(self.remote_hashes[frame].items()):
+                    if remote_hash != state_hash and self.desync is None:
+                        self.desync = self.synced + 1, frame
+                        logger.error('Desynchronised from player %d between '
+                                     'frames %d and %d of stage %d!', player,
+                                     self.synced + 1, frame, self.stage)
+                if self.desync is None:
+                    self.synced = frame
+            del self.remote_hashes[frame]
+
+        for frame in [frame for frame in self.local_hashes if frame <= self.synced]:
+            del self.local_hashes[frame]
 
 
     def run_iter(self, game, keystate):
-        if game.frame % 3 == 0:
-            # Phase 1: Update game with old data
-            self.run_game_iter(game, self.keystate, self.remote_keystate)
-        elif game.frame % 3 == 1:
-            # Phase 2: Update data, send new data, update game with old data
-            self.old_keystate, self.keystate = self.keystate, keystate
-            self.frame = game.frame // 3
-            self.send_message()
-            self.run_game_iter(game, self.old_keystate, self.remote_keystate)
-        elif game.frame % 3 == 2:
-            # Phase 3: Send new data, get remote data, update game with new data
-            self.send_message()
-            # Follow one valid update
-            message = self.read_message()
-            if message:
-                frame, keystate, old_keystate = message
-                if frame == self.frame:
-                    self.remote_keystate = keystate
-                elif frame == self.frame + 1:
-                    self.remote_keystate = old_keystate
-                else:
-                    raise Exception #TODO
-                self.run_game_iter(game, self.keystate, self.remote_keystate)
-            elif game.frame > 2:
-                logger.warn('Message not received in time, dropping frame.')
+        if game is not self.game:
+            self.start(game)
+        self.iteration += 1
+
+        # If the last frame got skipped, the input for this one has already
+        # been sent and can’t change anymore.
+        self.local_inputs.setdefault(game.frame + self.input_delay, keystate)
+        self.receive()
+        self.send()
+        self.flush()
+
+        if self.mispredicted is not None:
+            self.rollback(game)
+
+        # Don’t get further ahead than what can be rolled back.
+        if game.frame - self.get_confirmed() >= self.max_rollback:
+            self.wait(1. / 60.)
+            if self.mispredicted is not None:
+                self.rollback(game)
+
+        # Before simulating, as the stage may end on this frame.
+        self.confirm()
+
+        if game.frame - self.get_confirmed() >= self.max_rollback or not self.simulate(game):
+            self.nb_stalls += 1
+            logger.debug('Waiting for the inputs of frame %d.', self.get_confirmed())
+
+        self.forget(game.frame)
+        self.check_hashes(game)
+        self.send_confirmed()
+        self.flush()
+
+
+    def get_stats(self):
+        return {'rollbacks': self.nb_rollbacks,
+                'resimulated': self.nb_resimulated,
+                'stalls': self.nb_stalls,
+                'spectators': len(self.spectators),
+                'sent': self.transport.nb_sent,
+                'dropped': self.transport.nb_dropped,
+                'desync': self.desync}
+
+
+    def close(self):
+        logger.info('Netplay: %(rollbacks)d rollbacks, %(resimulated)d frames '
+                    'simulated again, %(stalls)d frames stalled, %(sent)d '
+                    'datagrams sent, %(dropped)d dropped.', self.get_stats())
+        self.transport.close()
+
+
+
+class Spectator:
+    """Drop-in replacement of Game.run_iter for the GameRunner, watching the
+    game played by the player at dest, with the inputs every player agreed
+    on.
+
+    Instance variables:
+    nb_stalls -- number of frames skipped waiting for the inputs
+    """
+
+    def __init__(self, port, dest, latency=0., jitter=0., loss=0.):
+        self.dest = dest
+        self.transport = Transport(port, latency, jitter, loss)
+        self.nb_stalls = 0
+        self.game = None
+
+
+    def start(self, game):
+        self.game = game
+        self.stage = game.stage
+        self.inputs = {}
+        self.received = game.frame
+
+
+    def send(self):
+        data = SPECTATE_STRUCT.pack(SPECTATE, self.stage, self.received)
+        self.transport.send([(data, self.dest, False)])
+
+
+    def receive(self):
+        for data, addr in self.transport.receive():
+            if addr != self.dest:
+                continue
+            try:
+                if data[0] != CONFIRMED:
+                    continue
+                _, _, stage, nb_players, first, nb_frames = CONFIRMED_STRUCT.unpack_from(data)
+                frame_struct = Struct('!%dH' % nb_players)
+                for i in range(nb_frames):
+                    frame = first + i
+                    if stage != self.stage or frame > self.received:
+                        break
+                    elif frame == self.received:
+                        offset = CONFIRMED_STRUCT.size + i * frame_struct.size
+                        self.inputs[frame] = list(frame_struct.unpack_from(data, offset))
+                        self.received += 1
+            except (StructError, IndexError):
+                logger.warn('Ignoring a malformed message from %s.', addr)
+
+
+    def run_iter(self, game, keystate):
+        if game is not self.game:
+            self.start(game)
+
+        self.send()
+        self.receive()
+        keystates = self.inputs.pop(game.frame, None)
+        if keystates is None:
+            self.transport.wait(1. / 60.)
+            self.receive()
+            keystates = self.inputs.pop(game.frame, None)
+        if keystates is None:
+            self.nb_stalls += 1
+            logger.debug('Waiting for the inputs of frame %d.', game.frame)
+            return
+
+        game.run_iter(keystates)
+
+
+    def get_stats(self):
+        return {'stalls': self.nb_stalls,
+                'received': self.received,
+                'sent': self.transport.nb_sent,
+                'dropped': self.transport.nb_dropped}
 
 
+    def close(self):
+        logger.info('Spectating: %(stalls)d frames stalled.', self.get_stats())
+        self.transport.close()
@@ -119,6 +119,9 @@ def parse_arguments(defaults):
     parser.add_argument('--debug', action='store_true', help='Set unlimited continues, and perhaps other debug features.')
     parser.add_argument('--verbosity', metavar='VERBOSITY', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='Select the wanted logging level.')
     parser.add_argument('--no-menu', action='store_true', help='Disable the menu.')
+    parser.add_argument('--no-cache', action='store_true', help='Parse every script again, instead of using the parsed ones kept in the cache directory.')
+    parser.add_argument('--prewarm-cache', action='store_true', help='Parse the scripts of every stage into the cache directory, and exit.')
+    parser.add_argument('--interpret-ecl', action='store_true', help='Interpret the enemy scripts, instead of compiling them to Python.')
 
     game_group = parser.add_argument_group('Game options')
     game_group.add_argument('-s', '--stage', metavar='STAGE', type=int, help='Stage, 1 to 7 (Extra), nothing means story mode.')
@@ -130,26 +133,38 @@ def parse_arguments(defaults):
     game_group.add_argument('--hints', metavar='HINTS', help='Hints file, to display text while playing.')
 
     replay_group = parser.add_argument_group('Replay options')
-    replay_group.add_argument('--replay', metavar='REPLAY', help='Select a file to replay.')
+    replay_group.add_argument('--replay', metavar='REPLAY', help='Select a file to replay, or a journal left by an interrupted --save-replay.')
     replay_group.add_argument('--save-replay', metavar='REPLAY', help='Save the upcoming game into a replay file.')
     replay_group.add_argument('--skip-replay', action='store_true', help='Skip the replay and start to play when it’s finished.')
 
     netplay_group = parser.add_argument_group('Netplay options')
     netplay_group.add_argument('--port', metavar='PORT', type=int, help='Local port to use.')
-    netplay_group.add_argument('--remote', metavar='REMOTE', help='Remote address.')
+    netplay_group.add_argument('--remote', metavar='REMOTE', help='Remote address, or comma-separated addresses of the players after this one with more than two players.')
+    netplay_group.add_argument('--players', metavar='NUMBER', type=int, help='Number of players.')
+    netplay_group.add_argument('--player', metavar='INDEX', type=int, help='Which player to play, by default the number of players minus one minus the number of remote addresses.')
+    netplay_group.add_argument('--spectate', action='store_true', help='Watch the game played by the player at the remote address, without playing.')
     netplay_group.add_argument('--friendly-fire', action='store_true', help='Allow friendly-fire during netplay.')
+    netplay_group.add_argument('--input-delay', metavar='FRAMES', type=int, help='Delay local inputs by that many frames, to leave them time to reach the remote player.')
+    netplay_group.add_argument('--max-rollback', metavar='FRAMES', type=int, help='Maximum number of frames to get ahead of the remote player, to be simulated again on misprediction.')
+    netplay_group.add_argument('--simulate-latency', metavar='MS', type=float, help='Delay every sent datagram by that many milliseconds, to try netplay on the loopback.')
+    netplay_group.add_argument('--simulate-jitter', metavar='MS', type=float, help='Delay every sent datagram by up to that many more milliseconds.')
+    netplay_group.add_argument('--simulate-loss', metavar='RATIO', type=float, help='Drop that ratio of sent datagrams, between 0 and 1.')
 
     graphics_group = parser.add_argument_group('Graphics options')
-    graphics_group.add_argument('--backend', metavar='BACKEND', choices=['opengl', 'sdl'], nargs='*', help='Which backend to use (opengl or sdl).')
+    graphics_group.add_argument('--backend', metavar='BACKEND', choices=['opengl', 'sdl', 'software'], nargs='*', help='Which backend to use (opengl, sdl, or software which renders without any window nor GPU).')
     graphics_group.add_argument('--fps-limit', metavar='FPS', type=int, help='Set fps limit. A value of 0 disables fps limiting, while a negative value limits to 60 fps if and only if vsync doesn’t work.')
     graphics_group.add_argument('--frameskip', metavar='FRAMESKIP', type=int, help='Set the frameskip, as 1/FRAMESKIP, or disabled if 0.')
     graphics_group.add_argument('--no-background', action='store_false', help='Disable background display (huge performance boost on slow systems).')
     graphics_group.add_argument('--no-particles', action='store_false', help='Disable particles handling (huge performance boost on slow systems).')
     graphics_group.add_argument('--no-sound', action='store_false', help='Disable music and sound effects.')
+    graphics_group.add_argument('--threaded', action='store_true', help='Run the game in its own thread, rendering the latest frame it produced, only supported by the OpenGL backend.')
+    graphics_group.add_argument('--record', action='store_true', help='Record every rendered frame, as PNG files in the screenshot directory.')
+    graphics_group.add_argument('--record-command', metavar='COMMAND', help='Record by piping raw RGB24 frames to COMMAND instead, {width} and {height} being replaced by the frame size.')
 
     opengl_group = parser.add_argument_group('OpenGL backend options')
     opengl_group.add_argument('--gl-flavor', choices=['core', 'es', 'compatibility', 'legacy'], help='OpenGL profile to use.')
     opengl_group.add_argument('--gl-version', type=float, help='OpenGL version to use.')
+    opengl_group.add_argument('--texture-atlas', action='store_true', help='Pack textures into a few big ones, to reduce the number of draw calls.')
 
     double_buffer = opengl_group.add_mutually_exclusive_group()
     double_buffer.add_argument('--double-buffer', dest='double_buffer', action='store_true', help='Enable double buffering.')
@@ -0,0 +1,256 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+"""Persistent cache of parsed scripts.
+
+ECL, ANM0, STD and MSG files get parsed at every launch and every stage
+transition, while they never change.  A ScriptCache keeps their parsed form
+in the XDG cache directory, one file per resource, so that later launches
+only have to map it and unmarshal it.
+
+A cache file is a header followed by the marshalled plain tuples, lists and
+dicts of the parsed resource: its instructions, sprite tables and interrupt
+maps.  The header holds the version of this layout, the version of marshal
+which wrote it, the kind of the resource and the checksum of the file it
+was parsed from, any mismatch making the cache file stale.
+"""
+
+import os
+import marshal
+from threading import get_ident
+from mmap import mmap, ACCESS_READ
+from struct import Struct, error as StructError
+from time import perf_counter
+
+from pytouhou.formats.std import Stage, Model
+from pytouhou.formats.ecl import ECL
+from pytouhou.formats.anm0 import ANM0, Script
+from pytouhou.formats.msg import MSG
+from pytouhou.formats.thtx import Texture
+from pytouhou.utils.xdg import save_cache_path
+
+from pytouhou.utils.helpers import get_logger
+
+logger = get_logger(__name__)
+
+# To be incremented whenever the parsed form of any format changes.
+CACHE_VERSION = 1
+
+MAGIC = b'PTSC'
+# Magic, layout version, marshal version, kind, checksum of the source.
+_header = Struct('<4sHH8sQ')
+
+# Kinds of resources which can be cached, by file extension.
+EXTENSIONS = {'.ecl': 'ecl', '.anm': 'anm', '.std': 'stage'}
+
+
+def get_kind(name):
+    """Return the kind of the resource name, or None if it can’t be
+    cached."""
+
+    base, extension = os.path.splitext(os.path.basename(name))
+    # MSG files don’t get an extension of their own.
+    if extension == '.dat' and base.startswith('msg'):
+        return 'msg'
+    return EXTENSIONS.get(extension)
+
+
+def dump_ecl(ecl):
+    return ecl.subs, ecl.mains
+
+
+def load_ecl(data):
+    ecl = ECL()
+    ecl.subs, ecl.mains = data
+    return ecl
+
+
+def dump_anm(anm_list):
+    entries = []
+    for anm in anm_list:
+        texture = anm.texture
+        if texture is not None:
+            texture = texture.width, texture.height, texture.fmt, bytes(texture.data)
+        scripts = {i: (list(script), script.interrupts)
+                   for i, script in anm.scripts.items()}
+        entries.append((anm.version, anm.size, anm.first_name,
+                        anm.secondary_name, anm.sprites, scripts, texture))
+    return entries
+
+
+def load_anm(data):
+    anm_list = []
+    for version, size, first_name, secondary_name, sprites, scripts, texture in data:
+        anm = ANM0()
+        anm.version = version
+        anm.size = size
+        anm.first_name = first_name
+        anm.secondary_name = secondary_name
+        anm.sprites = sprites
+        for i, (instructions, interrupts) in scripts.items():
+            script = anm.scripts[i] = Script()
+            script.extend(instructions)
+            script.interrupts = interrupts
+        if texture is not None:
+            anm.texture = Texture(*texture)
+        anm_list.append(anm)
+    return anm_list
+
+
+def dump_stage(stage):
+    models = [(model.unknown, model.bounding_box, model.quads)
+              for model in stage.models]
+    return (stage.name, stage.bgms, models, stage.object_instances,
+            stage.script)
+
+
+def load_stage(data):
+    stage = Stage()
+    stage.name, stage.bgms, models, stage.object_instances, stage.script = data
+    for unknown, bounding_box, quads in models:
+        model = Model(bounding_box=bounding_box, quads=quads)
+        model.unknown = unknown
+        stage.models.append(model)
+    return stage
+
+
+def dump_msg(msg):
+    return msg.msgs
+
+
+def load_msg(data):
+    msg = MSG()
+    msg.msgs = data
+    return msg
+
+
+
+class ScriptCache:
+    """Cache of parsed scripts, in directory.
+
+    Instance variables:
+    hits -- number of resources found in the cache
+    misses -- number of resources which had to be parsed
+    """
+
+    _formats = {'ecl': (ECL, dump_ecl, load_ecl),
+                'anm': (ANM0, dump_anm, load_anm),
+                'stage': (Stage, dump_stage, load_stage),
+                'msg': (MSG, dump_msg, load_msg)}
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = save_cache_path('pytouhou', 'scripts')
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+
+    def get_path(self, kind, name):
+        return os.path.join(self.directory, '%s.%s' % (name.replace(os.sep, '_'), kind))
+
+
+    def get(self, kind, name, checksum):
+        """Return the cached resource, or None if it isn’t cached or is
+        stale."""
+
+        try:
+            file = open(self.get_path(kind, name), 'rb')
+        except IOError:
+            return None
+
+        with file:
+            try:
+                data = mmap(file.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # Empty file.
+                return None
+
+        try:
+            magic, version, marshal_version, cached_kind, cached_checksum = _header.unpack_from(data)
+            if (magic != MAGIC or version != CACHE_VERSION or
+                    marshal_version != marshal.version or
+                    cached_kind.rstrip(b'\0') != kind.encode('ascii') or
+                    cached_checksum != checksum):
+                return None
+            with memoryview(data)[_header.size:] as payload:
+                value = marshal.loads(payload)
+            return self._formats[kind][2](value)
+        except (StructError, EOFError, ValueError, TypeError):
+            logger.warn('Corrupted cache entry for %s, ignoring.', name)
+            return None
+        finally:
+            data.close()
+
+
+    def put(self, kind, name, checksum, value):
+        header = _header.pack(MAGIC, CACHE_VERSION, marshal.version,
+                              kind.encode('ascii'), checksum)
+        payload = marshal.dumps(self._formats[kind][1](value))
+
+        # Write it aside first, so that no other instance can ever read a
+        # partial file.
+        path = self.get_path(kind, name)
+        temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), get_ident())
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(header)
+                file.write(payload)
+            os.replace(temp_path, path)
+        except IOError:
+            logger.warn('Failed to write the cache entry for %s.', name)
+
+
+    def load(self, kind, name, file, checksum):
+        """Return the resource name of the given kind from the cache, or
+        parse it from file and cache it.
+
+        file is only called, to return the file to parse, when the resource
+        isn’t in the cache already.
+        """
+
+        value = self.get(kind, name, checksum)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = self._formats[kind][0].read(file())
+        self.put(kind, name, checksum, value)
+        return value
+
+
+
+def prewarm(loader):
+    """Parse every cacheable resource known to loader into its cache, and
+    compile the ECL files if it has an ECL compiler.
+
+    Return the number of resources which had to be parsed, and the time it
+    took in seconds.
+    """
+
+    cache = loader.cache
+    misses = cache.misses
+    start = perf_counter()
+    for name in sorted(loader.known_files):
+        kind = get_kind(name)
+        if kind is None:
+            continue
+        try:
+            value = loader.load(kind, name)
+            if kind == 'ecl':
+                loader.compile_ecl(value)
+        except Exception:
+            logger.exception('Failed to parse %s, skipping.', name)
+    return cache.misses - misses, perf_counter() - start
@@ -14,7 +14,10 @@
 
 import os
 from glob import glob
+from zlib import crc32
 from itertools import chain
+from io import BytesIO
+from threading import Lock
 
 from pytouhou.formats import WrongFormatError
 from pytouhou.formats.pbg3 import PBG3
@@ -62,10 +65,11 @@ class Directory:
 class ArchiveDescription:
     _formats = {b'PBG3': PBG3}
 
-    def __init__(self, path, format_class, file_list=None):
+    def __init__(self, path, format_class, file_list=None, entries=None):
         self.path = path
         self.format_class = format_class
         self.file_list = file_list or []
+        self.entries = entries or {}
 
 
     def open(self):
@@ -89,17 +93,52 @@ class ArchiveDescription:
             format_class = cls._formats[magic]
             instance = format_class.read(file)
             file_list = instance.list_files()
-        return cls(path, format_class, file_list)
+        return cls(path, format_class, file_list, instance.entries)
+
+
+    def get_checksum(self, name):
+        """Return a 64-bit checksum of the file name, to tell whether it
+        changed."""
+
+        if self.format_class is Directory:
+            with open(os.path.join(self.path, str(name)), 'rb') as file:
+                data = file.read()
+            return crc32(data) << 32 | len(data)
+
+        # The archive already knows a checksum of its compressed files.
+        entry = self.entries[name]
+        return (entry.checksum & 0xffffffff) << 32 | entry.size
+
+
+    def get_size(self, name):
+        """Return the size of the file name, once extracted."""
+
+        if self.format_class is Directory:
+            return os.path.getsize(os.path.join(self.path, str(name)))
+        return self.entries[name].size
 
 
 
 class Loader:
+    _formats = {'anm': ANM0, 'ecl': ECL, 'msg': MSG, 'stage': Stage}
+
     def __init__(self, game_dir=None):
         self.exe_files = []
         self.game_dir = game_dir
         self.known_files = {}
         self.instanced_anms = {}  # Cache for the textures.
         self.loaded_anms = []  # For the double loading warnings.
+        self.atlas = None  # Set by renderers supporting texture atlases.
+        self.cache = None  # ScriptCache of the parsed scripts, if any.
+        self.ecl_compiler = None  # ECLCompiler, to not interpret the ECL.
+
+        # Resources loaded ahead of time by a Prefetcher, consumed by the
+        # get_* methods below.
+        self.staged = {}
+        self.staged_size = 0
+        self.staging_lock = Lock()
+        self.hidden_load_time = 0.
+        self.staging_hits = 0
 
 
     def scan_archives(self, paths_lists):
@@ -121,34 +160,108 @@ class Loader:
                     self.known_files[name] = archive_description
 
 
-    def get_file(self, name):
+    def stage(self, kind, name, value, size, load_time):
+        """Put an already loaded resource in the staging area.
+
+        Return False if it was already there, True otherwise.
+        """
+
+        with self.staging_lock:
+            if (kind, name) in self.staged:
+                return False
+            self.staged[(kind, name)] = (value, size, load_time)
+            self.staged_size += size
+        return True
+
+
+    def unstage(self, kind, name):
+        """Take a resource out of the staging area, or return None."""
+
+        with self.staging_lock:
+            try:
+                value, size, load_time = self.staged.pop((kind, name))
+            except KeyError:
+                return None
+            self.staged_size -= size
+            self.hidden_load_time += load_time
+            self.staging_hits += 1
+        return value
+
+
+    def clear_staging(self):
+        """Drop every resource which hasn’t been consumed yet."""
+
+        with self.staging_lock:
+            dropped = len(self.staged)
+            self.staged.clear()
+            self.staged_size = 0
+        return dropped
+
+
+    def read_file(self, name):
+        """Extract a file from its archive, bypassing the staging area."""
+
         with self.known_files[name].open() as archive:
             return archive.get_file(name)
 
 
+    def get_file(self, name):
+        data = self.unstage('file', name)
+        if data is not None:
+            return BytesIO(data)
+        return self.read_file(name)
+
+
+    def load(self, kind, name):
+        """Parse the script name, of one of the kinds of the Prefetcher,
+        going through the cache if there is one."""
+
+        if self.cache is None:
+            return self._formats[kind].read(self.get_file(name))
+        checksum = self.known_files[name].get_checksum(name)
+        return self.cache.load(kind, name, lambda: self.get_file(name), checksum)
+
+
     def get_anm(self, name):
         if name in self.loaded_anms:
             logger.warn('ANM0 %s already loaded', name)
-        file = self.get_file(name)
-        anm = ANM0.read(file)
+        anm = self.unstage('anm', name)
+        if anm is None:
+            anm = self.load('anm', name)
+        if self.atlas is not None:
+            self.atlas.add(anm, self)
         self.instanced_anms[name] = anm
         self.loaded_anms.append(name)
         return anm
 
 
     def get_stage(self, name):
-        file = self.get_file(name)
-        return Stage.read(file) #TODO: modular
+        stage = self.unstage('stage', name)
+        if stage is not None:
+            return stage
+        return self.load('stage', name) #TODO: modular
 
 
     def get_ecl(self, name):
-        file = self.get_file(name)
-        return ECL.read(file) #TODO: modular
+        ecl = self.unstage('ecl', name)
+        if ecl is not None:
+            return ecl
+        return self.load('ecl', name) #TODO: modular
+
+
+    def compile_ecl(self, ecl):
+        """Return the compiled subs of ecl, or None to interpret them."""
+
+        if self.ecl_compiler is None:
+            return None
+        return self.ecl_compiler.compile(ecl.subs)
 
 
     def get_msg(self, name):
-        file = self.get_file(name)
-        return MSG.read(file) #TODO: modular
+        msg = self.unstage('msg', name)
+        if msg is not None:
+            return msg
+        return self.load('msg', name) #TODO: modular
 
 
     def get_sht(self, name):
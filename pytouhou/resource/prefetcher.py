@@ -0,0 +1,145 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+"""Background loading of the resources of an upcoming stage.
+
+A Prefetcher reads and parses a list of resources in a separate thread, and
+puts them in the staging area of its Loader, from where the get_* methods of
+the Loader will pick them up instead of loading them again.
+"""
+
+import os
+from threading import Thread, Event
+from time import perf_counter
+
+from pytouhou.utils.helpers import get_logger
+
+logger = get_logger(__name__)
+
+
+class Prefetcher:
+    """Load the resources of the next stage while the current one is played.
+
+    Instance variables:
+    loader -- the Loader in which to stage the resources
+    resources -- list of (kind, name) tuples, kind being one of 'anm', 'ecl',
+                 'msg', 'stage' or 'file'
+    max_size -- maximum amount of file data to keep staged, in bytes
+    load_time -- time spent loading in the background, in seconds
+    """
+
+    def __init__(self, loader, resources, max_size=64 << 20):
+        self.loader = loader
+        self.resources = list(resources)
+        self.max_size = max_size
+        self.load_time = 0.
+        self.nb_staged = 0
+        self._cancelled = Event()
+        self._thread = None
+
+
+    def start(self):
+        """Start loading in the background, if it wasn’t already started."""
+
+        if self._thread is not None or self._cancelled.is_set():
+            return
+        self._thread = Thread(target=self._run, name='prefetcher', daemon=True)
+        self._thread.start()
+        logger.debug('Started prefetching %d resources.', len(self.resources))
+
+
+    def wait(self):
+        """Block until the background loading is done."""
+
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def cancel(self):
+        """Stop loading, and drop everything which has been staged."""
+
+        self._cancelled.set()
+        self.wait()
+        dropped = self.loader.clear_staging()
+        if dropped:
+            logger.debug('Dropped %d prefetched resources.', dropped)
+
+
+    def report(self, sync_time):
+        """Log how much of the loading got hidden behind the previous stage.
+
+        sync_time is the time, in seconds, the game spent loading the stage
+        on the main thread.
+        """
+
+        hidden = self.loader.hidden_load_time
+        total = hidden + sync_time
+        logger.info('Stage loaded in %.1f ms, %.1f ms (%d%%) hidden by '
+                    'prefetching %d/%d resources.', total * 1000,
+                    hidden * 1000, 100 * hidden / total if total else 0,
+                    self.loader.staging_hits, self.nb_staged)
+        self.loader.hidden_load_time = 0.
+        self.loader.staging_hits = 0
+
+
+    def _run(self):
+        pending = list(self.resources)
+        while pending:
+            kind, name = pending.pop(0)
+            if self._cancelled.is_set():
+                return
+
+            if name not in self.loader.known_files:
+                continue
+
+            start = perf_counter()
+            try:
+                if kind == 'file':
+                    value = self.loader.read_file(name).read()
+                    size = len(value)
+                else:
+                    value = self.loader.load(kind, name)
+                    size = self.loader.known_files[name].get_size(name)
+            except Exception:
+                # The main thread will raise it again when loading it itself.
+                logger.debug('Failed to prefetch %s, skipping.', name,
+                             exc_info=True)
+                continue
+            elapsed = perf_counter() - start
+
+            if self.loader.staged_size + size > self.max_size:
+                logger.debug('Prefetching memory cap reached at %s, stopping.',
+                             name)
+                return
+            if self._cancelled.is_set():
+                return
+
+            if self.loader.stage(kind, name, value, size, elapsed):
+                self.load_time += elapsed
+                self.nb_staged += 1
+
+            # The textures and music descriptions aren’t known before their
+            # parent resource is parsed.
+            if kind == 'anm':
+                for entry in value:
+                    if entry.texture is not None:
+                        continue
+                    for texture_name in (entry.first_name, entry.secondary_name):
+                        if texture_name:
+                            pending.append(('file', os.path.basename(texture_name)))
+            elif kind == 'stage':
+                for bgm in value.bgms:
+                    if bgm:
+                        posname = bgm[1].replace('bgm/', '').replace('.mid', '.pos')
+                        pending.append(('file', posname))
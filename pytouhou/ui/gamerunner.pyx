@@ -14,28 +14,65 @@
 
 cimport cython
 
+from queue import SimpleQueue
+from threading import Thread
+
 from pytouhou.lib cimport sdl
 
-from .window cimport Window, Runner
-from .music import BGMPlayer, SFXPlayer
+from .window cimport Window, Runner, Clock
+from .music import BGMPlayer, SFXPlayer, DeferredPlayer, run_deferred
+from .recorder import FrameWriter
+from .snapshots import SnapshotRing
 from pytouhou.game.game cimport Game
 from pytouhou.game.music cimport MusicPlayer
+from pytouhou.utils.helpers import get_logger
+
+logger = get_logger(__name__)
+
+
+cdef enum:
+    EVENT_QUIT = 1
+    EVENT_CAPTURE = 2
 
 
 cdef class GameRunner(Runner):
     cdef object background, con, resource_loader, keys, replay_level, common
+    cdef object prefetcher
     cdef Game game
     cdef Window window
-    cdef list save_keystates
+    cdef object save_keystates
+    cdef object recorder, screenshots
+    cdef long nb_recorded
     cdef bint skip
 
+    # Input of the next frame, sampled on the main thread.
+    cdef long keystate
+    cdef double fps
+
+    # Threaded mode, where the game runs in a simulation thread, publishing
+    # snapshots of every frame to the ring for the main thread to render.
+    # Everything touching SDL stays on the main thread: the keystates and
+    # framerate get sent to the simulation through inputs, and it sends back
+    # the calls to the audio players and the prefetcher through deferred.
+    cdef bint threaded, stop_simulation
+    cdef long stage
+    cdef object ring, simulation, simulation_error, current_snapshot
+    cdef object inputs, deferred
+
     # Since we want to support multiple renderers, don’t specify its type.
     #TODO: find a way to still specify its interface.
     cdef object renderer
 
     def __init__(self, Window window, renderer, common, resource_loader,
-                 bint skip=False, con=None):
+                 bint skip=False, con=None, recorder=None, bint threaded=False):
         self.renderer = renderer
+        self.recorder = recorder
+
+        if threaded and not hasattr(renderer, 'render_snapshot'):
+            logger.warning('This backend can’t render from another thread, '
+                           'disabling the threaded mode.')
+            threaded = False
+        self.threaded = threaded
         self.common = common
         self.resource_loader = resource_loader
 
@@ -49,9 +86,12 @@ cdef class GameRunner(Runner):
 
 
     def load_game(self, Game game, background=None, bgms=None, replay=None,
-                  save_keystates=None):
+                  save_keystates=None, prefetcher=None):
         self.game = game
+        self.stage = game.stage
         self.background = background
+        self.prefetcher = prefetcher
+        self.simulation_error = None
 
         if self.renderer is not None:
             self.renderer.load_textures(self.resource_loader.instanced_anms)
@@ -108,54 +148,104 @@ cdef class GameRunner(Runner):
             self.renderer.start(self.common)
 
 
-    cdef bint capture(self) except True:
+    cdef bint finish(self) except True:
+        if self.simulation is not None:
+            self.stop()
+
+        # The last rendered frame is still waiting in the renderer.
+        if self.recorder is not None:
+            frame = self.renderer.flush_frame()
+            if frame is not None:
+                self.record(frame)
+
+
+    cdef bint capture(self, long frame) except True:
         if self.renderer is not None:
-            filename = 'screenshot/frame%06d.ppm' % self.game.frame
-            self.renderer.capture(filename, self.width, self.height)
+            if self.screenshots is None:
+                self.screenshots = FrameWriter(self.width, self.height)
+            data, bottom_up = self.renderer.capture(self.width, self.height)
+            self.screenshots.push(frame, data, bottom_up)
 
 
-    cpdef bint update(self, bint render) except -1:
-        cdef long keystate
-        capture = False
+    cdef bint record(self, tuple frame) except True:
+        data, bottom_up = frame
+        self.recorder.push(self.nb_recorded, data, bottom_up)
+        self.nb_recorded += 1
+
+
+    def close(self):
+        """Wait for the captured frames to be written."""
+
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.screenshots is not None:
+            self.screenshots.close()
+            self.screenshots = None
+
+
+    def get_stats(self):
+        """Return the statistics of the threaded mode, or None."""
+
+        if self.ring is None:
+            return None
+        return self.ring.get_stats()
+
+
+    cdef int poll_events(self) except -1:
+        cdef int events = 0
 
-        if self.background is not None:
-            self.background.update(self.game.frame)
         for event in sdl.poll_events():
             type_ = event[0]
             if type_ == sdl.KEYDOWN:
                 scancode = event[1]
                 if scancode == sdl.SCANCODE_ESCAPE:
-                    return False #TODO: implement the pause.
+                    events |= EVENT_QUIT #TODO: implement the pause.
                 elif scancode == sdl.SCANCODE_P or scancode == sdl.SCANCODE_HOME:
-                    capture = True
+                    events |= EVENT_CAPTURE
             elif type_ == sdl.QUIT:
-                return False
+                events |= EVENT_QUIT
             elif type_ == sdl.WINDOWEVENT:
                 event_ = event[1]
                 if event_ == sdl.WINDOWEVENT_RESIZED:
                     self.set_renderer_size(event[2], event[3])
                     if self.window is not None:
                         self.window.set_size(event[2], event[3])
+        return events
+
+
+    cdef long read_keystate(self) except -1:
+        cdef long keystate = 0
+
+        #TODO: allow user settings
+        keys = sdl.keyboard_state
+        if keys[sdl.SCANCODE_Z]:
+            keystate |= 1
+        if keys[sdl.SCANCODE_X]:
+            keystate |= 2
+        if keys[sdl.SCANCODE_LSHIFT]:
+            keystate |= 4
+        if keys[sdl.SCANCODE_UP]:
+            keystate |= 16
+        if keys[sdl.SCANCODE_DOWN]:
+            keystate |= 32
+        if keys[sdl.SCANCODE_LEFT]:
+            keystate |= 64
+        if keys[sdl.SCANCODE_RIGHT]:
+            keystate |= 128
+        if keys[sdl.SCANCODE_LCTRL]:
+            keystate |= 256
+        return keystate
+
+
+    cdef bint run_game_frame(self) except True:
+        cdef long keystate
+
+        if self.background is not None:
+            self.background.update(self.game.frame)
+
         if self.replay_level is None:
-            #TODO: allow user settings
-            keys = sdl.keyboard_state
-            keystate = 0
-            if keys[sdl.SCANCODE_Z]:
-                keystate |= 1
-            if keys[sdl.SCANCODE_X]:
-                keystate |= 2
-            if keys[sdl.SCANCODE_LSHIFT]:
-                keystate |= 4
-            if keys[sdl.SCANCODE_UP]:
-                keystate |= 16
-            if keys[sdl.SCANCODE_DOWN]:
-                keystate |= 32
-            if keys[sdl.SCANCODE_LEFT]:
-                keystate |= 64
-            if keys[sdl.SCANCODE_RIGHT]:
-                keystate |= 128
-            if keys[sdl.SCANCODE_LCTRL]:
-                keystate |= 256
+            keystate = self.keystate
         else:
             try:
                 keystate = self.keys.next()
@@ -164,24 +254,177 @@ cdef class GameRunner(Runner):
                 if self.skip:
                     self.set_input()
                     self.skip = False
-                    self.game.sfx_player = SFXPlayer(self.resource_loader)
+                    player = SFXPlayer(self.resource_loader)
+                    if self.threaded:
+                        player = DeferredPlayer(player, self.deferred)
+                    self.game.sfx_player = player
 
         if self.save_keystates is not None:
-            self.save_keystates.append(keystate)
+            self.save_keystates.push(keystate)
 
         if self.con is not None:
             self.con.run_iter(self.game, keystate)
         else:
             self.game.run_iter([keystate])
 
+        # Start loading the next stage once the boss of this one shows up.
+        if self.prefetcher is not None and self.game.boss is not None:
+            if self.threaded:
+                self.deferred.put((self.prefetcher.start, ()))
+            else:
+                self.prefetcher.start()
+            self.prefetcher = None
+
         labels = self.game.interface.labels
         if self.window is not None and 'framerate' in labels:
-            labels['framerate'].set_text('%.2ffps' % self.window.get_fps())
+            labels['framerate'].set_text('%.2ffps' % self.fps)
+
+
+    def simulate(self):
+        """Run the game at 60 fps, publishing a snapshot of every frame.
+
+        This is the body of the simulation thread; the game only ever gets
+        touched from there while it runs.  Keystates come either from the
+        replay or from the keyboard state, sampled once per frame, so the
+        game is exactly as deterministic as in the single-threaded mode.
+        """
+
+        cdef Clock clock = Clock(60)
+
+        try:
+            while not self.stop_simulation:
+                # Only the latest input matters, if the main thread sent
+                # several since the previous frame.
+                while not self.inputs.empty():
+                    self.keystate, self.fps = self.inputs.get()
+                self.run_game_frame()
+                if not self.skip:
+                    snapshot = self.ring.acquire()
+                    if snapshot is None:
+                        break
+                    # The interface is always packed fully, since the render
+                    # thread can skip snapshots.
+                    self.renderer.snapshot(self.game, snapshot, True)
+                    self.ring.publish(snapshot)
+                with nogil:
+                    clock.tick()
+        except BaseException as error:
+            # NextStage and GameOver included, the main thread raises them
+            # again on its next update.
+            self.simulation_error = error
+
+
+    cdef bint stop(self) except True:
+        self.stop_simulation = True
+        self.ring.close()
+        if self.simulation is not None:
+            self.simulation.join()
+            self.simulation = None
+
+        # The sounds and the prefetching asked for until the end still have
+        # to happen, but none of its frames will be drawn anymore.
+        run_deferred(self.deferred)
+        if self.current_snapshot is not None:
+            self.ring.release(self.current_snapshot)
+            self.current_snapshot = None
+        self.ring.flush()
+
+        stats = self.ring.get_stats()
+        logger.info('%d frames simulated every %.2f ms (jitter %.2f ms), '
+                    '%d rendered every %.2f ms (jitter %.2f ms), %d dropped.',
+                    stats['published'], stats['sim_frame_time'],
+                    stats['sim_jitter'], stats['rendered'],
+                    stats['render_frame_time'], stats['render_jitter'],
+                    stats['dropped'])
+
+
+    cdef bint update_threaded(self, bint render, int events) except -1:
+        cdef bint new_frame = False
+
+        if self.ring is None:
+            # Recording needs every frame, so the simulation waits for the
+            # render thread then.
+            self.ring = SnapshotRing(self.renderer.new_snapshot,
+                                     lossless=self.recorder is not None)
+            self.inputs = SimpleQueue()
+            self.deferred = SimpleQueue()
+
+        if self.simulation is None and self.simulation_error is None:
+            game = self.game
+            if not isinstance(game.sfx_player, DeferredPlayer):
+                game.sfx_player = DeferredPlayer(game.sfx_player, self.deferred)
+            if not isinstance(game.music, DeferredPlayer):
+                game.music = DeferredPlayer(game.music, self.deferred)
+            self.stop_simulation = False
+            self.simulation = Thread(target=self.simulate, name='simulation',
+                                     daemon=True)
+            self.simulation.start()
+
+        self.inputs.put((self.read_keystate(),
+                         self.window.get_fps() if self.window is not None else 0.))
+        run_deferred(self.deferred)
+
+        if events & EVENT_QUIT:
+            self.stop()
+            return False
+
+        if self.simulation_error is not None:
+            error = self.simulation_error
+            self.simulation_error = None
+            self.stop()
+            raise error
+
+        # Draw the newest snapshot, or the previous one again if the
+        # simulation didn’t publish any since; this is only possible because
+        # their interface is always complete.
+        snapshot = self.ring.take(0 if self.current_snapshot is not None else .1)
+        if snapshot is not None and snapshot.stage != self.stage:
+            # Published before the stage changed.
+            self.ring.release(snapshot)
+            snapshot = None
+        if snapshot is not None:
+            if self.current_snapshot is not None:
+                self.ring.release(self.current_snapshot)
+            self.current_snapshot = snapshot
+            new_frame = True
+
+        if render and self.current_snapshot is not None:
+            self.renderer.render_snapshot(self.current_snapshot)
+            # Drawing the same snapshot again doesn’t make a new frame.
+            if self.recorder is not None and new_frame:
+                frame = self.renderer.read_frame(self.width, self.height)
+                if frame is not None:
+                    self.record(frame)
+
+        if events & EVENT_CAPTURE and self.current_snapshot is not None:
+            self.capture(self.current_snapshot.frame)
+
+        return True
+
+
+    cpdef bint update(self, bint render) except -1:
+        cdef int events = self.poll_events()
+
+        if self.threaded:
+            return self.update_threaded(render, events)
+
+        if events & EVENT_QUIT:
+            return False
+
+        if self.replay_level is None:
+            self.keystate = self.read_keystate()
+        if self.window is not None:
+            self.fps = self.window.get_fps()
+        self.run_game_frame()
 
         if render and not self.skip and self.renderer is not None:
             self.renderer.render(self.game)
+            if self.recorder is not None:
+                frame = self.renderer.read_frame(self.width, self.height)
+                if frame is not None:
+                    self.record(frame)
 
-        if capture:
-            self.capture()
+        if events & EVENT_CAPTURE:
+            self.capture(self.game.frame)
 
         return True
@@ -0,0 +1,2 @@
+cdef decode_png(loader, first_name, secondary_name)
+cdef compose_page(loader, page)
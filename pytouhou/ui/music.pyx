@@ -107,3 +107,32 @@ cdef class SFXPlayer(MusicPlayer):
         sound = self.get_sound(name)
         if sound is not None:
             sound.set_volume(volume)
+
+
+cdef class DeferredPlayer(MusicPlayer):
+    """Forward the calls made to player to a queue.
+
+    The game can then run in another thread than the one owning the audio
+    device, which runs the queued calls with run_deferred().
+    """
+
+    cdef public MusicPlayer player
+    cdef object queue
+
+    def __init__(self, MusicPlayer player, queue):
+        self.player = player
+        self.queue = queue
+
+    cpdef play(self, name):
+        self.queue.put((self.player.play, (name,)))
+
+    cpdef set_volume(self, name, float volume):
+        self.queue.put((self.player.set_volume, (name, volume)))
+
+
+def run_deferred(queue):
+    """Run every call waiting in queue, in the current thread."""
+
+    while not queue.empty():
+        function, args = queue.get()
+        function(*args)
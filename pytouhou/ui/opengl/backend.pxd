@@ -13,4 +13,5 @@ cdef bint use_framebuffer_blit
 cdef bint use_primitive_restart
 cdef bint use_pack_invert
 cdef bint use_scaled_rendering
+cdef bint use_texture_atlas
 cdef bytes shader_header
@@ -23,7 +23,7 @@ def init(options):
 
     cdef str flavor
 
-    global profile, major, minor, double_buffer, is_legacy, GameRenderer
+    global profile, major, minor, double_buffer, is_legacy, use_texture_atlas, GameRenderer
 
     flavor = options['flavor']
     assert flavor in ('core', 'es', 'compatibility', 'legacy')
@@ -41,6 +41,8 @@ def init(options):
 
     is_legacy = flavor == 'legacy' or flavor == 'compatibility' and major < 2
 
+    use_texture_atlas = options.get('texture-atlas', False)
+
     #TODO: check for framebuffer/renderbuffer support.
 
     from pytouhou.ui.opengl.gamerenderer import GameRenderer
@@ -1,4 +1,5 @@
 from pytouhou.lib.opengl cimport GLuint, GLushort, GLsizei
+from pytouhou.game.sprite cimport Sprite
 
 cdef struct Vertex:
     float x, y, z
@@ -9,15 +10,35 @@ cdef struct Vertex:
 cdef class BackgroundRenderer:
     cdef GLuint texture
     cdef GLsizei nb_indices
+    cdef object background, lock
+
+    # Vertices of the quads, chunk after chunk, and what is needed to draw
+    # the visible ones in the order of the whole background.
+    cdef Vertex *vertices
+    cdef GLushort *indices
+    cdef long nb_quads, nb_chunks
+    cdef long *quad_vertex  # First vertex of each quad, in drawing order.
+    cdef long *quad_chunk  # Chunk of each quad, in drawing order.
+    cdef long *chunk_start  # First quad of each chunk in the vertices.
+
+    # Models share their sprites between all of their instances, so every
+    # sprite gets a version bumped whenever it changed, and every quad
+    # remembers the version it got packed with.
+    cdef list sprites
+    cdef long *quad_sprite  # Index in sprites of each quad in the vertices.
+    cdef unsigned long *sprite_versions
+    cdef unsigned long *packed_versions
+    cdef unsigned long *chunk_versions
+    cdef unsigned long *uploaded_versions
+    cdef tuple drawn_chunks
 
     # For modern GL.
     cdef GLuint vbo, ibo
     cdef GLuint vao
 
-    # For fixed pipeline.
-    cdef Vertex *vertex_buffer
-    cdef GLushort nb_vertices
-
     cdef void set_state(self) nogil
-    cdef void render_background(self) nogil
+    cdef void pack_quad(self, long quad, Sprite sprite, float ox, float oy, float oz) nogil
+    cdef tuple update(self, float aspect)
+    cdef bint build_indices(self, tuple visible) except True
+    cdef long render_background(self, tuple visible) except -1
     cdef bint load(self, background, GLuint[MAX_TEXTURES] textures) except True
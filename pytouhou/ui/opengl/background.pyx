@@ -12,29 +12,57 @@
 ## GNU General Public License for more details.
 ##
 
-from libc.stdlib cimport malloc, free, realloc
+from libc.stdlib cimport malloc, calloc, free
+
+from threading import Lock
 
 from pytouhou.lib.opengl cimport \
          (glVertexPointer, glTexCoordPointer, glColorPointer,
           glVertexAttribPointer, glEnableVertexAttribArray, glBlendFunc,
-          glBindTexture, glBindBuffer, glBufferData, GL_ARRAY_BUFFER,
-          GL_STATIC_DRAW, GL_UNSIGNED_BYTE, GL_FLOAT, GL_SRC_ALPHA,
-          GL_ONE_MINUS_SRC_ALPHA, GL_TEXTURE_2D, glGenBuffers, glEnable,
-          glDisable, GL_DEPTH_TEST, glDrawElements, GL_UNSIGNED_SHORT,
-          GL_ELEMENT_ARRAY_BUFFER, glDeleteBuffers, glGenVertexArrays,
-          glDeleteVertexArrays, glBindVertexArray, glPushDebugGroup,
-          GL_DEBUG_SOURCE_APPLICATION, glPopDebugGroup, glDrawArrays)
-
-from .sprite cimport get_sprite_rendering_data
+          glBindTexture, glBindBuffer, glBufferData, glBufferSubData,
+          GL_ARRAY_BUFFER, GL_DYNAMIC_DRAW, GL_UNSIGNED_BYTE,
+          GL_FLOAT, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA, GL_TEXTURE_2D,
+          glGenBuffers, glEnable, glDisable, GL_DEPTH_TEST, glDrawElements,
+          GL_UNSIGNED_SHORT, GL_ELEMENT_ARRAY_BUFFER, glDeleteBuffers,
+          glGenVertexArrays, glDeleteVertexArrays, glBindVertexArray,
+          glPushDebugGroup, GL_DEBUG_SOURCE_APPLICATION, glPopDebugGroup)
+
+from pytouhou.utils.helpers import get_logger
+
+from .sprite cimport get_sprite_rendering_data, RenderingData
 from .backend cimport primitive_mode, is_legacy, use_debug_group, use_vao, use_primitive_restart
 
+logger = get_logger(__name__)
+
+
+cdef enum:
+    # Indices are 16-bit, with 0xFFFF being reserved for primitive restart.
+    MAX_QUADS = 16383
+
 
 cdef class BackgroundRenderer:
+    """Draw the background, chunk by chunk.
+
+    The chunks of the Background are culled against the view frustum on each
+    frame, and only the visible ones get drawn.  Their quads are re-packed
+    when their ANM scripts changed them, and those chunks alone uploaded
+    again.  update() runs alongside the game, render_background() alongside
+    the rendering, possibly in another thread.
+    """
+
     def __dealloc__(self):
-        if is_legacy:
-            if self.vertex_buffer != NULL:
-                free(self.vertex_buffer)
-        else:
+        free(self.vertices)
+        free(self.indices)
+        free(self.quad_vertex)
+        free(self.quad_chunk)
+        free(self.chunk_start)
+        free(self.quad_sprite)
+        free(self.sprite_versions)
+        free(self.packed_versions)
+        free(self.chunk_versions)
+        free(self.uploaded_versions)
+
+        if not is_legacy:
             glDeleteBuffers(1, &self.vbo)
             glDeleteBuffers(1, &self.ibo)
 
@@ -43,6 +71,8 @@ cdef class BackgroundRenderer:
 
 
     def __init__(self):
+        self.lock = Lock()
+
         if not is_legacy:
             if use_debug_group:
                 glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Background creation")
@@ -73,28 +103,149 @@ cdef class BackgroundRenderer:
         glEnableVertexAttribArray(2)
 
 
-    cdef void render_background(self) nogil:
+    cdef void pack_quad(self, long quad, Sprite sprite, float ox, float oy, float oz) nogil:
+        cdef RenderingData *data = get_sprite_rendering_data(sprite)
+        cdef Vertex *vertex = &self.vertices[4 * quad]
+
+        r, g, b, a = data.color[0], data.color[1], data.color[2], data.color[3]
+        vertex[0] = Vertex(data.pos[0] + ox, data.pos[4] + oy, data.pos[8] + oz, data.left, data.bottom, r, g, b, a)
+        vertex[1] = Vertex(data.pos[1] + ox, data.pos[5] + oy, data.pos[9] + oz, data.right, data.bottom, r, g, b, a)
+        vertex[2] = Vertex(data.pos[2] + ox, data.pos[6] + oy, data.pos[10] + oz, data.right, data.top, r, g, b, a)
+        vertex[3] = Vertex(data.pos[3] + ox, data.pos[7] + oy, data.pos[11] + oz, data.left, data.top, r, g, b, a)
+
+
+    cdef tuple update(self, float aspect):
+        """Re-pack the visible chunks changed since the previous call, and
+        return the indices of the visible ones."""
+
+        cdef Sprite sprite
+        cdef long i, quad
+        cdef unsigned long version
+        cdef bint changed
+
+        visible = tuple(self.background.visible_chunks(aspect))
+
+        # Rendering the sprite clears its dirty flag, so it has to be looked
+        # at once for all of the quads using it, visible or not.
+        for i, sprite in enumerate(self.sprites):
+            if sprite.dirty:
+                get_sprite_rendering_data(sprite)
+                self.sprite_versions[i] += 1
+
+        with self.lock:
+            for i in visible:
+                changed = False
+                quad = self.chunk_start[i]
+                for order, x, y, z, sprite in self.background.chunks[i].quads:
+                    if order < MAX_QUADS:
+                        version = self.sprite_versions[self.quad_sprite[quad]]
+                        if self.packed_versions[quad] != version:
+                            self.pack_quad(quad, sprite, x, y, z)
+                            self.packed_versions[quad] = version
+                            changed = True
+                        quad += 1
+                if changed:
+                    self.chunk_versions[i] += 1
+
+        return visible
+
+
+    cdef bint build_indices(self, tuple visible) except True:
+        cdef long i, quad, vertex
+        cdef GLushort *indices = self.indices
+        cdef char *drawn = <char*>calloc(self.nb_chunks, sizeof(char))
+
+        if drawn == NULL:
+            raise MemoryError
+        for i in visible:
+            drawn[i] = True
+
+        # Quads are kept in the order of the whole background, so that the
+        # transparent ones still blend the same with what is behind them.
+        self.nb_indices = 0
+        for quad in range(self.nb_quads):
+            if not drawn[self.quad_chunk[quad]]:
+                continue
+            vertex = self.quad_vertex[quad]
+            if is_legacy:
+                indices[0] = vertex
+                indices[1] = vertex + 1
+                indices[2] = vertex + 2
+                indices[3] = vertex + 3
+                indices += 4
+            elif use_primitive_restart:
+                indices[0] = vertex
+                indices[1] = vertex + 1
+                indices[2] = vertex + 3
+                indices[3] = vertex + 2
+                indices[4] = 0xFFFF
+                indices += 5
+            else:
+                indices[0] = vertex
+                indices[1] = vertex + 1
+                indices[2] = vertex + 3
+                indices[3] = vertex + 1
+                indices[4] = vertex + 2
+                indices[5] = vertex + 3
+                indices += 6
+        self.nb_indices = indices - self.indices
+        free(drawn)
+
+        if not is_legacy:
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.nb_indices * sizeof(GLushort), self.indices, GL_DYNAMIC_DRAW)
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+        self.drawn_chunks = visible
+
+
+    cdef long render_background(self, tuple visible) except -1:
+        """Draw the chunks in visible, return how many got uploaded again."""
+
+        cdef long i, start, end, nb_uploaded = 0
+
+        if not self.nb_quads:
+            return 0
+
         if use_debug_group:
             glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Background drawing")
 
-        if is_legacy:
-            glVertexPointer(3, GL_FLOAT, sizeof(Vertex), &self.vertex_buffer[0].x)
-            glTexCoordPointer(2, GL_FLOAT, sizeof(Vertex), &self.vertex_buffer[0].u)
-            glColorPointer(4, GL_UNSIGNED_BYTE, sizeof(Vertex), &self.vertex_buffer[0].r)
-        else:
-            if use_vao:
-                glBindVertexArray(self.vao)
-            else:
-                self.set_state()
+        # The legacy path draws straight from the vertices, which update()
+        # mustn’t change meanwhile.
+        with self.lock:
+            if not is_legacy:
+                glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+                for i in visible:
+                    if self.uploaded_versions[i] == self.chunk_versions[i]:
+                        continue
+                    start = self.chunk_start[i]
+                    end = self.chunk_start[i+1]
+                    glBufferSubData(GL_ARRAY_BUFFER, 4 * start * sizeof(Vertex),
+                                    4 * (end - start) * sizeof(Vertex),
+                                    &self.vertices[4 * start])
+                    self.uploaded_versions[i] = self.chunk_versions[i]
+                    nb_uploaded += 1
+                glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+            if visible != self.drawn_chunks:
+                self.build_indices(visible)
 
-        glEnable(GL_DEPTH_TEST)
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-        glBindTexture(GL_TEXTURE_2D, self.texture)
-        if is_legacy:
-            glDrawArrays(primitive_mode, 0, self.nb_vertices)
-        else:
-            glDrawElements(primitive_mode, self.nb_indices, GL_UNSIGNED_SHORT, NULL)
-        glDisable(GL_DEPTH_TEST)
+            if is_legacy:
+                glVertexPointer(3, GL_FLOAT, sizeof(Vertex), &self.vertices[0].x)
+                glTexCoordPointer(2, GL_FLOAT, sizeof(Vertex), &self.vertices[0].u)
+                glColorPointer(4, GL_UNSIGNED_BYTE, sizeof(Vertex), &self.vertices[0].r)
+            else:
+                if use_vao:
+                    glBindVertexArray(self.vao)
+                else:
+                    self.set_state()
+
+            glEnable(GL_DEPTH_TEST)
+            glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+            glBindTexture(GL_TEXTURE_2D, self.texture)
+            glDrawElements(primitive_mode, self.nb_indices, GL_UNSIGNED_SHORT,
+                           self.indices if is_legacy else NULL)
+            glDisable(GL_DEPTH_TEST)
 
         if not is_legacy:
             if use_vao:
@@ -106,73 +257,76 @@ cdef class BackgroundRenderer:
         if use_debug_group:
             glPopDebugGroup()
 
+        return nb_uploaded
 
-    cdef bint load(self, background, GLuint[MAX_TEXTURES] textures) except True:
-        cdef float ox, oy, oz, ox2, oy2, oz2
-        cdef GLsizei nb_vertices = 0, nb_indices = 0
-
-        vertex_buffer = <Vertex*> malloc(65536 * sizeof(Vertex))
-
-        if not is_legacy:
-            indices = <GLushort*> malloc(65536 * sizeof(GLushort))
-
-        for ox, oy, oz, model_id, model in background.object_instances:
-            for ox2, oy2, oz2, width_override, height_override, sprite in model:
-                #TODO: view frustum culling
-                data = get_sprite_rendering_data(sprite)
-                key = data.key
-
-                x1, x2, x3, x4, y1, y2, y3, y4, z1, z2, z3, z4 = data.pos[0], data.pos[1], data.pos[2], data.pos[3], data.pos[4], data.pos[5], data.pos[6], data.pos[7], data.pos[8], data.pos[9], data.pos[10], data.pos[11]
-                r, g, b, a = data.color[0], data.color[1], data.color[2], data.color[3]
-
-                # Pack data
-                vertex_buffer[nb_vertices] = Vertex(x1 + ox + ox2, y1 + oy + oy2, z1 + oz + oz2, data.left, data.bottom, r, g, b, a)
-                vertex_buffer[nb_vertices+1] = Vertex(x2 + ox + ox2, y2 + oy + oy2, z2 + oz + oz2, data.right, data.bottom, r, g, b, a)
-                vertex_buffer[nb_vertices+2] = Vertex(x3 + ox + ox2, y3 + oy + oy2, z3 + oz + oz2, data.right, data.top, r, g, b, a)
-                vertex_buffer[nb_vertices+3] = Vertex(x4 + ox + ox2, y4 + oy + oy2, z4 + oz + oz2, data.left, data.top, r, g, b, a)
-
-                if not is_legacy:
-                    # Add indices
-                    if use_primitive_restart:
-                        indices[nb_indices] = nb_vertices
-                        indices[nb_indices+1] = nb_vertices + 1
-                        indices[nb_indices+2] = nb_vertices + 3
-                        indices[nb_indices+3] = nb_vertices + 2
-                        indices[nb_indices+4] = 0xFFFF
-                    else:
-                        indices[nb_indices] = nb_vertices
-                        indices[nb_indices+1] = nb_vertices + 1
-                        indices[nb_indices+2] = nb_vertices + 3
-                        indices[nb_indices+3] = nb_vertices + 1
-                        indices[nb_indices+4] = nb_vertices + 2
-                        indices[nb_indices+5] = nb_vertices + 3
-
-                    nb_indices += 5 if use_primitive_restart else 6
-
-                nb_vertices += 4
 
+    cdef bint load(self, background, GLuint[MAX_TEXTURES] textures) except True:
+        cdef Sprite sprite
+        cdef long i, quad, key = 0
+
+        self.background = background
+        chunks = background.chunks
+        self.nb_chunks = len(chunks)
+        self.nb_quads = sum([len(chunk.quads) for chunk in chunks])
+        if self.nb_quads > MAX_QUADS:
+            logger.warning('This background has %d quads, only drawing the '
+                           'first %d.', self.nb_quads, MAX_QUADS)
+            self.nb_quads = MAX_QUADS
+        if not self.nb_quads:
+            return False
+
+        self.vertices = <Vertex*>malloc(4 * self.nb_quads * sizeof(Vertex))
+        self.indices = <GLushort*>malloc(6 * self.nb_quads * sizeof(GLushort))
+        self.quad_vertex = <long*>malloc(self.nb_quads * sizeof(long))
+        self.quad_chunk = <long*>malloc(self.nb_quads * sizeof(long))
+        self.chunk_start = <long*>malloc((self.nb_chunks + 1) * sizeof(long))
+        self.quad_sprite = <long*>malloc(self.nb_quads * sizeof(long))
+        self.packed_versions = <unsigned long*>calloc(self.nb_quads, sizeof(unsigned long))
+        self.chunk_versions = <unsigned long*>calloc(self.nb_chunks, sizeof(unsigned long))
+        self.uploaded_versions = <unsigned long*>calloc(self.nb_chunks, sizeof(unsigned long))
+        if (self.vertices == NULL or self.indices == NULL or
+                self.quad_vertex == NULL or self.quad_chunk == NULL or
+                self.chunk_start == NULL or self.quad_sprite == NULL or
+                self.packed_versions == NULL or self.chunk_versions == NULL or
+                self.uploaded_versions == NULL):
+            raise MemoryError
+
+        self.sprites = []
+        sprite_indices = {}
+        quad = 0
+        for i, chunk in enumerate(chunks):
+            self.chunk_start[i] = quad
+            for order, x, y, z, sprite in chunk.quads:
+                if order >= MAX_QUADS:
+                    continue
+                if id(sprite) not in sprite_indices:
+                    sprite_indices[id(sprite)] = len(self.sprites)
+                    self.sprites.append(sprite)
+                self.quad_sprite[quad] = sprite_indices[id(sprite)]
+                self.quad_vertex[order] = 4 * quad
+                self.quad_chunk[order] = i
+                self.pack_quad(quad, sprite, x, y, z)
+                key = get_sprite_rendering_data(sprite).key
+                quad += 1
+        self.chunk_start[self.nb_chunks] = quad
+
+        self.sprite_versions = <unsigned long*>calloc(len(self.sprites), sizeof(unsigned long))
+        if self.sprite_versions == NULL:
+            raise MemoryError
+
+        #TODO: handle backgrounds using more than one texture.
         self.texture = textures[key >> 1]
 
-        # We only need to keep the rendered vertices and indices in memory,
-        # either in RAM or in VRAM, they will never change until we implement
-        # background animation.
-
-        if is_legacy:
-            self.vertex_buffer = <Vertex*> realloc(vertex_buffer, nb_vertices * sizeof(Vertex))
-            self.nb_vertices = nb_vertices
-        else:
+        if not is_legacy:
             if use_debug_group:
                 glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Background uploading")
 
             glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-            glBufferData(GL_ARRAY_BUFFER, nb_vertices * sizeof(Vertex), vertex_buffer, GL_STATIC_DRAW)
+            glBufferData(GL_ARRAY_BUFFER, 4 * self.nb_quads * sizeof(Vertex), self.vertices, GL_DYNAMIC_DRAW)
             glBindBuffer(GL_ARRAY_BUFFER, 0)
 
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, nb_indices * sizeof(GLushort), indices, GL_STATIC_DRAW)
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
-
-            self.nb_indices = nb_indices
-
             if use_debug_group:
                 glPopDebugGroup()
+
+        logger.debug('Split %d background quads into %d chunks.',
+                     self.nb_quads, self.nb_chunks)
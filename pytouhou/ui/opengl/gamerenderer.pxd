@@ -1,10 +1,43 @@
+from pytouhou.lib.opengl cimport GLuint
 from pytouhou.utils.matrix cimport Matrix
 from pytouhou.game.game cimport Game
 from .background cimport BackgroundRenderer
-from .renderer cimport Renderer
+from .renderer cimport Renderer, QuadBuffer
 from .framebuffer cimport Framebuffer
 from .shader cimport Shader
 
+cdef enum:
+    LAYER_SPELLCARD
+    LAYER_ENEMIES
+    LAYER_EFFECTS
+    LAYER_PLAYERS
+    LAYER_BULLETS
+    LAYER_INTERFACE
+    NB_LAYERS
+
+cdef enum BackgroundMode:
+    CLEAR
+    SPELLCARD
+    BACKGROUND
+
+
+# Everything needed to render a frame, without having to look at the Game.
+cdef class Snapshot(QuadBuffer):
+    cdef public long frame, stage
+    cdef long layer_ends[NB_LAYERS]
+    cdef long nb_sources
+    cdef BackgroundMode background_mode
+    cdef float camera[6]
+    cdef tuple background_chunks
+    cdef unsigned char fog_r, fog_g, fog_b
+    cdef float fog_start, fog_end
+    cdef long game_x, game_y, game_width, game_height
+    cdef long interface_width, interface_height
+    cdef bint msg_box
+    cdef list texts
+    cdef tuple sprite_counters
+
+
 cdef class GameRenderer(Renderer):
     cdef Matrix *game_mvp
     cdef Matrix *interface_mvp
@@ -13,7 +46,18 @@ cdef class GameRenderer(Renderer):
     cdef Framebuffer framebuffer
     cdef BackgroundRenderer background_renderer
     cdef object background
+    cdef public tuple sprite_counters
+    cdef Snapshot last_snapshot
+
+    # Pixel buffers used to read the frames back without stalling.
+    cdef GLuint capture_pbos[2]
+    cdef long capture_index, capture_size
+    cdef bint capture_pending
 
-    cdef bint render_game(self, Game game) except True
-    cdef bint render_text(self, dict texts) except True
-    cdef bint render_interface(self, interface, game_boss) except True
+    cdef bint pack_game(self, Game game, Snapshot snapshot, set sources) except True
+    cdef bint pack_interface(self, interface, game_boss, Snapshot snapshot, set sources, bint full) except True
+    cdef bint render_layer(self, Snapshot snapshot, long layer) except True
+    cdef bint render_game(self, Snapshot snapshot) except True
+    cdef bint render_text(self, list texts) except True
+    cdef bint render_interface(self, Snapshot snapshot) except True
+    cdef bytes map_frame(self, GLuint pbo)
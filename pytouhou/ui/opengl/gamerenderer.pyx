@@ -22,21 +22,30 @@ from pytouhou.lib.opengl cimport \
           GL_FOG_COLOR, GL_COLOR_BUFFER_BIT, GLfloat, glViewport, glScissor,
           GL_SCISSOR_TEST, GL_DEPTH_BUFFER_BIT, glPushDebugGroup,
           GL_DEBUG_SOURCE_APPLICATION, glPopDebugGroup, glBindTexture,
-          glGetTexImage, GL_TEXTURE_2D, GL_RGB, GL_UNSIGNED_BYTE)
+          glGetTexImage, GL_TEXTURE_2D, GL_RGB, GL_UNSIGNED_BYTE, GLuint,
+          glGenBuffers, glDeleteBuffers, glBindBuffer, glBufferData,
+          glMapBuffer, glUnmapBuffer, GL_PIXEL_PACK_BUFFER, GL_STREAM_READ,
+          GL_READ_ONLY)
 
 from pytouhou.utils.matrix cimport mul, new_identity
 from pytouhou.utils.maths cimport perspective, setup_camera, ortho_2d
+from pytouhou.utils.frustum import FOVY, Z_NEAR, Z_FAR
 from pytouhou.game.text cimport NativeText, GlyphCollection
 from pytouhou.ui.window cimport Window
 from .shaders.eosd import GameShader, BackgroundShader
 from .renderer cimport Texture
-from .backend cimport is_legacy, use_debug_group, use_pack_invert, use_scaled_rendering
+from .sprite import pop_sprite_counters
+from .backend cimport is_legacy, use_debug_group, use_pack_invert, use_scaled_rendering, use_texture_atlas
 
 from collections import namedtuple
 Rect = namedtuple('Rect', 'x y w h')
 Color = namedtuple('Color', 'r g b a')
 
 
+cdef class Snapshot(QuadBuffer):
+    pass
+
+
 cdef class GameRenderer(Renderer):
     def __init__(self, resource_loader, Window window):
         Renderer.__init__(self, resource_loader)
@@ -57,6 +66,8 @@ cdef class GameRenderer(Renderer):
             free(self.interface_mvp)
         if self.proj != NULL:
             free(self.proj)
+        if self.capture_pbos[0]:
+            glDeleteBuffers(2, self.capture_pbos)
 
 
     property size:
@@ -79,8 +90,8 @@ cdef class GameRenderer(Renderer):
 
 
     def start(self, common):
-        self.proj = perspective(30, float(common.width) / float(common.height),
-                                101010101./2010101., 101010101./10101.)
+        self.proj = perspective(FOVY, float(common.width) / float(common.height),
+                                Z_NEAR, Z_FAR)
         self.game_mvp = setup_camera(0, 0, 1)
         mul(self.game_mvp, self.proj)
         self.interface_mvp = ortho_2d(0., float(common.interface.width),
@@ -88,40 +99,207 @@ cdef class GameRenderer(Renderer):
 
 
     def render(self, Game game):
+        if self.last_snapshot is None:
+            self.last_snapshot = Snapshot()
+        self.snapshot(game, self.last_snapshot)
+        self.render_snapshot(self.last_snapshot)
+
+
+    def new_snapshot(self):
+        return Snapshot()
+
+
+    def snapshot(self, Game game, Snapshot snapshot, bint full=False):
+        """Pack everything needed to render the current frame of game.
+
+        Only the CPU is used there, so that it can run on the simulation
+        thread while another one calls render_snapshot().  Unless full is
+        set, the interface only contains what changed since the previous
+        snapshot, so every snapshot has to be rendered.
+        """
+
+        sources = set() if use_texture_atlas else None
+
+        snapshot.frame = game.frame
+        snapshot.stage = game.stage
+        snapshot.nb_quads = 0
+        self.pack_game(game, snapshot, sources)
+        # Labels get their textures on the render thread, from a copy of
+        # their state so that the game can keep changing them meanwhile.
+        snapshot.texts = copy_texts(game.texts)
+        self.pack_interface(game.interface, game.boss, snapshot, sources, full)
+        snapshot.nb_sources = len(sources) if sources is not None else 0
+
+        # Sprites re-rendered, and which of their parts, during this frame.
+        snapshot.sprite_counters = pop_sprite_counters()
+
+
+    def render_snapshot(self, Snapshot snapshot):
         if use_scaled_rendering:
             self.framebuffer.bind()
 
-        self.render_game(game)
-        self.render_text(game.texts)
-        self.render_interface(game.interface, game.boss)
+        self.nb_groups = 0
+        self.render_game(snapshot)
+        self.render_text(snapshot.texts)
+        self.render_interface(snapshot)
+        self.nb_saved_groups = snapshot.nb_sources - self.nb_groups if use_texture_atlas else 0
 
         if use_scaled_rendering:
             self.framebuffer.render(self.x, self.y, self.width, self.height)
 
+        self.sprite_counters = snapshot.sprite_counters
+
 
-    def capture(self, filename, int width, int height):
-        capture_memory = <char*>malloc(width * height * 3)
+    def capture(self, int width, int height):
+        """Read the last frame back synchronously.
+
+        Return its RGB data, and whether its rows are stored bottom to top.
+        """
+
+        cdef char *capture_memory = <char*>malloc(width * height * 3)
 
         glBindTexture(GL_TEXTURE_2D, self.framebuffer.texture)
         glGetTexImage(GL_TEXTURE_2D, 0, GL_RGB, GL_UNSIGNED_BYTE, capture_memory)
         glBindTexture(GL_TEXTURE_2D, 0)
 
-        # TODO: output to PNG instead.
+        data = capture_memory[:width * height * 3]
+        free(capture_memory)
+        return data, not use_pack_invert
+
 
-        # PPM output, bottom to top.
-        with open(filename, 'wb') as ppm:
-            ppm.write(('P6\n%d %d\n 255\n' % (width, height)).encode())
-            if use_pack_invert:
-                ppm.write(capture_memory[:width * height * 3])
-            else:
-                for i in range(width * (height - 1), -1, -width):
-                    ppm.write(capture_memory[i * 3:(i + width) * 3])
+    def read_frame(self, int width, int height):
+        """Start reading the last frame back, and return the previous one.
+
+        The frame gets copied into one of two pixel buffers, and is only
+        mapped one frame later, once the GPU is done with it.  Return the same
+        tuple as capture(), or None if no frame was pending.
+        """
+
+        cdef long size = width * height * 3
+
+        if is_legacy:
+            # No pixel buffer objects there.
+            return self.capture(width, height)
+
+        if size != self.capture_size:
+            if not self.capture_pbos[0]:
+                glGenBuffers(2, self.capture_pbos)
+            for i in range(2):
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, self.capture_pbos[i])
+                glBufferData(GL_PIXEL_PACK_BUFFER, size, NULL, GL_STREAM_READ)
+            self.capture_size = size
+            self.capture_pending = False
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.capture_pbos[self.capture_index])
+        glBindTexture(GL_TEXTURE_2D, self.framebuffer.texture)
+        glGetTexImage(GL_TEXTURE_2D, 0, GL_RGB, GL_UNSIGNED_BYTE, NULL)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+        data = None
+        if self.capture_pending:
+            data = self.map_frame(self.capture_pbos[self.capture_index ^ 1])
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        self.capture_index ^= 1
+        self.capture_pending = True
+        return (data, not use_pack_invert) if data is not None else None
+
+
+    def flush_frame(self):
+        """Return the frame still pending in read_frame(), if any."""
+
+        if is_legacy or not self.capture_pending:
+            return None
+        data = self.map_frame(self.capture_pbos[self.capture_index ^ 1])
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.capture_pending = False
+        return (data, not use_pack_invert) if data is not None else None
+
+
+    cdef bytes map_frame(self, GLuint pbo):
+        cdef char *pixels
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        pixels = <char*>glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+        if pixels == NULL:
+            return None
+        data = pixels[:self.capture_size]
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        return data
+
+
+    cdef bint pack_game(self, Game game, Snapshot snapshot, set sources) except True:
+        snapshot.game_x, snapshot.game_y = game.interface.game_pos
+        snapshot.game_width = game.width
+        snapshot.game_height = game.height
+
+        if self.background_renderer is None:
+            snapshot.background_mode = CLEAR
+        elif game.spellcard_effect is not None:
+            snapshot.background_mode = SPELLCARD
+        else:
+            snapshot.background_mode = BACKGROUND
+            back = self.background
+            snapshot.camera[0], snapshot.camera[1], snapshot.camera[2] = back.position_interpolator.values
+            snapshot.camera[3], snapshot.camera[4], snapshot.camera[5] = back.position2_interpolator.values
+            snapshot.fog_b, snapshot.fog_g, snapshot.fog_r, snapshot.fog_start, snapshot.fog_end = back.fog_interpolator.values
+            snapshot.background_chunks = self.background_renderer.update(float(game.width) / float(game.height))
+
+        layers = ([game.spellcard_effect] if snapshot.background_mode == SPELLCARD else (),
+                  [enemy for enemy in game.enemies if enemy.visible],
+                  game.effects,
+                  chain(game.players_bullets, game.lasers_sprites(),
+                        game.players, game.msg_sprites()),
+                  chain(game.bullets, game.lasers, game.cancelled_bullets))
+        for i, elements in enumerate(layers):
+            snapshot.layer_ends[i] = self.pack_quads(snapshot, elements, sources)
+            # Particles come after every effect, not in spawn order.
+            if i == LAYER_EFFECTS:
+                snapshot.layer_ends[i] = self.pack_particles(snapshot, game.particles, sources)
+        self.pack_items(snapshot, game.items, sources)
+        snapshot.layer_ends[LAYER_BULLETS] = self.pack_quads(snapshot, game.labels, sources)
+
+        snapshot.msg_box = game.msg_runner is not None
+
+
+    cdef bint pack_interface(self, interface, game_boss, Snapshot snapshot, set sources, bint full) except True:
+        cdef GlyphCollection label
+
+        elements = []
+
+        snapshot.interface_width = interface.width
+        snapshot.interface_height = interface.height
+
+        if full:
+            items = interface.items
+        else:
+            items = [item for item in interface.items if item.anmrunner and item.anmrunner.running]
+        labels = interface.labels.values()
+
+        if items:
+            # Redraw all the interface
+            elements.extend(items)
+        else:
+            # Redraw only changed labels
+            labels = [label for label in labels if label.changed]
+
+        elements.extend(interface.level_start)
+
+        if game_boss is not None:
+            elements.extend(interface.boss_items)
+
+        elements.extend(labels)
+        snapshot.layer_ends[LAYER_INTERFACE] = self.pack_quads(snapshot, elements, sources)
+        for label in labels:
+            label.changed = False
 
-        # Cleanup.
-        free(capture_memory)
 
+    cdef bint render_layer(self, Snapshot snapshot, long layer) except True:
+        start = snapshot.layer_ends[layer - 1] if layer > 0 else 0
+        self.nb_groups += self.draw_quads(snapshot, start, snapshot.layer_ends[layer])
 
-    cdef bint render_game(self, Game game) except True:
+
+    cdef bint render_game(self, Snapshot snapshot) except True:
         cdef long game_x, game_y
         cdef float x, y, z, dx, dy, dz
         cdef float fog_data[4]
@@ -132,19 +310,19 @@ cdef class GameRenderer(Renderer):
         if use_debug_group:
             glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Game rendering")
 
-        game_x, game_y = game.interface.game_pos
-        glViewport(game_x, game_y, game.width, game.height)
+        game_x, game_y = snapshot.game_x, snapshot.game_y
+        glViewport(game_x, game_y, snapshot.game_width, snapshot.game_height)
         glClear(GL_DEPTH_BUFFER_BIT)
-        glScissor(game_x, game_y, game.width, game.height)
+        glScissor(game_x, game_y, snapshot.game_width, snapshot.game_height)
         glEnable(GL_SCISSOR_TEST)
 
         if is_legacy:
             glMatrixMode(GL_PROJECTION)
             glLoadIdentity()
 
-        if self.background_renderer is None:
+        if snapshot.background_mode == CLEAR:
             glClear(GL_COLOR_BUFFER_BIT)
-        elif game is not None and game.spellcard_effect is not None:
+        elif snapshot.background_mode == SPELLCARD:
             if is_legacy:
                 glMatrixMode(GL_MODELVIEW)
                 glLoadMatrixf(<GLfloat*>self.game_mvp)
@@ -153,21 +331,20 @@ cdef class GameRenderer(Renderer):
                 self.game_shader.bind()
                 self.game_shader.uniform_matrix('mvp', self.game_mvp)
 
-            self.render_elements([game.spellcard_effect])
+            self.render_layer(snapshot, LAYER_SPELLCARD)
         else:
-            back = self.background
-            x, y, z = back.position_interpolator.values
-            dx, dy, dz = back.position2_interpolator.values
-            fog_b, fog_g, fog_r, fog_start, fog_end = back.fog_interpolator.values
+            x, y, z = snapshot.camera[0], snapshot.camera[1], snapshot.camera[2]
+            dx, dy, dz = snapshot.camera[3], snapshot.camera[4], snapshot.camera[5]
+            fog_b, fog_g, fog_r = snapshot.fog_b, snapshot.fog_g, snapshot.fog_r
+            fog_start, fog_end = snapshot.fog_start, snapshot.fog_end
 
             # Those two lines may come from the difference between Direct3D and
             # OpenGL’s distance handling.  The first one seem to calculate fog
             # from the eye, while the second does that starting from the near
             # plane.
-            #TODO: investigate, and use a variable to keep the near plane
-            # distance at a single place.
-            fog_start -= 101010101./2010101.
-            fog_end -= 101010101./2010101.
+            #TODO: investigate.
+            fog_start -= Z_NEAR
+            fog_end -= Z_NEAR
 
             mvp = new_identity()
             mvp_data = <GLfloat*>mvp
@@ -202,28 +379,20 @@ cdef class GameRenderer(Renderer):
                 self.background_shader.uniform_4('fog_color', fog_r / 255., fog_g / 255., fog_b / 255., 1.)
 
             free(mvp)
-            self.background_renderer.render_background()
+            self.background_renderer.render_background(snapshot.background_chunks)
 
-        if game is not None:
-            if is_legacy:
-                glMatrixMode(GL_MODELVIEW)
-                glLoadMatrixf(<GLfloat*>self.game_mvp)
-                glDisable(GL_FOG)
-            else:
-                self.game_shader.bind()
-                self.game_shader.uniform_matrix('mvp', self.game_mvp)
+        if is_legacy:
+            glMatrixMode(GL_MODELVIEW)
+            glLoadMatrixf(<GLfloat*>self.game_mvp)
+            glDisable(GL_FOG)
+        else:
+            self.game_shader.bind()
+            self.game_shader.uniform_matrix('mvp', self.game_mvp)
+
+        for layer in range(LAYER_ENEMIES, LAYER_INTERFACE):
+            self.render_layer(snapshot, layer)
 
-            self.render_elements([enemy for enemy in game.enemies if enemy.visible])
-            self.render_elements(game.effects)
-            self.render_elements(chain(game.players_bullets,
-                                       game.lasers_sprites(),
-                                       game.players,
-                                       game.msg_sprites()))
-            self.render_elements(chain(game.bullets, game.lasers,
-                                       game.cancelled_bullets, game.items,
-                                       game.labels))
-
-        if game.msg_runner is not None:
+        if snapshot.msg_box:
             rect = Rect(48, 368, 288, 48)
             color1 = Color(0, 0, 0, 192)
             color2 = Color(0, 0, 0, 128)
@@ -235,34 +404,39 @@ cdef class GameRenderer(Renderer):
             glPopDebugGroup()
 
 
-    cdef bint render_text(self, dict texts) except True:
-        cdef NativeText label
-
+    cdef bint render_text(self, list texts) except True:
         if self.font_manager is None:
             return False
 
-        self.font_manager.load(texts)
+        textures = self.font_manager.load(texts)
 
         black = Color(0, 0, 0, 255)
 
-        for label in texts.values():
-            texture = (<Texture>label.texture).texture
-            rect = Rect(label.x, label.y, label.width, label.height)
-            gradient = [Color(*color, a=label.alpha) for color in label.gradient]
+        for string, x, y, align, alpha, shadow, colors in texts:
+            loaded = textures[string]
+            if loaded is None:
+                continue
+            texture, width, height = loaded
 
-            if label.shadow:
-                shadow_rect = Rect(label.x + 1, label.y + 1, label.width, label.height)
-                shadow = [black._replace(a=label.alpha)] * 4
-                self.render_quads([shadow_rect, rect], [shadow, gradient], texture)
+            if align == 'center':
+                x -= width // 2
+            elif align == 'right':
+                x -= width
             else:
-                self.render_quads([rect], [gradient], texture)
+                assert align == 'left'
 
+            rect = Rect(x, y, width, height)
+            gradient = [Color(*color, a=alpha) for color in colors]
 
-    cdef bint render_interface(self, interface, game_boss) except True:
-        cdef GlyphCollection label
+            if shadow:
+                shadow_rect = Rect(x + 1, y + 1, width, height)
+                shadow_colors = [black._replace(a=alpha)] * 4
+                self.render_quads([shadow_rect, rect], [shadow_colors, gradient], (<Texture>texture).texture)
+            else:
+                self.render_quads([rect], [gradient], (<Texture>texture).texture)
 
-        elements = []
 
+    cdef bint render_interface(self, Snapshot snapshot) except True:
         if use_debug_group:
             glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Interface rendering")
 
@@ -273,27 +447,19 @@ cdef class GameRenderer(Renderer):
         else:
             self.interface_shader.bind()
             self.interface_shader.uniform_matrix('mvp', self.interface_mvp)
-        glViewport(0, 0, interface.width, interface.height)
+        glViewport(0, 0, snapshot.interface_width, snapshot.interface_height)
 
-        items = [item for item in interface.items if item.anmrunner and item.anmrunner.running]
-        labels = interface.labels.values()
+        self.render_layer(snapshot, LAYER_INTERFACE)
 
-        if items:
-            # Redraw all the interface
-            elements.extend(items)
-        else:
-            # Redraw only changed labels
-            labels = [label for label in labels if label.changed]
+        if use_debug_group:
+            glPopDebugGroup()
 
-        elements.extend(interface.level_start)
 
-        if game_boss is not None:
-            elements.extend(interface.boss_items)
+cdef list copy_texts(dict texts):
+    """Return the state of every text needed to render it, as tuples."""
 
-        elements.extend(labels)
-        self.render_elements(elements)
-        for label in labels:
-            label.changed = False
+    cdef NativeText label
 
-        if use_debug_group:
-            glPopDebugGroup()
+    return [(label.text, label.x, label.y, label.align, label.alpha,
+             label.shadow, tuple(label.gradient))
+            for label in texts.values()]
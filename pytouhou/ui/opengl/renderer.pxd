@@ -1,7 +1,9 @@
-from cpython cimport PyObject
 from pytouhou.lib.opengl cimport GLuint
 from .texture cimport TextureManager, FontManager
 from .framebuffer cimport Framebuffer
+from .sprite cimport RenderingData
+from pytouhou.game.particle cimport ParticleSystem
+from pytouhou.game.item cimport ItemSystem
 
 cdef struct Vertex:
     short x, y, z, padding
@@ -19,28 +21,62 @@ cdef class Texture:
     cdef long key
     cdef GLuint texture
     cdef GLuint *pointer
-    cdef unsigned short indices[2][65536]
 
     #XXX: keep a reference so that when __dealloc__ is called self.pointer is still valid.
     cdef Renderer renderer
 
 
+# Quads ready to be drawn, in growable arenas reused from frame to frame.
+cdef class QuadBuffer:
+    cdef Vertex *vertices
+    cdef long *keys
+    cdef size_t vertices_capacity, keys_capacity
+    cdef long nb_quads
+
+    cdef bint reserve(self, long nb_quads) except True
+
+
 cdef class Renderer:
     cdef TextureManager texture_manager
     cdef FontManager font_manager
-    cdef Vertex vertex_buffer[MAX_ELEMENTS]
     cdef long x, y, width, height
 
+    cdef QuadBuffer quads
+    cdef unsigned short *index_buffer
+    cdef size_t index_capacity
+
+    # Rendering data of every particle animation or item sprite, while
+    # packing them.
+    cdef RenderingData **particle_data
+    cdef size_t particle_data_capacity
+
+    # Half-height of every item sprite, under which it gets replaced by its
+    # indicator.
+    cdef double *item_heights
+    cdef size_t item_heights_capacity
+
     # For modern GL.
     cdef GLuint vbo, text_vbo
     cdef GLuint vao, text_vao
 
     cdef GLuint textures[MAX_TEXTURES]
-    cdef unsigned short *indices[MAX_TEXTURES][2]
-    cdef unsigned short last_indices[2 * MAX_TEXTURES]
-    cdef PyObject *elements[640*3]
+
+    # Number of indices for each key in the current batch, and where they
+    # end in index_buffer.
+    cdef long key_counts[2 * MAX_TEXTURES]
+    cdef long key_ends[2 * MAX_TEXTURES]
+
+    # Draw calls issued for the last elements, and how many more it would
+    # have taken without texture atlases.
+    cdef public long nb_groups, nb_saved_groups
 
     cdef void set_state(self) nogil
     cdef void set_text_state(self) nogil
+    cdef long pack_quads(self, QuadBuffer buffer, elements, set sources) except -1
+    cdef long pack_particles(self, QuadBuffer buffer, ParticleSystem particles, set sources) except -1
+    cdef long pack_items(self, QuadBuffer buffer, ItemSystem items, set sources) except -1
+    cdef bint pack_indices(self, long *keys, long nb_quads) except True
+    cdef long draw_batch(self, Vertex *vertices, long nb_vertices) except -1
+    cdef long draw_quads(self, QuadBuffer buffer, long start, long end) except -1
     cdef bint render_elements(self, elements) except True
     cdef bint render_quads(self, rects, colors, GLuint texture) except True
@@ -12,7 +12,7 @@
 ## GNU General Public License for more details.
 ##
 
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, free, realloc
 from libc.string cimport memset
 from os.path import join
 
@@ -30,14 +30,25 @@ from pytouhou.lib.opengl cimport \
 from pytouhou.lib.sdl import SDLError
 
 from pytouhou.game.element cimport Element
-from .sprite cimport get_sprite_rendering_data
-from .backend cimport primitive_mode, is_legacy, use_debug_group, use_vao, use_primitive_restart
-
+from pytouhou.game.effect cimport Effect
+from pytouhou.game.particle cimport ParticleSystem
+from pytouhou.game.item cimport ItemSystem
+from pytouhou.game.itemtype cimport ItemType
+from pytouhou.game.sprite cimport Sprite
+from .sprite cimport RenderingData, get_sprite_rendering_data
+from .backend cimport primitive_mode, is_legacy, use_debug_group, use_vao, use_primitive_restart, use_texture_atlas
+
+from pytouhou.utils.atlas import AtlasBuilder
 from pytouhou.utils.helpers import get_logger
 
 logger = get_logger(__name__)
 
 
+# Keep 0xFFFF free for primitive restart, and whole quads in a batch.
+cdef enum:
+    MAX_BATCH_VERTICES = 65532
+
+
 cdef class Texture:
     def __cinit__(self, GLuint texture, Renderer renderer):
         self.texture = texture
@@ -52,8 +63,6 @@ cdef class Texture:
         self.key = key
         self.pointer = &renderer.textures[key]
         self.pointer[0] = texture
-        for i in range(2):
-            renderer.indices[key][i] = self.indices[i]
 
         #XXX: keep a reference so that when __dealloc__ is called self.pointer is still valid.
         self.renderer = renderer
@@ -63,29 +72,52 @@ cdef class Texture:
             glDeleteTextures(1, &self.texture)
         if self.pointer != NULL:
             self.pointer[0] = 0
-        # The dangling pointers in renderer.indices doesn’t matter, since we
-        # won’t use them if no texture is loaded in that slot.
-
-
-cdef long find_objects(Renderer self, object elements) except -1:
-    # Don’t type element as Element, or else the overriding of objects won’t work.
-    cdef Element obj
-    cdef long i = 0
-    for element in elements:
-        for obj in element.objects:
-            sprite = obj.sprite
-            if sprite and sprite.visible:
-                # warning: no reference is preserved on the object—assuming the object will not die accidentally
-                self.elements[i] = <PyObject*>obj
-                i += 1
-                if i >= 640*3-4:
-                    return i
-    return i
+
+
+cdef bint grow(void **buffer, size_t *capacity, size_t needed, size_t item_size) except True:
+    """Make sure buffer can hold needed items, at least doubling its size."""
+    if needed <= capacity[0]:
+        return False
+    new_capacity = max(needed, 2 * capacity[0], 256)
+    new_buffer = realloc(buffer[0], new_capacity * item_size)
+    if new_buffer == NULL:
+        raise MemoryError()
+    buffer[0] = new_buffer
+    capacity[0] = new_capacity
+
+
+cdef void pack_quad(Vertex *rec, RenderingData *data, short ox, short oy):
+    """Write the four vertices of the sprite rendered as data at ox, oy."""
+    cdef short x1, x2, x3, x4, y1, y2, y3, y4, z1, z2, z3, z4
+    cdef unsigned char r, g, b, a
+
+    x1, x2, x3, x4, y1, y2, y3, y4, z1, z2, z3, z4 = <short>data.pos[0], <short>data.pos[1], <short>data.pos[2], <short>data.pos[3], <short>data.pos[4], <short>data.pos[5], <short>data.pos[6], <short>data.pos[7], <short>data.pos[8], <short>data.pos[9], <short>data.pos[10], <short>data.pos[11]
+    r, g, b, a = data.color[0], data.color[1], data.color[2], data.color[3]
+    rec[0] = Vertex(x1 + ox, y1 + oy, z1, 0, data.left, data.bottom, r, g, b, a)
+    rec[1] = Vertex(x2 + ox, y2 + oy, z2, 0, data.right, data.bottom, r, g, b, a)
+    rec[2] = Vertex(x4 + ox, y4 + oy, z4, 0, data.left, data.top, r, g, b, a)
+    rec[3] = Vertex(x3 + ox, y3 + oy, z3, 0, data.right, data.top, r, g, b, a)
+
+
+cdef class QuadBuffer:
+    def __dealloc__(self):
+        free(self.vertices)
+        free(self.keys)
+
+
+    cdef bint reserve(self, long nb_quads) except True:
+        grow(<void**>&self.vertices, &self.vertices_capacity, 4 * nb_quads, sizeof(Vertex))
+        grow(<void**>&self.keys, &self.keys_capacity, nb_quads, sizeof(long))
 
 
 cdef class Renderer:
     def __dealloc__(self):
-        if not is_legacy:
+        free(self.index_buffer)
+        free(self.particle_data)
+        free(self.item_heights)
+
+        # Nothing got created on the GPU when __init__() wasn’t called.
+        if not is_legacy and self.vbo:
             glDeleteBuffers(1, &self.vbo)
 
             if use_vao:
@@ -94,6 +126,11 @@ cdef class Renderer:
 
 
     def __init__(self, resource_loader):
+        self.quads = QuadBuffer()
+
+        if use_texture_atlas and resource_loader.atlas is None:
+            resource_loader.atlas = AtlasBuilder()
+
         self.texture_manager = TextureManager(resource_loader, self, Texture)
         font_name = join(resource_loader.game_dir, 'font.ttf')
         try:
@@ -150,71 +187,198 @@ cdef class Renderer:
         glBindBuffer(GL_ARRAY_BUFFER, 0)
 
 
-    cdef bint render_elements(self, elements) except True:
-        cdef Element element
+    cdef long pack_quads(self, QuadBuffer buffer, elements, set sources) except -1:
+        """Append the quads of the visible objects of elements to buffer.
 
-        nb_elements = find_objects(self, elements)
-        if not nb_elements:
-            return False
+        The vertices are computed there, so that nothing but drawing is left.
+        Return the number of quads in buffer.
+        """
 
-        nb_vertices = 0
-        memset(self.last_indices, 0, sizeof(self.last_indices))
+        # Don’t type element as Element, or else the overriding of objects won’t work.
+        cdef Element obj
+        cdef RenderingData *data
+        cdef long i = buffer.nb_quads
+        cdef object last_anm = None
+        cdef long last_blend = -1
 
-        for element_idx in range(nb_elements):
-            element = <object>self.elements[element_idx]
-            ox, oy = <short>element.x, <short>element.y
-            data = get_sprite_rendering_data(element.sprite)
-            key = data.key
+        for element in elements:
+            for obj in element.objects:
+                sprite = obj.sprite
+                if not sprite or not sprite.visible:
+                    continue
 
-            blendfunc = key & 1
-            texture = key >> 1
+                buffer.reserve(i + 1)
+                data = get_sprite_rendering_data(sprite)
+                buffer.keys[i] = data.key
+
+                # Consecutive quads nearly always come from the same anm, so
+                # only touch the set when the source changes.
+                if sources is not None and (sprite.anm is not last_anm or data.key & 1 != last_blend):
+                    last_anm, last_blend = sprite.anm, data.key & 1
+                    sources.add((id(last_anm), last_blend))
+
+                pack_quad(&buffer.vertices[4 * i], data, <short>obj.x, <short>obj.y)
+                i += 1
+
+        buffer.nb_quads = i
+        return i
+
+
+    cdef long pack_particles(self, QuadBuffer buffer, ParticleSystem particles, set sources) except -1:
+        """Append the quads of the visible particles to buffer.
+
+        The sprite of each animation only gets looked at once, all of its
+        particles then being packed straight from their positions.  Return
+        the number of quads in buffer.
+        """
+
+        cdef Effect animation
+        cdef Sprite sprite
+        cdef RenderingData *data
+        cdef long i, nb_quads = buffer.nb_quads
+        cdef double *positions = particles.positions
+
+        grow(<void**>&self.particle_data, &self.particle_data_capacity,
+             len(particles.animations), sizeof(RenderingData*))
+        for i, animation in enumerate(particles.animations):
+            sprite = animation.sprite
+            if sprite is None or not sprite.visible:
+                self.particle_data[i] = NULL
+                continue
+            data = get_sprite_rendering_data(sprite)
+            self.particle_data[i] = data
+            if sources is not None:
+                sources.add((id(sprite.anm), data.key & 1))
+
+        buffer.reserve(nb_quads + particles.nb_particles)
+        for i in range(particles.nb_particles):
+            data = self.particle_data[particles.animation_ids[i]]
+            if data == NULL:
+                continue
+            buffer.keys[nb_quads] = data.key
+            pack_quad(&buffer.vertices[4 * nb_quads], data,
+                      <short>positions[2*i], <short>positions[2*i+1])
+            nb_quads += 1
+
+        buffer.nb_quads = nb_quads
+        return nb_quads
+
+
+    cdef long pack_items(self, QuadBuffer buffer, ItemSystem items, set sources) except -1:
+        """Append the quads of the items to buffer, or of their indicator
+        for those above the screen.
+
+        Like for particles, the sprites of each item type only get looked at
+        once.  Return the number of quads in buffer.
+        """
+
+        cdef ItemType item_type
+        cdef Sprite sprite
+        cdef RenderingData *data
+        cdef long i, j, nb_quads = buffer.nb_quads
+        cdef double x, y
+        cdef double *positions = items.positions
+        cdef double *heights
+
+        if not items.nb_items:
+            return nb_quads
+
+        # The sprite of type j is at 2*j, and its indicator at 2*j+1.
+        grow(<void**>&self.particle_data, &self.particle_data_capacity,
+             2 * len(items.item_types), sizeof(RenderingData*))
+        grow(<void**>&self.item_heights, &self.item_heights_capacity,
+             2 * len(items.item_types), sizeof(double))
+        heights = self.item_heights
+        for j, item_type in enumerate(items.item_types):
+            for i, sprite in enumerate((item_type.sprite, item_type.indicator_sprite)):
+                if sprite is None or not sprite.visible:
+                    self.particle_data[2*j+i] = NULL
+                else:
+                    data = get_sprite_rendering_data(sprite)
+                    self.particle_data[2*j+i] = data
+                    if sources is not None:
+                        sources.add((id(sprite.anm), data.key & 1))
+                heights[2*j+i] = sprite._texcoords[3] / 2. if sprite is not None else 0.
+
+        buffer.reserve(nb_quads + items.nb_items)
+        for i in range(items.nb_items):
+            j = 2 * items.types[i]
+            x, y = positions[2*i], positions[2*i+1]
+            if items.frames[i] and y < -heights[j]:
+                j += 1
+                y = heights[j]
+            data = self.particle_data[j]
+            if data == NULL:
+                continue
+            buffer.keys[nb_quads] = data.key
+            pack_quad(&buffer.vertices[4 * nb_quads], data, <short>x, <short>y)
+            nb_quads += 1
 
-            rec = self.indices[texture][blendfunc]
-            next_indice = self.last_indices[key]
+        buffer.nb_quads = nb_quads
+        return nb_quads
 
-            # Pack data in buffer
-            x1, x2, x3, x4, y1, y2, y3, y4, z1, z2, z3, z4 = <short>data.pos[0], <short>data.pos[1], <short>data.pos[2], <short>data.pos[3], <short>data.pos[4], <short>data.pos[5], <short>data.pos[6], <short>data.pos[7], <short>data.pos[8], <short>data.pos[9], <short>data.pos[10], <short>data.pos[11]
-            r, g, b, a = data.color[0], data.color[1], data.color[2], data.color[3]
-            self.vertex_buffer[nb_vertices] = Vertex(x1 + ox, y1 + oy, z1, 0, data.left, data.bottom, r, g, b, a)
-            self.vertex_buffer[nb_vertices+1] = Vertex(x2 + ox, y2 + oy, z2, 0, data.right, data.bottom, r, g, b, a)
-            self.vertex_buffer[nb_vertices+2] = Vertex(x4 + ox, y4 + oy, z4, 0, data.left, data.top, r, g, b, a)
-            self.vertex_buffer[nb_vertices+3] = Vertex(x3 + ox, y3 + oy, z3, 0, data.right, data.top, r, g, b, a)
 
-            # Add indices
+    cdef bint pack_indices(self, long *keys, long nb_quads) except True:
+        """Fill the index arena for nb_quads quads, sorted by key.
+
+        Each key gets drawn in a single call; key_counts and key_ends tell
+        where its indices are.
+        """
+
+        cdef long nb_vertices, key, i, end_indice
+        cdef unsigned short *rec
+
+        per_quad = 4 if is_legacy else 5 if use_primitive_restart else 6
+
+        grow(<void**>&self.index_buffer, &self.index_capacity, per_quad * nb_quads, sizeof(unsigned short))
+        memset(self.key_counts, 0, sizeof(self.key_counts))
+
+        # First pass: how many indices each key will need.
+        for i in range(nb_quads):
+            self.key_counts[keys[i]] += per_quad
+
+        # Each key gets a contiguous range of the index arena.
+        end_indice = 0
+        for key in range(2 * MAX_TEXTURES):
+            self.key_ends[key] = end_indice
+            end_indice += self.key_counts[key]
+
+        # Second pass: indices.
+        for i in range(nb_quads):
+            key = keys[i]
+            rec = &self.index_buffer[self.key_ends[key]]
+            nb_vertices = 4 * i
             if is_legacy:
-                rec[next_indice] = nb_vertices
-                rec[next_indice+1] = nb_vertices + 1
-                rec[next_indice+2] = nb_vertices + 3
-                rec[next_indice+3] = nb_vertices + 2
-                self.last_indices[key] += 4
+                rec[0] = nb_vertices
+                rec[1] = nb_vertices + 1
+                rec[2] = nb_vertices + 3
+                rec[3] = nb_vertices + 2
             elif use_primitive_restart:
-                rec[next_indice] = nb_vertices
-                rec[next_indice+1] = nb_vertices + 1
-                rec[next_indice+2] = nb_vertices + 2
-                rec[next_indice+3] = nb_vertices + 3
-                rec[next_indice+4] = 0xFFFF
-                self.last_indices[key] += 5
+                rec[0] = nb_vertices
+                rec[1] = nb_vertices + 1
+                rec[2] = nb_vertices + 2
+                rec[3] = nb_vertices + 3
+                rec[4] = 0xFFFF
             else:
-                rec[next_indice] = nb_vertices
-                rec[next_indice+1] = nb_vertices + 1
-                rec[next_indice+2] = nb_vertices + 2
-                rec[next_indice+3] = nb_vertices + 1
-                rec[next_indice+4] = nb_vertices + 2
-                rec[next_indice+5] = nb_vertices + 3
-                self.last_indices[key] += 6
+                rec[0] = nb_vertices
+                rec[1] = nb_vertices + 1
+                rec[2] = nb_vertices + 2
+                rec[3] = nb_vertices + 1
+                rec[4] = nb_vertices + 2
+                rec[5] = nb_vertices + 3
+            self.key_ends[key] += per_quad
 
-            nb_vertices += 4
 
-        if use_debug_group:
-            glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Elements drawing")
+    cdef long draw_batch(self, Vertex *vertices, long nb_vertices) except -1:
+        """Draw vertices with what pack_indices put in the index arena, return the number of draw calls."""
 
         if is_legacy:
-            glVertexPointer(3, GL_SHORT, sizeof(Vertex), &self.vertex_buffer[0].x)
-            glTexCoordPointer(2, GL_FLOAT, sizeof(Vertex), &self.vertex_buffer[0].u)
-            glColorPointer(4, GL_UNSIGNED_BYTE, sizeof(Vertex), &self.vertex_buffer[0].r)
+            glVertexPointer(3, GL_SHORT, sizeof(Vertex), &vertices[0].x)
+            glTexCoordPointer(2, GL_FLOAT, sizeof(Vertex), &vertices[0].u)
+            glColorPointer(4, GL_UNSIGNED_BYTE, sizeof(Vertex), &vertices[0].r)
         else:
             glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-            glBufferData(GL_ARRAY_BUFFER, nb_vertices * sizeof(Vertex), &self.vertex_buffer[0], GL_DYNAMIC_DRAW)
+            glBufferData(GL_ARRAY_BUFFER, nb_vertices * sizeof(Vertex), vertices, GL_DYNAMIC_DRAW)
             glBindBuffer(GL_ARRAY_BUFFER, 0)
 
             if use_vao:
@@ -225,11 +389,13 @@ cdef class Renderer:
         # Don’t change the state when it’s not needed.
         previous_blendfunc = -1
         previous_texture = -1
+        nb_groups = 0
 
         for key in range(2 * MAX_TEXTURES):
-            nb_indices = self.last_indices[key]
+            nb_indices = self.key_counts[key]
             if not nb_indices:
                 continue
+            nb_groups += 1
 
             blendfunc = key & 1
             texture = key >> 1
@@ -238,11 +404,31 @@ cdef class Renderer:
                 glBlendFunc(GL_SRC_ALPHA, (GL_ONE_MINUS_SRC_ALPHA, GL_ONE)[blendfunc])
             if texture != previous_texture:
                 glBindTexture(GL_TEXTURE_2D, self.textures[texture])
-            glDrawElements(primitive_mode, nb_indices, GL_UNSIGNED_SHORT, self.indices[texture][blendfunc])
+            glDrawElements(primitive_mode, nb_indices, GL_UNSIGNED_SHORT, &self.index_buffer[self.key_ends[key] - nb_indices])
 
             previous_blendfunc = blendfunc
             previous_texture = texture
 
+        return nb_groups
+
+
+    cdef long draw_quads(self, QuadBuffer buffer, long start, long end) except -1:
+        """Draw the quads of buffer from start to end, return the number of draw calls."""
+
+        if start >= end:
+            return 0
+
+        if use_debug_group:
+            glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Elements drawing")
+
+        # Indices are 16-bit, so huge scenes get split in several batches.
+        nb_groups = 0
+        while start < end:
+            batch_end = min(end, start + MAX_BATCH_VERTICES // 4)
+            self.pack_indices(&buffer.keys[start], batch_end - start)
+            nb_groups += self.draw_batch(&buffer.vertices[4 * start], 4 * (batch_end - start))
+            start = batch_end
+
         glBindTexture(GL_TEXTURE_2D, 0)
 
         if not is_legacy and use_vao:
@@ -251,6 +437,55 @@ cdef class Renderer:
         if use_debug_group:
             glPopDebugGroup()
 
+        return nb_groups
+
+
+    def pack_scene(self, elements):
+        """Pack elements, then their indices batch by batch, like
+        render_elements() would, but without drawing anything.
+
+        Return the number of quads, their vertices as (x, y, z, key) tuples,
+        and the indices of every batch.  No GL call is made, so this works
+        without a context, on a Renderer made with Renderer.__new__().
+        """
+
+        cdef QuadBuffer buffer = QuadBuffer()
+        cdef Vertex *vertex
+        cdef long i, start, end, nb_quads
+
+        nb_quads = self.pack_quads(buffer, elements, None)
+
+        vertices = []
+        for i in range(4 * nb_quads):
+            vertex = &buffer.vertices[i]
+            vertices.append((vertex.x, vertex.y, vertex.z, buffer.keys[i // 4]))
+
+        batches = []
+        for start in range(0, nb_quads, MAX_BATCH_VERTICES // 4):
+            end = min(nb_quads, start + MAX_BATCH_VERTICES // 4)
+            self.pack_indices(&buffer.keys[start], end - start)
+            batches.append([self.index_buffer[i] for i in range(self.key_ends[2 * MAX_TEXTURES - 1])])
+
+        return nb_quads, vertices, batches
+
+
+    cdef bint render_elements(self, elements) except True:
+        # Only track the textures as they were before being packed if there
+        # is something to compare to.
+        sources = set() if use_texture_atlas else None
+
+        # Don’t report the draw calls of the previous elements when there
+        # is nothing to draw.
+        self.nb_groups = self.nb_saved_groups = 0
+
+        self.quads.nb_quads = 0
+        nb_quads = self.pack_quads(self.quads, elements, sources)
+        if not nb_quads:
+            return False
+
+        self.nb_groups = self.draw_quads(self.quads, 0, nb_quads)
+        self.nb_saved_groups = len(sources) - self.nb_groups if sources is not None else 0
+
 
     cdef bint render_quads(self, rects, colors, GLuint texture) except True:
         # There is nothing that batch more than two quads on the same texture, currently.
@@ -18,6 +18,7 @@ from libc.string cimport memcpy
 from libc.math cimport M_PI as pi
 
 from pytouhou.utils.matrix cimport Matrix, scale2d, flip, rotate_x, rotate_y, rotate_z, translate, translate2d
+from pytouhou.game.sprite cimport DIRTY_TRANSFORM, DIRTY_TEXCOORDS, DIRTY_COLOR, DIRTY_ALL
 from .renderer cimport Texture #XXX
 
 
@@ -27,15 +28,28 @@ default = Matrix(-.5,   .5,   .5,  -.5,
                  0,    0,    0,    0,
                  1,    1,    1,    1)
 
+# How many sprites got (partially) re-rendered since the last call to
+# pop_sprite_counters().
+cdef long nb_rendered = 0, nb_transforms = 0, nb_texcoords = 0, nb_colors = 0
+
+
+def pop_sprite_counters():
+    '''Return and reset the numbers of re-rendered sprites, transforms,
+    texcoords and colors.'''
+    global nb_rendered, nb_transforms, nb_texcoords, nb_colors
+    counters = (nb_rendered, nb_transforms, nb_texcoords, nb_colors)
+    nb_rendered = nb_transforms = nb_texcoords = nb_colors = 0
+    return counters
+
 
 cdef RenderingData* get_sprite_rendering_data(Sprite sprite) nogil:
-    if sprite.changed:
+    if sprite.dirty:
         render_sprite(sprite)
     return <RenderingData*>sprite._rendering_data
 
 
 def get_sprite_vertices(Sprite sprite):
-    if sprite.changed:
+    if sprite.dirty:
         render_sprite(sprite)
     data = <RenderingData*>sprite._rendering_data
     return [(data.pos[0], data.pos[1], data.pos[2]),
@@ -45,52 +59,65 @@ def get_sprite_vertices(Sprite sprite):
 
 
 cdef void render_sprite(Sprite sprite) nogil:
+    global nb_rendered, nb_transforms, nb_texcoords, nb_colors
     cdef Matrix vertmat
+    cdef unsigned char dirty = sprite.dirty
 
     if sprite._rendering_data == NULL:
         sprite._rendering_data = malloc(sizeof(RenderingData))
+        dirty = DIRTY_ALL
 
     data = <RenderingData*>sprite._rendering_data
-    memcpy(&vertmat, &default, sizeof(Matrix))
+    nb_rendered += 1
 
     tx, ty, tw, th = sprite._texcoords[0], sprite._texcoords[1], sprite._texcoords[2], sprite._texcoords[3]
-    sx, sy = sprite._rescale[0], sprite._rescale[1]
-    width = sprite.width_override or (tw * sx)
-    height = sprite.height_override or (th * sy)
-
-    scale2d(&vertmat, width, height)
-    if sprite.mirrored:
-        flip(&vertmat)
-
-    rx, ry, rz = sprite._rotations_3d[0], sprite._rotations_3d[1], sprite._rotations_3d[2]
-    if sprite.automatic_orientation:
-        rz += pi/2. - sprite.angle
-    elif sprite.force_rotation:
-        rz += sprite.angle
-
-    if rx:
-        rotate_x(&vertmat, -rx)
-    if ry:
-        rotate_y(&vertmat, ry)
-    if rz:
-        rotate_z(&vertmat, -rz) #TODO: minus, really?
-    if sprite.allow_dest_offset:
-        translate(&vertmat, sprite._dest_offset)
-    if sprite.corner_relative_placement: # Reposition
-        translate2d(&vertmat, width / 2, height / 2)
-
-    memcpy(data.pos, &vertmat, 12 * sizeof(float))
-
-    x_1 = sprite.anm.size_inv[0]
-    y_1 = sprite.anm.size_inv[1]
-    tox, toy = sprite._texoffsets[0], sprite._texoffsets[1]
-    data.left = tx * x_1 + tox
-    data.right = (tx + tw) * x_1 + tox
-    data.bottom = ty * y_1 + toy
-    data.top = (ty + th) * y_1 + toy
-
-    for i in range(4):
-        data.color[i] = sprite._color[i]
 
+    if dirty & DIRTY_TRANSFORM:
+        nb_transforms += 1
+        memcpy(&vertmat, &default, sizeof(Matrix))
+
+        sx, sy = sprite._rescale[0], sprite._rescale[1]
+        width = sprite.width_override or (tw * sx)
+        height = sprite.height_override or (th * sy)
+
+        scale2d(&vertmat, width, height)
+        if sprite.mirrored:
+            flip(&vertmat)
+
+        rx, ry, rz = sprite._rotations_3d[0], sprite._rotations_3d[1], sprite._rotations_3d[2]
+        if sprite.automatic_orientation:
+            rz += pi/2. - sprite.angle
+        elif sprite.force_rotation:
+            rz += sprite.angle
+
+        if rx:
+            rotate_x(&vertmat, -rx)
+        if ry:
+            rotate_y(&vertmat, ry)
+        if rz:
+            rotate_z(&vertmat, -rz) #TODO: minus, really?
+        if sprite.allow_dest_offset:
+            translate(&vertmat, sprite._dest_offset)
+        if sprite.corner_relative_placement: # Reposition
+            translate2d(&vertmat, width / 2, height / 2)
+
+        memcpy(data.pos, &vertmat, 12 * sizeof(float))
+
+    if dirty & DIRTY_TEXCOORDS:
+        nb_texcoords += 1
+        x_1 = sprite.anm.size_inv[0]
+        y_1 = sprite.anm.size_inv[1]
+        tox, toy = sprite._texoffsets[0], sprite._texoffsets[1]
+        data.left = tx * x_1 + tox
+        data.right = (tx + tw) * x_1 + tox
+        data.bottom = ty * y_1 + toy
+        data.top = (ty + th) * y_1 + toy
+
+    if dirty & DIRTY_COLOR:
+        nb_colors += 1
+        for i in range(4):
+            data.color[i] = sprite._color[i]
+
+    # Both the texture and the blendfunc can change.
     data.key = ((<Texture>sprite.anm.texture).key << 1) | sprite.blendfunc
-    sprite.changed = False
+    sprite.dirty = 0
@@ -8,5 +8,6 @@ cdef class TextureManager:
 cdef class FontManager:
     cdef Font font
     cdef object renderer, texture_class
+    cdef dict textures
 
-    cdef bint load(self, dict labels) except True
+    cdef dict load(self, list texts)
@@ -19,15 +19,13 @@ from pytouhou.lib.opengl cimport \
           glGenTextures, glBindTexture, glTexImage2D, GL_TEXTURE_2D, GLuint,
           glPushDebugGroup, GL_DEBUG_SOURCE_APPLICATION, glPopDebugGroup)
 
-from pytouhou.lib.sdl cimport load_png, create_rgb_surface
 from pytouhou.lib.sdl import SDLError
 from pytouhou.formats.thtx import Texture #TODO: perhaps define that elsewhere?
-from pytouhou.game.text cimport NativeText
+from pytouhou.utils.atlas import AtlasPage
+from pytouhou.ui.images cimport decode_png, compose_page
 
 from .backend cimport use_debug_group
 
-import os
-
 from pytouhou.utils.helpers import get_logger
 logger = get_logger(__name__)
 
@@ -43,11 +41,22 @@ cdef class TextureManager:
         if use_debug_group:
             glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Texture loading")
 
+        # Nothing can be added anymore to the pages we are about to upload.
+        if self.loader.atlas is not None:
+            self.loader.atlas.seal()
+
         for anm in sorted(anms.values(), key=is_ascii):
             if use_debug_group:
                 glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Loading textures from ANM")
 
             for entry in anm:
+                if isinstance(entry.texture, AtlasPage):
+                    page = entry.texture
+                    if page.texture is None:
+                        texture = compose_page(self.loader, page)
+                        page.texture = self.texture_class(load_texture(texture), self.renderer)
+                    entry.texture = page.texture
+                    continue
                 if entry.texture is None:
                     texture = decode_png(self.loader, entry.first_name, entry.secondary_name)
                 elif not isinstance(entry.texture, self.texture_class):
@@ -73,56 +82,43 @@ cdef class FontManager:
         self.texture_class = texture_class
 
 
-    cdef bint load(self, dict labels) except True:
-        cdef NativeText label
-
-        if use_debug_group:
-            glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Text rendering")
+    cdef dict load(self, list texts):
+        """Return the texture, width and height of each string of texts.
 
-        for i, label in labels.items():
-            if label.texture is None:
-                try:
-                    surface = self.font.render(label.text)
-                except SDLError as e:
-                    logger.error(u'Rendering of label “%s” failed: %s', label.text, e)
-                    del labels[i]  # Prevents it from retrying to render.
-                    continue
+        texts is a list of the text states copied in a snapshot, whose first
+        item is the string.  Strings rendered for the previous call are
+        reused, the others get dropped.
+        """
 
-                label.width, label.height = surface.surface.w, surface.surface.h
+        cdef dict textures = {}
 
-                if label.align == 'center':
-                    label.x -= label.width // 2
-                elif label.align == 'right':
-                    label.x -= label.width
-                else:
-                    assert label.align == 'left'
+        if use_debug_group:
+            glPushDebugGroup(GL_DEBUG_SOURCE_APPLICATION, 0, -1, "Text rendering")
 
-                texture = Texture(label.width, label.height, -4, surface.pixels)
-                label.texture = self.texture_class(load_texture(texture), self.renderer)
+        for text in texts:
+            string = text[0]
+            if string in textures:
+                continue
+            if self.textures is not None and string in self.textures:
+                textures[string] = self.textures[string]
+                continue
+            try:
+                surface = self.font.render(string)
+            except SDLError as e:
+                logger.error(u'Rendering of label “%s” failed: %s', string, e)
+                textures[string] = None  # Prevents it from retrying to render.
+                continue
+
+            width, height = surface.surface.w, surface.surface.h
+            texture = Texture(width, height, -4, surface.pixels)
+            textures[string] = (self.texture_class(load_texture(texture), self.renderer),
+                                width, height)
 
         if use_debug_group:
             glPopDebugGroup()
 
-
-cdef decode_png(loader, first_name, secondary_name):
-    image_file = load_png(loader.get_file(os.path.basename(first_name)))
-    width, height = image_file.surface.w, image_file.surface.h
-
-    # Support only 32 bits RGBA. Paletted surfaces are awful to work with.
-    #TODO: verify it doesn’t blow up on big-endian systems.
-    new_image = create_rgb_surface(width, height, 32, 0x000000ff, 0x0000ff00, 0x00ff0000, 0xff000000)
-    new_image.blit(image_file)
-
-    if secondary_name:
-        alpha_file = load_png(loader.get_file(os.path.basename(secondary_name)))
-        assert (width == alpha_file.surface.w and height == alpha_file.surface.h)
-
-        new_alpha_file = create_rgb_surface(width, height, 24)
-        new_alpha_file.blit(alpha_file)
-
-        new_image.set_alpha(new_alpha_file)
-
-    return Texture(width, height, -4, new_image.pixels)
+        self.textures = textures
+        return textures
 
 
 cdef GLuint load_texture(thtx) except? 65535:
@@ -0,0 +1,137 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+"""Writing of captured frames, away from the render thread.
+
+The renderer only reads the frames back, and pushes the raw RGB data to a
+FrameWriter, which compresses it to PNG files, or feeds it to an external
+encoder, in its own thread.
+"""
+
+import os
+import shlex
+import zlib
+from queue import Queue
+from struct import pack
+from subprocess import Popen, PIPE
+from threading import Thread
+from time import perf_counter
+
+from pytouhou.utils.helpers import get_logger
+
+logger = get_logger(__name__)
+
+
+def iter_rows(width, height, data, bottom_up=False):
+    """Yield the rows of a RGB frame, from top to bottom."""
+
+    stride = width * 3
+    if bottom_up:
+        for i in range(height - 1, -1, -1):
+            yield data[i*stride:(i+1)*stride]
+    else:
+        for i in range(height):
+            yield data[i*stride:(i+1)*stride]
+
+
+def png_chunk(tag, data):
+    return (pack('>I', len(data)) + tag + data +
+            pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+
+def encode_png(width, height, data, bottom_up=False, level=1):
+    """Encode a RGB frame as a PNG image."""
+
+    # Each row starts with its filter type, none here.
+    raw = b''.join(b'\0' + row for row in iter_rows(width, height, data, bottom_up))
+    return b''.join((b'\x89PNG\r\n\x1a\n',
+                     png_chunk(b'IHDR', pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+                     png_chunk(b'IDAT', zlib.compress(raw, level)),
+                     png_chunk(b'IEND', b'')))
+
+
+
+class FrameWriter:
+    """Write frames in a background thread.
+
+    Frames are either written as PNG files, named after pattern, or piped as
+    raw RGB24 to command, whose arguments can use {width} and {height}.  At
+    most max_pending frames can be waiting to be written, push() blocks
+    when the writer falls further behind.
+    """
+
+    def __init__(self, width, height, pattern='screenshot/frame%06d.png',
+                 command=None, max_pending=8):
+        self.width = width
+        self.height = height
+        self.pattern = pattern
+        self.queue = Queue(max_pending)
+        self.nb_frames = 0
+        self.stall_time = 0.
+
+        self.process = None
+        if command is not None:
+            args = [arg.format(width=width, height=height)
+                    for arg in shlex.split(command)]
+            self.process = Popen(args, stdin=PIPE)
+        else:
+            directory = os.path.dirname(pattern)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        self.thread = Thread(target=self._run, name='frame writer', daemon=True)
+        self.thread.start()
+
+
+    def push(self, frame, data, bottom_up=False):
+        """Queue a frame, waiting if too many of them are pending."""
+
+        if self.queue.full():
+            start = perf_counter()
+            self.queue.put((frame, data, bottom_up))
+            self.stall_time += perf_counter() - start
+        else:
+            self.queue.put((frame, data, bottom_up))
+
+
+    def close(self):
+        """Write every pending frame, then stop the thread."""
+
+        self.queue.put(None)
+        self.thread.join()
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+        if self.nb_frames:
+            logger.info('Wrote %d frames, the game waited %.1f ms for the writer.',
+                        self.nb_frames, self.stall_time * 1000)
+
+
+    def _run(self):
+        width, height = self.width, self.height
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame, data, bottom_up = item
+            try:
+                if self.process is not None:
+                    self.process.stdin.write(b''.join(iter_rows(width, height, data, bottom_up)))
+                else:
+                    with open(self.pattern % frame, 'wb') as file:
+                        file.write(encode_png(width, height, data, bottom_up))
+            except (IOError, OSError):
+                logger.exception('Failed to write frame %d:', frame)
+            else:
+                self.nb_frames += 1
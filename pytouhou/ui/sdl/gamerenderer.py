@@ -61,14 +61,17 @@ class GameRenderer:
             self.window.win.render_clear()
 
             self.render_elements([enemy for enemy in game.enemies if enemy.visible])
+            # Particles come after every effect, not in spawn order.
             self.render_elements(game.effects)
+            self.render_particles(game.particles)
             self.render_elements(chain(game.players_bullets,
                                        game.lasers_sprites(),
                                        game.players,
                                        game.msg_sprites()))
             self.render_elements(chain(game.bullets, game.lasers,
-                                       game.cancelled_bullets, game.items,
-                                       game.labels))
+                                       game.cancelled_bullets))
+            self.render_items(game.items)
+            self.render_elements(game.labels)
 
 
     def render_interface(self, interface, boss):
@@ -109,31 +112,43 @@ class GameRenderer:
 
             sprite = element.sprite
             if sprite and sprite.visible:
-                ox, oy = element.x, element.y
-                data = get_sprite_rendering_data(sprite)
+                self.render_sprite(sprite, element.x, element.y)
+                nb_vertices += 4
 
-                #XXX
-                texture_width = 256
-                texture_height = 256
 
-                source = Rect(data.left * texture_width,
-                              data.bottom * texture_height,
-                              (data.right - data.left) * texture_width,
-                              (data.top - data.bottom) * texture_height)
+    def render_particles(self, particles):
+        for sprite, x, y in particles.get_sprites():
+            self.render_sprite(sprite, x, y)
 
-                dest = Rect(ox + data.x, oy + data.y, data.width, data.height)
 
-                texture = sprite.anm.texture
-                texture.set_color_mod(data.r, data.g, data.b)
-                texture.set_alpha_mod(data.a)
-                texture.set_blend_mode(2 if data.blendfunc else 1)
+    def render_items(self, items):
+        for sprite, x, y in items.get_sprites():
+            self.render_sprite(sprite, x, y)
 
-                if data.rotation or data.flip:
-                    self.window.win.render_copy_ex(texture, source, dest, data.rotation, data.flip)
-                else:
-                    self.window.win.render_copy(texture, source, dest)
 
-                nb_vertices += 4
+    def render_sprite(self, sprite, ox, oy):
+        data = get_sprite_rendering_data(sprite)
+
+        #XXX
+        texture_width = 256
+        texture_height = 256
+
+        source = Rect(data.left * texture_width,
+                      data.bottom * texture_height,
+                      (data.right - data.left) * texture_width,
+                      (data.top - data.bottom) * texture_height)
+
+        dest = Rect(ox + data.x, oy + data.y, data.width, data.height)
+
+        texture = sprite.anm.texture
+        texture.set_color_mod(data.r, data.g, data.b)
+        texture.set_alpha_mod(data.a)
+        texture.set_blend_mode(2 if data.blendfunc else 1)
+
+        if data.rotation or data.flip:
+            self.window.win.render_copy_ex(texture, source, dest, data.rotation, data.flip)
+        else:
+            self.window.win.render_copy(texture, source, dest)
 
 
     def render_text(self, texts):
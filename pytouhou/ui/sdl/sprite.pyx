@@ -18,7 +18,7 @@ from libc.math cimport M_PI as pi
 
 
 cdef RenderingData* get_sprite_rendering_data(Sprite sprite) nogil:
-    if sprite.changed:
+    if sprite.dirty:
         render_sprite(sprite)
     return <RenderingData*>sprite._rendering_data
 
@@ -70,4 +70,4 @@ cdef void render_sprite(Sprite sprite) nogil:
     data.rotation = -rz * 180 / pi
     data.flip = sprite.mirrored
 
-    sprite.changed = False
+    sprite.dirty = 0
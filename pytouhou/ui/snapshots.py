@@ -0,0 +1,163 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+"""Hand-over of render snapshots between the simulation and render threads.
+
+The simulation thread packs every frame into a snapshot taken from a small
+ring, and publishes it.  The render thread only ever draws the most recent
+one, so the simulation never waits for rendering: snapshots it didn’t get
+to draw in time are recycled, and counted as dropped.
+
+When every frame has to be drawn, to record them, the ring is lossless
+instead: the render thread takes the snapshots in order, and the simulation
+waits for a free one.
+"""
+
+from collections import deque
+from math import sqrt
+from threading import Condition
+from time import perf_counter
+
+
+def interval_stats(times):
+    """Return the mean and standard deviation of the intervals between times,
+    in seconds."""
+
+    intervals = [b - a for a, b in zip(times, list(times)[1:])]
+    if not intervals:
+        return 0., 0.
+    mean = sum(intervals) / len(intervals)
+    variance = sum((i - mean) ** 2 for i in intervals) / len(intervals)
+    return mean, sqrt(variance)
+
+
+
+class SnapshotRing:
+    """A ring of size snapshots, created by calling factory.
+
+    Instance variables:
+    nb_published -- number of snapshots published by the simulation
+    nb_rendered -- number of snapshots taken by the render thread
+    nb_dropped -- number of snapshots which got recycled without being taken
+    """
+
+    def __init__(self, factory, size=3, history=120, lossless=False):
+        # One being written, one being drawn, and one ready in between.
+        assert size >= 3
+        self.lossless = lossless
+        self.closed = False
+        self.free = [factory() for i in range(size)]
+        self.ready = deque()
+        self.condition = Condition()
+        self.nb_published = 0
+        self.nb_rendered = 0
+        self.nb_dropped = 0
+        self.publish_times = deque(maxlen=history)
+        self.take_times = deque(maxlen=history)
+
+
+    def acquire(self):
+        """Return a snapshot to write into, never blocking unless lossless.
+
+        When the render thread lags behind, this is the oldest published
+        snapshot it hasn’t taken yet.  A lossless ring waits for a snapshot
+        to be released instead, and returns None once closed.
+        """
+
+        with self.condition:
+            while self.lossless and not self.free and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            if self.free:
+                return self.free.pop()
+            self.nb_dropped += 1
+            return self.ready.popleft()
+
+
+    def publish(self, snapshot):
+        with self.condition:
+            self.ready.append(snapshot)
+            self.nb_published += 1
+            self.publish_times.append(perf_counter())
+            self.condition.notify_all()
+
+
+    def take(self, timeout=None):
+        """Return the most recent published snapshot, or the oldest one if
+        lossless, or None if none got published within timeout seconds.
+
+        The snapshot has to be given back with release() once drawn.
+        """
+
+        with self.condition:
+            if not self.ready and timeout != 0:
+                self.condition.wait(timeout)
+            if not self.ready:
+                return None
+            if self.lossless:
+                snapshot = self.ready.popleft()
+                self.nb_rendered += 1
+                self.take_times.append(perf_counter())
+                return snapshot
+            snapshot = self.ready.pop()
+            while self.ready:
+                self.free.append(self.ready.popleft())
+                self.nb_dropped += 1
+            self.nb_rendered += 1
+            self.take_times.append(perf_counter())
+            return snapshot
+
+
+    def release(self, snapshot):
+        with self.condition:
+            self.free.append(snapshot)
+            self.condition.notify_all()
+
+
+    def close(self):
+        """Wake up a simulation waiting in acquire(), for it to stop."""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+    def flush(self):
+        """Recycle the snapshots published but not taken, and reopen the
+        ring."""
+
+        with self.condition:
+            self.free.extend(self.ready)
+            self.ready.clear()
+            self.closed = False
+
+
+    def get_stats(self):
+        """Return a dict describing how regular both threads were lately.
+
+        Frame times and jitters (their standard deviation) are in
+        milliseconds.
+        """
+
+        with self.condition:
+            sim_time, sim_jitter = interval_stats(self.publish_times)
+            render_time, render_jitter = interval_stats(self.take_times)
+            return {'published': self.nb_published,
+                    'rendered': self.nb_rendered,
+                    'dropped': self.nb_dropped,
+                    'sim_frame_time': sim_time * 1000,
+                    'sim_jitter': sim_jitter * 1000,
+                    'render_frame_time': render_time * 1000,
+                    'render_jitter': render_jitter * 1000}
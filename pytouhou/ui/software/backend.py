@@ -0,0 +1,34 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+import os
+
+
+GameRenderer = None
+
+
+def init(_):
+    global GameRenderer
+
+    # Nothing gets displayed, SDL is only used for its events, fonts and
+    # image loading, so it doesn’t need any display to work.
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+    from pytouhou.ui.software.gamerenderer import GameRenderer
+
+
+def create_window(title, x, y, width, height, _):
+    # Frames only live in memory, the Window will render them without
+    # presenting them.
+    return None
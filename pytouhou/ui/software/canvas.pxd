@@ -0,0 +1,41 @@
+from pytouhou.utils.matrix cimport Matrix
+from .texture cimport Image
+
+cdef struct Vertex:
+    float x, y, z
+    float u, v
+    unsigned char r, g, b, a
+
+# A vertex in clip space, before the division by w.
+cdef struct ClipVertex:
+    float x, y, z, w
+    float u, v
+    float r, g, b, a
+
+# A vertex once projected, with its attributes divided by w.
+cdef struct Fragment:
+    float x, y, z
+    float inv_w, u_w, v_w, depth_w
+    float r, g, b, a
+
+cdef class Canvas:
+    cdef unsigned char *pixels  # RGBA, top to bottom.
+    cdef float *depth
+    cdef long width, height
+
+    # Both in pixels, with the origin at the top-left.
+    cdef long view_x, view_y, view_width, view_height
+    cdef long clip_x1, clip_y1, clip_x2, clip_y2
+
+    cdef Matrix mvp
+    cdef bint depth_test, fog
+    cdef float fog_scale, fog_end
+    cdef float fog_color[3]
+
+    cdef void set_viewport(self, long x, long y, long width, long height) nogil
+    cdef void set_clip(self, long x, long y, long width, long height) nogil
+    cdef void set_fog(self, float start, float end, unsigned char r, unsigned char g, unsigned char b) nogil
+    cdef void clear(self) nogil
+    cdef void clear_depth(self) nogil
+    cdef void draw_quad(self, Vertex *vertices, Image *image, long blendfunc) nogil
+    cdef void draw_triangle(self, Fragment *a, Fragment *b, Fragment *c, Image *image, long blendfunc) nogil
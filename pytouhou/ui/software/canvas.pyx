@@ -0,0 +1,333 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+"""A tiny rasterizer, following what the OpenGL backend asks of the GPU.
+
+Quads are projected with the same matrices, split into two triangles, and
+filled with nearest texture sampling, modulated by their vertex colors, then
+blended either with (SRC_ALPHA, ONE_MINUS_SRC_ALPHA) or (SRC_ALPHA, ONE).
+The background also gets a depth test and the linear fog of its shader.
+
+Everything is done in software, and is deterministic, so that frames can be
+compared pixel for pixel between runs.
+"""
+
+cimport cython
+from libc.stdlib cimport malloc, free
+from libc.math cimport floor, ceil
+
+
+cdef class Canvas:
+    def __cinit__(self, long width, long height):
+        self.width = width
+        self.height = height
+        self.pixels = <unsigned char*>malloc(width * height * 4)
+        self.depth = <float*>malloc(width * height * sizeof(float))
+        if self.pixels == NULL or self.depth == NULL:
+            raise MemoryError
+        self.set_viewport(0, 0, width, height)
+        self.set_clip(0, 0, width, height)
+        self.clear()
+        self.clear_depth()
+
+
+    def __dealloc__(self):
+        free(self.pixels)
+        free(self.depth)
+
+
+    def read(self, bint alpha=False):
+        """Return the pixels, as RGB or RGBA, from top to bottom."""
+
+        cdef long nb_pixels = self.width * self.height
+        cdef unsigned char *rgb
+
+        if alpha:
+            return self.pixels[:nb_pixels * 4]
+
+        rgb = <unsigned char*>malloc(nb_pixels * 3)
+        if rgb == NULL:
+            raise MemoryError
+        for i in range(nb_pixels):
+            rgb[3*i] = self.pixels[4*i]
+            rgb[3*i+1] = self.pixels[4*i+1]
+            rgb[3*i+2] = self.pixels[4*i+2]
+        data = rgb[:nb_pixels * 3]
+        free(rgb)
+        return data
+
+
+    def compare(self, bytes reference, long tolerance=0):
+        """Compare the pixels with a RGB reference frame, as returned by read().
+
+        Return the number of pixels with a channel differing by more than
+        tolerance, and the biggest difference found.
+        """
+
+        cdef const unsigned char *ref = reference
+        cdef long nb_pixels = self.width * self.height
+        cdef long nb_different = 0, max_delta = 0, delta, pixel_delta
+
+        if len(reference) != nb_pixels * 3:
+            raise ValueError('Reference frame of %d bytes, expected %d.' % (len(reference), nb_pixels * 3))
+
+        for i in range(nb_pixels):
+            pixel_delta = 0
+            for j in range(3):
+                delta = <long>self.pixels[4*i+j] - <long>ref[3*i+j]
+                if delta < 0:
+                    delta = -delta
+                if delta > pixel_delta:
+                    pixel_delta = delta
+            if pixel_delta > tolerance:
+                nb_different += 1
+            if pixel_delta > max_delta:
+                max_delta = pixel_delta
+        return nb_different, max_delta
+
+
+    cdef void set_viewport(self, long x, long y, long width, long height) nogil:
+        # Same arguments as glViewport, with the origin at the bottom-left.
+        self.view_x = x
+        self.view_y = self.height - (y + height)
+        self.view_width = width
+        self.view_height = height
+
+
+    cdef void set_clip(self, long x, long y, long width, long height) nogil:
+        # Same arguments as glScissor.
+        self.clip_x1 = max(x, 0)
+        self.clip_y1 = max(self.height - (y + height), 0)
+        self.clip_x2 = min(x + width, self.width)
+        self.clip_y2 = min(self.height - y, self.height)
+
+
+    @cython.cdivision(True)
+    cdef void set_fog(self, float start, float end, unsigned char r, unsigned char g, unsigned char b) nogil:
+        self.fog_scale = 1. / (end - start)
+        self.fog_end = end
+        self.fog_color[0] = r
+        self.fog_color[1] = g
+        self.fog_color[2] = b
+
+
+    cdef void clear(self) nogil:
+        cdef long x, y, i
+
+        for y in range(self.clip_y1, self.clip_y2):
+            for x in range(self.clip_x1, self.clip_x2):
+                i = 4 * (y * self.width + x)
+                self.pixels[i] = self.pixels[i+1] = self.pixels[i+2] = 0
+                self.pixels[i+3] = 255
+
+
+    cdef void clear_depth(self) nogil:
+        cdef long i
+
+        for i in range(self.width * self.height):
+            self.depth[i] = 1.
+
+
+    @cython.cdivision(True)
+    cdef void draw_quad(self, Vertex *vertices, Image *image, long blendfunc) nogil:
+        # Clipping a quad by a plane leaves at most five vertices.
+        cdef ClipVertex clipped[4]
+        cdef ClipVertex polygon[5]
+        cdef Fragment fragments[5]
+        cdef float *m = <float*>&self.mvp
+        cdef float start_distance, end_distance, t
+        cdef long i, nb_vertices = 0
+        cdef Vertex *vertex
+        cdef ClipVertex *clip
+        cdef ClipVertex *start
+        cdef ClipVertex *end
+        cdef Fragment *fragment
+
+        for i in range(4):
+            vertex = &vertices[i]
+            clip = &clipped[i]
+            clip.x = vertex.x * m[0] + vertex.y * m[4] + vertex.z * m[8] + m[12]
+            clip.y = vertex.x * m[1] + vertex.y * m[5] + vertex.z * m[9] + m[13]
+            clip.z = vertex.x * m[2] + vertex.y * m[6] + vertex.z * m[10] + m[14]
+            clip.w = vertex.x * m[3] + vertex.y * m[7] + vertex.z * m[11] + m[15]
+            clip.u = vertex.u
+            clip.v = vertex.v
+            clip.r = vertex.r
+            clip.g = vertex.g
+            clip.b = vertex.b
+            clip.a = vertex.a
+
+        # Cut the quad along the near plane, z = -w, like the GPU does, so
+        # that the background quads crossing it don’t disappear.  A quad
+        # entirely in front of it keeps its four vertices, in order.
+        for i in range(4):
+            start = &clipped[i]
+            end = &clipped[(i + 1) % 4]
+            start_distance = start.z + start.w
+            end_distance = end.z + end.w
+            if start_distance >= 0:
+                polygon[nb_vertices] = start[0]
+                nb_vertices += 1
+            if (start_distance >= 0) != (end_distance >= 0):
+                # Every attribute is interpolated linearly in clip space.
+                t = start_distance / (start_distance - end_distance)
+                clip = &polygon[nb_vertices]
+                clip.x = start.x + t * (end.x - start.x)
+                clip.y = start.y + t * (end.y - start.y)
+                clip.z = start.z + t * (end.z - start.z)
+                clip.w = start.w + t * (end.w - start.w)
+                clip.u = start.u + t * (end.u - start.u)
+                clip.v = start.v + t * (end.v - start.v)
+                clip.r = start.r + t * (end.r - start.r)
+                clip.g = start.g + t * (end.g - start.g)
+                clip.b = start.b + t * (end.b - start.b)
+                clip.a = start.a + t * (end.a - start.a)
+                nb_vertices += 1
+
+        if nb_vertices < 3:
+            return
+
+        for i in range(nb_vertices):
+            clip = &polygon[i]
+
+            # Only a degenerate matrix can still put a vertex there.
+            if clip.w < 1e-6:
+                return
+
+            fragment = &fragments[i]
+            fragment.inv_w = 1. / clip.w
+            fragment.x = self.view_x + (clip.x * fragment.inv_w + 1.) * .5 * self.view_width
+            fragment.y = self.view_y + (1. - clip.y * fragment.inv_w) * .5 * self.view_height
+            fragment.z = clip.z * fragment.inv_w
+            fragment.u_w = clip.u * fragment.inv_w
+            fragment.v_w = clip.v * fragment.inv_w
+            # What the background shader gets as gl_FragCoord.z / gl_FragCoord.w.
+            fragment.depth_w = (clip.z + clip.w) * .5 * fragment.inv_w
+            fragment.r = clip.r
+            fragment.g = clip.g
+            fragment.b = clip.b
+            fragment.a = clip.a
+
+        for i in range(1, nb_vertices - 1):
+            self.draw_triangle(&fragments[0], &fragments[i], &fragments[i+1], image, blendfunc)
+
+
+    @cython.cdivision(True)
+    @cython.boundscheck(False)
+    cdef void draw_triangle(self, Fragment *a, Fragment *b, Fragment *c, Image *image, long blendfunc) nogil:
+        cdef Fragment *swap
+        cdef float area, px, py, w0, w1, w2, inv_w, u, v, depth, fog_density
+        cdef float r, g, b_, alpha, tr, tg, tb, ta
+        cdef long x, y, x1, y1, x2, y2, tx, ty, i, t
+        cdef bint tl0, tl1, tl2
+
+        area = (b.x - a.x) * (c.y - a.y) - (b.y - a.y) * (c.x - a.x)
+        if area == 0:
+            return
+        if area < 0:
+            swap = b
+            b = c
+            c = swap
+            area = -area
+
+        x1 = max(<long>floor(min(a.x, b.x, c.x)), self.clip_x1)
+        y1 = max(<long>floor(min(a.y, b.y, c.y)), self.clip_y1)
+        x2 = min(<long>ceil(max(a.x, b.x, c.x)), self.clip_x2)
+        y2 = min(<long>ceil(max(a.y, b.y, c.y)), self.clip_y2)
+
+        # Top-left fill rule, so that the two triangles of a quad don’t
+        # both blend the pixels of their shared edge.
+        tl0 = (c.y == b.y and c.x > b.x) or c.y < b.y
+        tl1 = (a.y == c.y and a.x > c.x) or a.y < c.y
+        tl2 = (b.y == a.y and b.x > a.x) or b.y < a.y
+
+        for y in range(y1, y2):
+            py = y + .5
+            for x in range(x1, x2):
+                px = x + .5
+
+                w0 = (c.x - b.x) * (py - b.y) - (c.y - b.y) * (px - b.x)
+                if w0 < 0 or (w0 == 0 and not tl0):
+                    continue
+                w1 = (a.x - c.x) * (py - c.y) - (a.y - c.y) * (px - c.x)
+                if w1 < 0 or (w1 == 0 and not tl1):
+                    continue
+                w2 = (b.x - a.x) * (py - a.y) - (b.y - a.y) * (px - a.x)
+                if w2 < 0 or (w2 == 0 and not tl2):
+                    continue
+
+                w0 /= area
+                w1 /= area
+                w2 /= area
+
+                i = y * self.width + x
+                if self.depth_test:
+                    depth = w0 * a.z + w1 * b.z + w2 * c.z
+                    if depth >= self.depth[i]:
+                        continue
+
+                # Colors are interpolated without perspective correction,
+                # they are constant on every quad but the text gradients.
+                r = w0 * a.r + w1 * b.r + w2 * c.r
+                g = w0 * a.g + w1 * b.g + w2 * c.g
+                b_ = w0 * a.b + w1 * b.b + w2 * c.b
+                alpha = w0 * a.a + w1 * b.a + w2 * c.a
+
+                inv_w = 1. / (w0 * a.inv_w + w1 * b.inv_w + w2 * c.inv_w)
+
+                if image != NULL:
+                    u = (w0 * a.u_w + w1 * b.u_w + w2 * c.u_w) * inv_w
+                    v = (w0 * a.v_w + w1 * b.v_w + w2 * c.v_w) * inv_w
+
+                    # Textures repeat, like with GL_REPEAT.
+                    tx = (<long>floor(u * image.width)) % image.width
+                    ty = (<long>floor(v * image.height)) % image.height
+                    if tx < 0:
+                        tx += image.width
+                    if ty < 0:
+                        ty += image.height
+                    t = 4 * (ty * image.width + tx)
+                    tr = image.pixels[t]
+                    tg = image.pixels[t+1]
+                    tb = image.pixels[t+2]
+                    ta = image.pixels[t+3]
+                    r = r * tr / 255.
+                    g = g * tg / 255.
+                    b_ = b_ * tb / 255.
+                    alpha = alpha * ta / 255.
+
+                if alpha <= 0:
+                    continue
+
+                if self.fog:
+                    depth = (w0 * a.depth_w + w1 * b.depth_w + w2 * c.depth_w) * inv_w
+                    fog_density = (self.fog_end - depth) * self.fog_scale
+                    fog_density = min(max(fog_density, 0.), 1.)
+                    r = self.fog_color[0] + (r - self.fog_color[0]) * fog_density
+                    g = self.fog_color[1] + (g - self.fog_color[1]) * fog_density
+                    b_ = self.fog_color[2] + (b_ - self.fog_color[2]) * fog_density
+
+                if self.depth_test:
+                    self.depth[i] = w0 * a.z + w1 * b.z + w2 * c.z
+
+                alpha /= 255.
+                i *= 4
+                if blendfunc:
+                    self.pixels[i] = <unsigned char>min(self.pixels[i] + r * alpha + .5, 255.)
+                    self.pixels[i+1] = <unsigned char>min(self.pixels[i+1] + g * alpha + .5, 255.)
+                    self.pixels[i+2] = <unsigned char>min(self.pixels[i+2] + b_ * alpha + .5, 255.)
+                else:
+                    self.pixels[i] = <unsigned char>(self.pixels[i] + (r - self.pixels[i]) * alpha + .5)
+                    self.pixels[i+1] = <unsigned char>(self.pixels[i+1] + (g - self.pixels[i+1]) * alpha + .5)
+                    self.pixels[i+2] = <unsigned char>(self.pixels[i+2] + (b_ - self.pixels[i+2]) * alpha + .5)
@@ -0,0 +1,32 @@
+from pytouhou.utils.matrix cimport Matrix
+from pytouhou.game.game cimport Game
+from pytouhou.game.particle cimport ParticleSystem
+from pytouhou.game.item cimport ItemSystem
+from pytouhou.game.sprite cimport Sprite
+from .canvas cimport Canvas, Vertex
+from .texture cimport Texture, TextureManager, FontManager
+
+cdef class GameRenderer:
+    cdef Canvas canvas
+    cdef TextureManager texture_manager
+    cdef FontManager font_manager
+    cdef Matrix *game_mvp
+    cdef Matrix *interface_mvp
+    cdef Matrix *proj
+    cdef long x, y, width, height
+
+    # The background never changes once loaded, so its quads are kept.
+    cdef object background
+    cdef Vertex *background_vertices
+    cdef long nb_background_vertices
+    cdef Texture background_texture
+
+    cdef bint render_game(self, Game game) except True
+    cdef bint render_background(self) except True
+    cdef bint render_text(self, dict texts) except True
+    cdef bint render_interface(self, interface, game_boss) except True
+    cdef bint render_elements(self, elements) except True
+    cdef bint render_particles(self, ParticleSystem particles) except True
+    cdef bint render_items(self, ItemSystem items) except True
+    cdef bint render_sprite(self, Sprite sprite, float ox, float oy) except True
+    cdef bint render_quad(self, rect, colors, Texture texture) except True
@@ -0,0 +1,328 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+from libc.stdlib cimport malloc, free
+from itertools import chain
+from os.path import join
+
+from pytouhou.lib.sdl import SDLError
+from pytouhou.utils.matrix cimport mul, new_identity
+from pytouhou.utils.maths cimport perspective, setup_camera, ortho_2d
+from pytouhou.utils.frustum import FOVY, Z_NEAR, Z_FAR
+from pytouhou.game.element cimport Element
+from pytouhou.game.effect cimport Effect
+from pytouhou.game.particle cimport ParticleSystem
+from pytouhou.game.item cimport ItemSystem
+from pytouhou.game.sprite cimport Sprite
+from pytouhou.game.text cimport NativeText, GlyphCollection
+from pytouhou.ui.window cimport Window
+from .sprite cimport get_sprite_rendering_data
+
+from collections import namedtuple
+Rect = namedtuple('Rect', 'x y w h')
+Color = namedtuple('Color', 'r g b a')
+
+from pytouhou.utils.helpers import get_logger
+logger = get_logger(__name__)
+
+
+cdef class GameRenderer:
+    def __init__(self, resource_loader, Window window):
+        self.canvas = Canvas(window.width, window.height)
+        self.texture_manager = TextureManager(resource_loader)
+        font_name = join(resource_loader.game_dir, 'font.ttf')
+        try:
+            self.font_manager = FontManager(font_name, 16)
+        except SDLError:
+            self.font_manager = None
+            logger.error('Font file “%s” not found, disabling text rendering altogether.', font_name)
+
+
+    def __dealloc__(self):
+        if self.game_mvp != NULL:
+            free(self.game_mvp)
+        if self.interface_mvp != NULL:
+            free(self.interface_mvp)
+        if self.proj != NULL:
+            free(self.proj)
+        free(self.background_vertices)
+
+
+    property size:
+        # Frames are always rendered at the native size, nothing to scale.
+        def __set__(self, tuple size):
+            self.x, self.y, self.width, self.height = size
+
+
+    def load_textures(self, dict anms):
+        self.texture_manager.load(anms)
+
+
+    def load_background(self, background):
+        cdef Sprite sprite
+        cdef Vertex *vertex
+        cdef float ox, oy, oz, ox2, oy2, oz2
+
+        free(self.background_vertices)
+        self.background_vertices = NULL
+        self.nb_background_vertices = 0
+        self.background = background
+        if background is None:
+            return
+
+        nb_quads = sum(len(model) for _, _, _, _, model in background.object_instances)
+        self.background_vertices = <Vertex*>malloc(4 * nb_quads * sizeof(Vertex))
+        if self.background_vertices == NULL:
+            raise MemoryError
+
+        for ox, oy, oz, model_id, model in background.object_instances:
+            for ox2, oy2, oz2, width_override, height_override, sprite in model:
+                data = get_sprite_rendering_data(sprite)
+                r, g, b, a = data.color[0], data.color[1], data.color[2], data.color[3]
+                vertex = &self.background_vertices[self.nb_background_vertices]
+                vertex[0] = Vertex(data.pos[0] + ox + ox2, data.pos[4] + oy + oy2, data.pos[8] + oz + oz2, data.left, data.bottom, r, g, b, a)
+                vertex[1] = Vertex(data.pos[1] + ox + ox2, data.pos[5] + oy + oy2, data.pos[9] + oz + oz2, data.right, data.bottom, r, g, b, a)
+                vertex[2] = Vertex(data.pos[2] + ox + ox2, data.pos[6] + oy + oy2, data.pos[10] + oz + oz2, data.right, data.top, r, g, b, a)
+                vertex[3] = Vertex(data.pos[3] + ox + ox2, data.pos[7] + oy + oy2, data.pos[11] + oz + oz2, data.left, data.top, r, g, b, a)
+                self.nb_background_vertices += 4
+
+                # Like in the OpenGL backend, the whole background uses a
+                # single texture.
+                self.background_texture = <Texture>sprite.anm.texture
+
+
+    def start(self, common):
+        self.proj = perspective(FOVY, float(common.width) / float(common.height),
+                                Z_NEAR, Z_FAR)
+        self.game_mvp = setup_camera(0, 0, 1)
+        mul(self.game_mvp, self.proj)
+        self.interface_mvp = ortho_2d(0., float(common.interface.width),
+                                      float(common.interface.height), 0.)
+
+
+    def render(self, Game game):
+        self.render_game(game)
+        self.render_text(game.texts)
+        self.render_interface(game.interface, game.boss)
+
+
+    def capture(self, int width, int height):
+        """Return the last frame as RGB, from top to bottom."""
+
+        return self.canvas.read(), False
+
+
+    def read_frame(self, int width, int height):
+        # There is nothing to wait for, frames are ready as soon as rendered.
+        return self.capture(width, height)
+
+
+    def flush_frame(self):
+        return None
+
+
+    def compare(self, bytes reference, long tolerance=0):
+        """Compare the last frame with a reference one, see Canvas.compare()."""
+
+        return self.canvas.compare(reference, tolerance)
+
+
+    cdef bint render_game(self, Game game) except True:
+        cdef long game_x, game_y
+        cdef float x, y, z, dx, dy, dz
+        cdef float fog_start, fog_end
+        cdef unsigned char fog_r, fog_g, fog_b
+
+        canvas = self.canvas
+        game_x, game_y = game.interface.game_pos
+        canvas.set_viewport(game_x, game_y, game.width, game.height)
+        canvas.set_clip(game_x, game_y, game.width, game.height)
+
+        if self.background is None:
+            canvas.clear()
+        elif game.spellcard_effect is not None:
+            canvas.mvp = self.game_mvp[0]
+            self.render_elements([game.spellcard_effect])
+        else:
+            back = self.background
+            x, y, z = back.position_interpolator.values
+            dx, dy, dz = back.position2_interpolator.values
+            fog_b, fog_g, fog_r, fog_start, fog_end = back.fog_interpolator.values
+
+            # See the OpenGL backend about those near plane offsets.
+            fog_start -= Z_NEAR
+            fog_end -= Z_NEAR
+
+            mvp = new_identity()
+            mvp_data = <float*>mvp
+            mvp_data[12] = -x
+            mvp_data[13] = -y
+            mvp_data[14] = -z
+            view = setup_camera(dx, dy, dz)
+            mul(mvp, view)
+            free(view)
+            mul(mvp, self.proj)
+            canvas.mvp = mvp[0]
+            free(mvp)
+
+            canvas.set_fog(fog_start, fog_end, fog_r, fog_g, fog_b)
+            self.render_background()
+
+        canvas.mvp = self.game_mvp[0]
+        self.render_elements([enemy for enemy in game.enemies if enemy.visible])
+        # Particles come after every effect, not in spawn order.
+        self.render_elements(game.effects)
+        self.render_particles(game.particles)
+        self.render_elements(chain(game.players_bullets,
+                                   game.lasers_sprites(),
+                                   game.players,
+                                   game.msg_sprites()))
+        self.render_elements(chain(game.bullets, game.lasers,
+                                   game.cancelled_bullets))
+        self.render_items(game.items)
+        self.render_elements(game.labels)
+
+        if game.msg_runner is not None:
+            rect = Rect(48, 368, 288, 48)
+            color1 = Color(0, 0, 0, 192)
+            color2 = Color(0, 0, 0, 128)
+            self.render_quad(rect, (color1, color1, color2, color2), None)
+
+        canvas.set_clip(0, 0, canvas.width, canvas.height)
+
+
+    cdef bint render_background(self) except True:
+        canvas = self.canvas
+        if self.background_texture is None:
+            return False
+
+        canvas.clear_depth()
+        canvas.depth_test = True
+        canvas.fog = True
+        for i in range(0, self.nb_background_vertices, 4):
+            canvas.draw_quad(&self.background_vertices[i], &self.background_texture.image, 0)
+        canvas.depth_test = False
+        canvas.fog = False
+
+
+    cdef bint render_elements(self, elements) except True:
+        # Don’t type element as Element, or else the overriding of objects won’t work.
+        cdef Element obj
+        cdef Sprite sprite
+
+        for element in elements:
+            for obj in element.objects:
+                sprite = obj.sprite
+                if not sprite or not sprite.visible:
+                    continue
+
+                self.render_sprite(sprite, obj.x, obj.y)
+
+
+    cdef bint render_particles(self, ParticleSystem particles) except True:
+        cdef Effect animation
+        cdef Sprite sprite
+        cdef long i
+        cdef double *positions = particles.positions
+
+        for i in range(particles.nb_particles):
+            animation = particles.animations[particles.animation_ids[i]]
+            sprite = animation.sprite
+            if sprite is None or not sprite.visible:
+                continue
+            self.render_sprite(sprite, positions[2*i], positions[2*i+1])
+
+
+    cdef bint render_items(self, ItemSystem items) except True:
+        for sprite, x, y in items.get_sprites():
+            self.render_sprite(sprite, x, y)
+
+
+    cdef bint render_sprite(self, Sprite sprite, float ox, float oy) except True:
+        cdef Texture texture
+        cdef Vertex vertices[4]
+
+        data = get_sprite_rendering_data(sprite)
+        r, g, b, a = data.color[0], data.color[1], data.color[2], data.color[3]
+        vertices[0] = Vertex(data.pos[0] + ox, data.pos[4] + oy, data.pos[8], data.left, data.bottom, r, g, b, a)
+        vertices[1] = Vertex(data.pos[1] + ox, data.pos[5] + oy, data.pos[9], data.right, data.bottom, r, g, b, a)
+        vertices[2] = Vertex(data.pos[2] + ox, data.pos[6] + oy, data.pos[10], data.right, data.top, r, g, b, a)
+        vertices[3] = Vertex(data.pos[3] + ox, data.pos[7] + oy, data.pos[11], data.left, data.top, r, g, b, a)
+
+        texture = <Texture>sprite.anm.texture
+        self.canvas.draw_quad(vertices, &texture.image, data.blendfunc)
+
+
+    cdef bint render_quad(self, rect, colors, Texture texture) except True:
+        cdef Vertex vertices[4]
+
+        c1, c2, c3, c4 = colors
+        x, y, w, h = rect
+        vertices[0] = Vertex(x, y, 0, 0, 0, c1.r, c1.g, c1.b, c1.a)
+        vertices[1] = Vertex(x + w, y, 0, 1, 0, c2.r, c2.g, c2.b, c2.a)
+        vertices[2] = Vertex(x + w, y + h, 0, 1, 1, c3.r, c3.g, c3.b, c3.a)
+        vertices[3] = Vertex(x, y + h, 0, 0, 1, c4.r, c4.g, c4.b, c4.a)
+
+        # Without texture, only the colors are drawn.
+        self.canvas.draw_quad(vertices, &texture.image if texture is not None else NULL, 0)
+
+
+    cdef bint render_text(self, dict texts) except True:
+        cdef NativeText label
+
+        if self.font_manager is None:
+            return False
+
+        self.font_manager.load(texts)
+
+        black = Color(0, 0, 0, 255)
+
+        for label in texts.values():
+            rect = Rect(label.x, label.y, label.width, label.height)
+            gradient = [Color(*color, a=label.alpha) for color in label.gradient]
+
+            if label.shadow:
+                shadow_rect = Rect(label.x + 1, label.y + 1, label.width, label.height)
+                shadow = [black._replace(a=label.alpha)] * 4
+                self.render_quad(shadow_rect, shadow, label.texture)
+            self.render_quad(rect, gradient, label.texture)
+
+
+    cdef bint render_interface(self, interface, game_boss) except True:
+        cdef GlyphCollection label
+
+        elements = []
+
+        self.canvas.mvp = self.interface_mvp[0]
+        self.canvas.set_viewport(0, 0, interface.width, interface.height)
+
+        items = [item for item in interface.items if item.anmrunner and item.anmrunner.running]
+        labels = interface.labels.values()
+
+        if items:
+            # Redraw all the interface
+            elements.extend(items)
+        else:
+            # Redraw only changed labels
+            labels = [label for label in labels if label.changed]
+
+        elements.extend(interface.level_start)
+
+        if game_boss is not None:
+            elements.extend(interface.boss_items)
+
+        elements.extend(labels)
+        self.render_elements(elements)
+        for label in labels:
+            label.changed = False
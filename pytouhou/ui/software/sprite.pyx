@@ -0,0 +1,95 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+
+from libc.stdlib cimport malloc
+from libc.string cimport memcpy
+from libc.math cimport M_PI as pi
+
+from pytouhou.utils.matrix cimport Matrix, scale2d, flip, rotate_x, rotate_y, rotate_z, translate, translate2d
+from pytouhou.game.sprite cimport DIRTY_TRANSFORM, DIRTY_TEXCOORDS, DIRTY_COLOR, DIRTY_ALL
+
+
+cdef Matrix default
+default = Matrix(-.5,   .5,   .5,  -.5,
+                 -.5,  -.5,   .5,   .5,
+                 0,    0,    0,    0,
+                 1,    1,    1,    1)
+
+
+cdef RenderingData* get_sprite_rendering_data(Sprite sprite) nogil:
+    if sprite.dirty:
+        render_sprite(sprite)
+    return <RenderingData*>sprite._rendering_data
+
+
+# Same quads as the OpenGL backend, minus the texture key which only makes
+# sense there.
+cdef void render_sprite(Sprite sprite) nogil:
+    cdef Matrix vertmat
+    cdef unsigned char dirty = sprite.dirty
+
+    if sprite._rendering_data == NULL:
+        sprite._rendering_data = malloc(sizeof(RenderingData))
+        dirty = DIRTY_ALL
+
+    data = <RenderingData*>sprite._rendering_data
+
+    tx, ty, tw, th = sprite._texcoords[0], sprite._texcoords[1], sprite._texcoords[2], sprite._texcoords[3]
+
+    if dirty & DIRTY_TRANSFORM:
+        memcpy(&vertmat, &default, sizeof(Matrix))
+
+        sx, sy = sprite._rescale[0], sprite._rescale[1]
+        width = sprite.width_override or (tw * sx)
+        height = sprite.height_override or (th * sy)
+
+        scale2d(&vertmat, width, height)
+        if sprite.mirrored:
+            flip(&vertmat)
+
+        rx, ry, rz = sprite._rotations_3d[0], sprite._rotations_3d[1], sprite._rotations_3d[2]
+        if sprite.automatic_orientation:
+            rz += pi/2. - sprite.angle
+        elif sprite.force_rotation:
+            rz += sprite.angle
+
+        if rx:
+            rotate_x(&vertmat, -rx)
+        if ry:
+            rotate_y(&vertmat, ry)
+        if rz:
+            rotate_z(&vertmat, -rz) #TODO: minus, really?
+        if sprite.allow_dest_offset:
+            translate(&vertmat, sprite._dest_offset)
+        if sprite.corner_relative_placement: # Reposition
+            translate2d(&vertmat, width / 2, height / 2)
+
+        memcpy(data.pos, &vertmat, 12 * sizeof(float))
+
+    if dirty & DIRTY_TEXCOORDS:
+        x_1 = sprite.anm.size_inv[0]
+        y_1 = sprite.anm.size_inv[1]
+        tox, toy = sprite._texoffsets[0], sprite._texoffsets[1]
+        data.left = tx * x_1 + tox
+        data.right = (tx + tw) * x_1 + tox
+        data.bottom = ty * y_1 + toy
+        data.top = (ty + th) * y_1 + toy
+
+    if dirty & DIRTY_COLOR:
+        for i in range(4):
+            data.color[i] = sprite._color[i]
+
+    data.blendfunc = sprite.blendfunc
+    sprite.dirty = 0
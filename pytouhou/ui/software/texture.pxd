@@ -0,0 +1,20 @@
+from pytouhou.lib.sdl cimport Font
+
+cdef struct Image:
+    unsigned char *pixels  # RGBA, top to bottom.
+    long width, height
+
+cdef class Texture:
+    cdef Image image
+
+cdef class TextureManager:
+    cdef object loader
+
+    cdef bint load(self, dict anms) except True
+
+cdef class FontManager:
+    cdef Font font
+
+    cdef bint load(self, dict labels) except True
+
+cdef Texture load_texture(thtx)
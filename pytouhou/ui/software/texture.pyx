@@ -0,0 +1,145 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+
+from pytouhou.lib.sdl import SDLError
+from pytouhou.formats.thtx import Texture as THTX #TODO: perhaps define that elsewhere?
+from pytouhou.utils.atlas import AtlasPage
+from pytouhou.game.text cimport NativeText
+from pytouhou.ui.images cimport decode_png, compose_page
+
+from pytouhou.utils.helpers import get_logger
+logger = get_logger(__name__)
+
+
+cdef class Texture:
+    def __dealloc__(self):
+        free(self.image.pixels)
+
+
+    property size:
+        def __get__(self):
+            return self.image.width, self.image.height
+
+
+cdef class TextureManager:
+    def __init__(self, loader=None):
+        self.loader = loader
+
+
+    cdef bint load(self, dict anms) except True:
+        # Nothing can be added anymore to the pages we are about to decode.
+        if self.loader.atlas is not None:
+            self.loader.atlas.seal()
+
+        for anm in sorted(anms.values(), key=is_ascii):
+            for entry in anm:
+                if isinstance(entry.texture, AtlasPage):
+                    page = entry.texture
+                    if page.texture is None:
+                        page.texture = load_texture(compose_page(self.loader, page))
+                    entry.texture = page.texture
+                    continue
+                if entry.texture is None:
+                    texture = decode_png(self.loader, entry.first_name, entry.secondary_name)
+                elif not isinstance(entry.texture, Texture):
+                    texture = entry.texture
+                entry.texture = load_texture(texture)
+        anms.clear()
+
+
+def is_ascii(anm):
+    return anm[0].first_name.endswith('ascii.png')
+
+
+cdef class FontManager:
+    def __init__(self, fontname, fontsize=16):
+        self.font = Font(fontname, fontsize)
+
+
+    cdef bint load(self, dict labels) except True:
+        cdef NativeText label
+
+        for i, label in labels.items():
+            if label.texture is None:
+                try:
+                    surface = self.font.render(label.text)
+                except SDLError as e:
+                    logger.error(u'Rendering of label “%s” failed: %s', label.text, e)
+                    del labels[i]  # Prevents it from retrying to render.
+                    continue
+
+                label.width, label.height = surface.surface.w, surface.surface.h
+
+                if label.align == 'center':
+                    label.x -= label.width // 2
+                elif label.align == 'right':
+                    label.x -= label.width
+                else:
+                    assert label.align == 'left'
+
+                label.texture = load_texture(THTX(label.width, label.height, -4, surface.pixels))
+
+
+cdef Texture load_texture(thtx):
+    """Convert a texture to RGBA, whatever its format."""
+
+    cdef Texture texture
+    cdef const unsigned char *data = thtx.data
+    cdef unsigned char *pixels
+    cdef unsigned short pixel
+    cdef long fmt = thtx.fmt
+    cdef long nb_pixels = thtx.width * thtx.height
+
+    if fmt not in (1, 3, 5, 7, -4):
+        raise Exception('Unknown texture type')
+
+    pixels = <unsigned char*>malloc(nb_pixels * 4)
+    if pixels == NULL:
+        raise MemoryError
+
+    if fmt == -4: #XXX: non-standard
+        memcpy(pixels, data, nb_pixels * 4)
+    elif fmt == 1:
+        for i in range(nb_pixels):
+            pixels[4*i] = data[4*i+2]
+            pixels[4*i+1] = data[4*i+1]
+            pixels[4*i+2] = data[4*i]
+            pixels[4*i+3] = data[4*i+3]
+    elif fmt == 3:
+        for i in range(nb_pixels):
+            pixel = data[2*i] | (data[2*i+1] << 8)
+            pixels[4*i] = ((pixel >> 11) & 0x1f) * 255 // 31
+            pixels[4*i+1] = ((pixel >> 5) & 0x3f) * 255 // 63
+            pixels[4*i+2] = (pixel & 0x1f) * 255 // 31
+            pixels[4*i+3] = 255
+    elif fmt == 5:
+        for i in range(nb_pixels):
+            pixel = data[2*i] | (data[2*i+1] << 8)
+            pixels[4*i] = ((pixel >> 8) & 0xf) * 17
+            pixels[4*i+1] = ((pixel >> 4) & 0xf) * 17
+            pixels[4*i+2] = (pixel & 0xf) * 17
+            pixels[4*i+3] = (pixel >> 12) * 17
+    else:
+        for i in range(nb_pixels):
+            pixels[4*i] = pixels[4*i+1] = pixels[4*i+2] = data[i]
+            pixels[4*i+3] = 255
+
+    texture = Texture.__new__(Texture)
+    texture.image.pixels = pixels
+    texture.image.width = thtx.width
+    texture.image.height = thtx.height
+    return texture
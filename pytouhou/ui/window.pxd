@@ -24,6 +24,7 @@ cdef class Window:
     cdef Clock clock
     cdef int frame, frameskip
     cdef int width, height
+    cdef bint headless
 
     cdef void set_size(self, int width, int height) nogil
     cpdef set_runner(self, Runner runner=*)
@@ -85,6 +85,9 @@ cdef class Window:
                 width, height,
                 frameskip)
 
+            # Some backends render frames without ever showing them.
+            self.headless = self.win is None
+
         self.clock = Clock(fps_limit)
         self.frame = 0
         self.frameskip = frameskip
@@ -93,7 +96,8 @@ cdef class Window:
 
 
     cdef void set_size(self, int width, int height) nogil:
-        self.win.set_window_size(width, height)
+        if self.win is not None:
+            self.win.set_window_size(width, height)
 
 
     cpdef set_runner(self, Runner runner=None):
@@ -113,16 +117,20 @@ cdef class Window:
 
     @cython.cdivision(True)
     cdef bint run_frame(self) except -1:
-        cdef bint render = (self.win is not None and
+        cdef bint render = ((self.win is not None or self.headless) and
                             (self.frameskip <= 1 or not self.frame % self.frameskip))
 
         running = False
         if self.runner is not None:
             running = self.runner.update(render)
-        if render:
-            self.win.present()
-
-        self.clock.tick()
+        # Let the simulation thread run, if any, while waiting on the GPU
+        # and on the clock.
+        if render and self.win is not None:
+            with nogil:
+                self.win.present()
+
+        with nogil:
+            self.clock.tick()
         self.frame += 1
 
         return running
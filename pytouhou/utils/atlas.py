@@ -0,0 +1,203 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+"""Texture atlases.
+
+EoSD spreads its sprites over a lot of small textures, each of them costing
+a texture switch and a draw call at render time.  This module packs those
+textures into a few big pages, and rewrites the sprites of the ANM entries
+so that they point into their page.
+
+Everything here is done on the CPU, the renderer only uploads the composed
+pages.
+"""
+
+import os
+from struct import unpack_from
+
+from pytouhou.formats import WrongFormatError
+from pytouhou.formats.thtx import Texture
+from pytouhou.utils.helpers import get_logger
+
+logger = get_logger(__name__)
+
+
+# Instructions which scroll the texture, relying on it wrapping around.
+_texture_shifts = {0: (27, 28), 2: (26, 27)}
+
+
+def png_size(data):
+    """Return the size of a PNG image, reading only its header."""
+
+    if data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR':
+        raise WrongFormatError(data[:8])
+    return unpack_from('>II', data, 16)
+
+
+def remap_sprites(sprites, anm_size, texture_size, offset, page_size):
+    """Rewrite the sprites of an entry placed at offset in a page.
+
+    The sprites are expressed in the coordinates of the ANM, which can differ
+    from the size of the texture actually used.  The sprites keep their size,
+    only their position and the size of the ANM change.
+
+    Return the new sprites dict, and the new size of the ANM.
+    """
+
+    ratio_x = anm_size[0] / texture_size[0]
+    ratio_y = anm_size[1] / texture_size[1]
+    dx = offset[0] * ratio_x
+    dy = offset[1] * ratio_y
+    new_sprites = {idx: (x + dx, y + dy, width, height)
+                   for idx, (x, y, width, height) in sprites.items()}
+    return new_sprites, (page_size[0] * ratio_x, page_size[1] * ratio_y)
+
+
+def compose(width, height, images):
+    """Blit RGBA images into a new one.
+
+    images is a list of (x, y, texture) tuples, each texture being in the
+    RGBA format (-4).
+    """
+
+    pixels = bytearray(width * height * 4)
+    for x, y, texture in images:
+        assert texture.fmt == -4
+        row = texture.width * 4
+        data = texture.data
+        for line in range(texture.height):
+            start = ((y + line) * width + x) * 4
+            pixels[start:start+row] = data[line*row:(line+1)*row]
+    return Texture(width, height, -4, bytes(pixels))
+
+
+
+class AtlasPage:
+    """A big texture, filled with shelves of smaller ones.
+
+    Instance variables:
+    width, height -- size of the page, in pixels
+    entries -- list of (entry, x, y) placed on this page
+    texture -- the texture uploaded for this page, once it has been
+    """
+
+    def __init__(self, width, height, padding=1):
+        self.width = width
+        self.height = height
+        self.padding = padding
+        self.shelves = []  # List of [y, height, next free x].
+        self.entries = []
+        self.texture = None
+
+
+    def place(self, width, height):
+        """Find room for a width×height rectangle.
+
+        Return its position, or None if it doesn’t fit on this page anymore.
+        """
+
+        padding = self.padding
+        width += padding
+        height += padding
+
+        for shelf in self.shelves:
+            y, shelf_height, x = shelf
+            if height <= shelf_height and x + width <= self.width:
+                shelf[2] += width
+                return x, y
+
+        y = self.shelves[-1][0] + self.shelves[-1][1] if self.shelves else 0
+        if y + height > self.height or width > self.width:
+            return None
+        self.shelves.append([y, height, width])
+        return 0, y
+
+
+
+class AtlasBuilder:
+    """Pack the textures of ANM entries into pages as they get loaded.
+
+    Pages are filled until they get sealed, which happens when the renderer
+    loads the pending textures, so that a page gets uploaded only once.
+    """
+
+    def __init__(self, width=2048, height=2048, padding=1):
+        self.width = width
+        self.height = height
+        self.padding = padding
+        self.open_pages = []
+        self.nb_pages = 0
+        self.nb_entries = 0
+
+
+    def can_pack(self, entry):
+        if entry.texture is not None or not entry.first_name:
+            return False
+        shifts = _texture_shifts.get(entry.version, ())
+        for script in entry.scripts.values():
+            for time, opcode, args in script:
+                if opcode in shifts:
+                    return False
+        return True
+
+
+    def add(self, anm, loader):
+        """Place the entries of an ANM file into the open pages."""
+
+        placed = []
+        for entry in anm:
+            if not self.can_pack(entry):
+                continue
+            name = os.path.basename(entry.first_name)
+            try:
+                data = loader.get_file(name).read()
+                size = png_size(data)
+            except (KeyError, WrongFormatError):
+                continue
+            # Keep the data around for when it will get decoded.
+            loader.stage('file', name, data, len(data), 0.)
+            placed.append((size, entry))
+
+        # Tallest first, so that shelves get wasted as little as possible.
+        placed.sort(key=lambda item: item[0][1], reverse=True)
+        for (width, height), entry in placed:
+            if width + self.padding > self.width or height + self.padding > self.height:
+                continue
+            for page in self.open_pages:
+                position = page.place(width, height)
+                if position is not None:
+                    break
+            else:
+                page = AtlasPage(self.width, self.height, self.padding)
+                self.open_pages.append(page)
+                self.nb_pages += 1
+                position = page.place(width, height)
+
+            entry.sprites, entry.size = remap_sprites(entry.sprites, entry.size,
+                                                      (width, height), position,
+                                                      (page.width, page.height))
+            entry.texture = page
+            page.entries.append((entry, position[0], position[1]))
+            self.nb_entries += 1
+
+
+    def seal(self):
+        """Close the open pages, and return them."""
+
+        pages = self.open_pages
+        self.open_pages = []
+        if pages:
+            logger.info('Packed %d textures into %d atlases so far.',
+                        self.nb_entries, self.nb_pages)
+        return pages
@@ -0,0 +1,118 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+"""View frustum culling of the background, on the CPU.
+
+Matrices are lists of 16 floats, laid out like pytouhou.utils.matrix, which
+transform row vectors: clip[j] = sum(v[i] * m[4*i+j]).  The functions here
+build the same matrices as the renderers do for the background, so that
+what gets culled can be checked without any GPU.
+"""
+
+from math import tan, radians, sqrt
+
+
+# The projection used for the background, and its near plane distance which
+# the fog also depends on.
+FOVY = 30.
+Z_NEAR = 101010101. / 2010101.
+Z_FAR = 101010101. / 10101.
+
+
+def mul(mat1, mat2):
+    return [sum(mat1[4*i+k] * mat2[4*k+j] for k in range(4))
+            for i in range(4) for j in range(4)]
+
+
+def perspective(fovy, aspect, z_near, z_far):
+    top = tan(radians(fovy / 2)) * z_near
+    right = top * aspect
+    return [z_near / right, 0., 0., 0.,
+            0., z_near / top, 0., 0.,
+            0., 0., -(z_far + z_near) / (z_far - z_near), -1.,
+            0., 0., -(2 * z_far * z_near) / (z_far - z_near), 0.]
+
+
+def normalize(vec):
+    norm = sqrt(sum(c * c for c in vec))
+    return [c / norm for c in vec]
+
+
+def cross(vec1, vec2):
+    return [vec1[1] * vec2[2] - vec2[1] * vec1[2],
+            vec1[2] * vec2[0] - vec2[2] * vec1[0],
+            vec1[0] * vec2[1] - vec2[0] * vec1[1]]
+
+
+def dot(vec1, vec2):
+    return vec1[0] * vec2[0] + vec1[1] * vec2[1] + vec1[2] * vec2[2]
+
+
+def look_at(eye, center, up):
+    f = normalize([c - e for c, e in zip(center, eye)])
+    s = normalize(cross(f, normalize(up)))
+    u = cross(s, f)
+    return [s[0], u[0], -f[0], 0.,
+            s[1], u[1], -f[1], 0.,
+            s[2], u[2], -f[2], 0.,
+            -dot(s, eye), -dot(u, eye), dot(f, eye), 1.]
+
+
+def background_matrix(position, direction, aspect):
+    """Return the mvp matrix of the background, for a camera at position
+    looking in direction, as given by the position and position2
+    interpolators of the Background."""
+
+    x, y, z = position
+    dx, dy, dz = direction
+    translation = [1., 0., 0., 0.,
+                   0., 1., 0., 0.,
+                   0., 0., 1., 0.,
+                   -x, -y, -z, 1.]
+    # See pytouhou.utils.maths.setup_camera for those magic constants.
+    view = look_at((192., 224., -835.979370 * dz),
+                   (192. + dx, 224. - dy, 0.), (0., -1., 0.))
+    return mul(mul(translation, view), perspective(FOVY, aspect, Z_NEAR, Z_FAR))
+
+
+def frustum_planes(matrix):
+    """Return the six planes of the frustum of matrix, as (a, b, c, d)
+    tuples, a point being inside when a*x + b*y + c*z + d >= 0 for all of
+    them."""
+
+    columns = [(matrix[j], matrix[4+j], matrix[8+j], matrix[12+j])
+               for j in range(4)]
+    w = columns[3]
+    planes = []
+    for column in columns[:3]:
+        planes.append(tuple(a + b for a, b in zip(w, column)))
+        planes.append(tuple(a - b for a, b in zip(w, column)))
+    return planes
+
+
+def box_visible(planes, box):
+    """Tell whether an axis-aligned box, given as (x1, y1, z1, x2, y2, z2),
+    may intersect the frustum.
+
+    This is conservative: some boxes near the corners of the frustum are
+    kept even though they are outside of it.
+    """
+
+    x1, y1, z1, x2, y2, z2 = box
+    for a, b, c, d in planes:
+        # Test the corner the furthest along the normal of the plane.
+        if (a * (x2 if a > 0 else x1) + b * (y2 if b > 0 else y1) +
+                c * (z2 if c > 0 else z1) + d) < 0:
+            return False
+    return True
@@ -29,3 +29,32 @@ def read_string(file, size, encoding=None):
     else:
         return data
 
+
+
+def get_buffer(file):
+    """Return the whole content of file as a memoryview, without copying it
+    when it already is in memory."""
+
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        return memoryview(file)
+    getbuffer = getattr(file, 'getbuffer', None)
+    if getbuffer is not None:
+        return getbuffer()
+    file.seek(0)
+    return memoryview(file.read())
+
+
+def unpack_string(data, offset, size, encoding=None):
+    """Like read_string, from the buffer data at offset."""
+
+    string = bytes(data[offset:offset+size])
+
+    try:
+        string = string[:string.index(b'\x00')]
+    except ValueError:
+        pass
+
+    if encoding:
+        return string.decode(encoding)
+    else:
+        return string
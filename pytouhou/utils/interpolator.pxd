@@ -1,13 +1,54 @@
+# Easing curves, applied to the linear progression x of an interpolation.
+# The first ones follow the numbering of the ANM interpolation modes.
+cpdef enum Formula:
+    FORMULA_LINEAR = 0
+    FORMULA_ACCELERATE = 1  # x²
+    FORMULA_ACCELERATE_3 = 2  # x³
+    FORMULA_ACCELERATE_4 = 3  # x⁴
+    FORMULA_DECELERATE = 4  # 2x - x²
+    FORMULA_DECELERATE_3 = 5  # 2x - x³
+    FORMULA_DECELERATE_4 = 6  # 2x - x⁴
+    FORMULA_REVERSE = 7  # 1 - x
+
+cdef double ease(Formula formula, double x) nogil
+
+
 cdef class Interpolator:
     cdef unsigned long start_frame, end_frame, _frame
     cdef long _length
     cdef double *_values
     cdef double *start_values
     cdef double *end_values
-    cdef object _formula
+    cdef Formula formula
 
     cpdef set_interpolation_start(self, unsigned long frame, tuple values)
     cpdef set_interpolation_end(self, unsigned long frame, tuple values)
     cpdef set_interpolation_end_frame(self, unsigned long end_frame)
     cpdef set_interpolation_end_values(self, tuple values)
     cpdef update(self, unsigned long frame)
+
+
+cdef enum:
+    SLOT_USED = 1
+    SLOT_RAN = 2
+
+
+cdef class InterpolatorBank:
+    cdef long length, capacity, nb_slots, nb_free
+    cdef long *free_slots
+    cdef unsigned char *flags
+    cdef unsigned long *start_frames
+    cdef unsigned long *end_frames
+    cdef unsigned long *frames
+    cdef unsigned long *checked_frames
+    cdef Formula *formulae
+    cdef double *values
+
+    cdef bint grow(self, long capacity) except True
+    cdef long add_slot(self, double *start_values, unsigned long start_frame,
+                       double *end_values, unsigned long end_frame,
+                       Formula formula) except -1
+    cdef void release(self, long slot) nogil
+    cdef double *get_values(self, long slot) nogil
+    cdef bint update_slot(self, long slot, unsigned long frame) nogil
+    cdef void update_all(self, unsigned long frame) nogil
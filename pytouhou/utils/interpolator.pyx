@@ -12,34 +12,78 @@
 ## GNU General Public License for more details.
 ##
 
-from libc.stdlib cimport malloc, free
+cimport cython
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy
+
+from .maths cimport ipow
+
+
+cdef double ease(Formula formula, double x) nogil:
+    # Those go through ipow(), rounded like the x ** n of the Python lambdas
+    # they replaced, so that replays stay in sync.
+    if formula == FORMULA_ACCELERATE:
+        return ipow(x, 2)
+    elif formula == FORMULA_ACCELERATE_3:
+        return ipow(x, 3)
+    elif formula == FORMULA_ACCELERATE_4:
+        return ipow(x, 4)
+    elif formula == FORMULA_DECELERATE:
+        return 2. * x - ipow(x, 2)
+    elif formula == FORMULA_DECELERATE_3:
+        return 2. * x - ipow(x, 3)
+    elif formula == FORMULA_DECELERATE_4:
+        return 2. * x - ipow(x, 4)
+    elif formula == FORMULA_REVERSE:
+        return 1. - x
+    return x
 
 
 cdef class Interpolator:
     def __init__(self, tuple values, unsigned long start_frame=0, tuple end_values=None,
-                 unsigned long end_frame=0, formula=None):
+                 unsigned long end_frame=0, Formula formula=FORMULA_LINEAR):
         self._length = len(values)
-        self._values = <double*>malloc(self._length * sizeof(double))
-        self.start_values = <double*>malloc(self._length * sizeof(double))
-        self.end_values = <double*>malloc(self._length * sizeof(double))
+        # A single allocation for the current, start and end values.
+        self._values = <double*>malloc(3 * self._length * sizeof(double))
+        if self._values == NULL:
+            raise MemoryError
+        self.start_values = self._values + self._length
+        self.end_values = self._values + 2 * self._length
         for i in range(self._length):
             self._values[i] = values[i]
             self.start_values[i] = self._values[i]
+            self.end_values[i] = self._values[i]
         if end_values is not None:
             for i in range(self._length):
                 self.end_values[i] = end_values[i]
         self.start_frame = start_frame
         self.end_frame = end_frame
         self._frame = 0
-        self._formula = formula
+        self.formula = formula
 
 
     def __dealloc__(self):
-        free(self.end_values)
-        free(self.start_values)
         free(self._values)
 
 
+    def __deepcopy__(self, memo):
+        cdef Interpolator interpolator = Interpolator.__new__(Interpolator)
+
+        interpolator._length = self._length
+        interpolator._values = <double*>malloc(3 * self._length * sizeof(double))
+        if interpolator._values == NULL:
+            raise MemoryError
+        memcpy(interpolator._values, self._values, 3 * self._length * sizeof(double))
+        interpolator.start_values = interpolator._values + self._length
+        interpolator.end_values = interpolator._values + 2 * self._length
+        interpolator.start_frame = self.start_frame
+        interpolator.end_frame = self.end_frame
+        interpolator._frame = self._frame
+        interpolator.formula = self.formula
+        memo[id(self)] = interpolator
+        return interpolator
+
+
     property values:
         def __get__(self):
             return tuple([self._values[i] for i in range(self._length)])
@@ -82,9 +126,214 @@ cdef class Interpolator:
             self.start_frame = frame
         else:
             coeff = float(frame - self.start_frame) / float(self.end_frame - self.start_frame)
-            if self._formula is not None:
-                coeff = self._formula(coeff)
+            coeff = ease(self.formula, coeff)
             for i in range(self._length):
                 start_value = self.start_values[i]
                 end_value = self.end_values[i]
                 self._values[i] = start_value + coeff * (end_value - start_value)
+
+
+
+cdef class InterpolatorBank:
+    """Interpolators of length values each, all following the game frame.
+
+    Their frames and values are kept in contiguous arrays, so that
+    update_all() can advance them at once, before their owners read them
+    with update_slot().  A slot behaves exactly like an Interpolator whose
+    update() gets called once per frame, while it is true.
+    """
+
+    def __init__(self, long length, long capacity=16):
+        self.length = length
+        self.grow(capacity)
+
+
+    def __dealloc__(self):
+        free(self.free_slots)
+        free(self.flags)
+        free(self.start_frames)
+        free(self.end_frames)
+        free(self.frames)
+        free(self.checked_frames)
+        free(self.formulae)
+        free(self.values)
+
+
+    def __deepcopy__(self, memo):
+        cdef InterpolatorBank bank = InterpolatorBank(self.length, self.capacity)
+        cdef long n = self.capacity
+
+        memcpy(bank.free_slots, self.free_slots, n * sizeof(long))
+        memcpy(bank.flags, self.flags, n * sizeof(unsigned char))
+        memcpy(bank.start_frames, self.start_frames, n * sizeof(unsigned long))
+        memcpy(bank.end_frames, self.end_frames, n * sizeof(unsigned long))
+        memcpy(bank.frames, self.frames, n * sizeof(unsigned long))
+        memcpy(bank.checked_frames, self.checked_frames, n * sizeof(unsigned long))
+        memcpy(bank.formulae, self.formulae, n * sizeof(Formula))
+        memcpy(bank.values, self.values, 3 * n * self.length * sizeof(double))
+        bank.nb_slots = self.nb_slots
+        bank.nb_free = self.nb_free
+        memo[id(self)] = bank
+        return bank
+
+
+    def __len__(self):
+        return self.nb_slots - self.nb_free
+
+
+    cdef bint grow(self, long capacity) except True:
+        # Each array is only replaced once reallocated, so that none leaks
+        # nor dangles if another one fails.
+        if not grow_array(<void**>&self.free_slots, capacity * sizeof(long)):
+            raise MemoryError
+        if not grow_array(<void**>&self.flags, capacity * sizeof(unsigned char)):
+            raise MemoryError
+        if not grow_array(<void**>&self.start_frames, capacity * sizeof(unsigned long)):
+            raise MemoryError
+        if not grow_array(<void**>&self.end_frames, capacity * sizeof(unsigned long)):
+            raise MemoryError
+        if not grow_array(<void**>&self.frames, capacity * sizeof(unsigned long)):
+            raise MemoryError
+        if not grow_array(<void**>&self.checked_frames, capacity * sizeof(unsigned long)):
+            raise MemoryError
+        if not grow_array(<void**>&self.formulae, capacity * sizeof(Formula)):
+            raise MemoryError
+        if not grow_array(<void**>&self.values, 3 * capacity * self.length * sizeof(double)):
+            raise MemoryError
+        self.capacity = capacity
+
+
+    cdef long add_slot(self, double *start_values, unsigned long start_frame,
+                       double *end_values, unsigned long end_frame,
+                       Formula formula) except -1:
+        cdef long slot, i, length = self.length
+        cdef double *values
+
+        if self.nb_free:
+            self.nb_free -= 1
+            slot = self.free_slots[self.nb_free]
+        else:
+            if self.nb_slots == self.capacity:
+                self.grow(2 * self.capacity)
+            slot = self.nb_slots
+            self.nb_slots += 1
+
+        # Same layout as the values of an Interpolator.
+        values = &self.values[3 * slot * length]
+        for i in range(length):
+            values[i] = start_values[i]
+            values[length+i] = start_values[i]
+            values[2*length+i] = end_values[i]
+        self.start_frames[slot] = start_frame
+        self.end_frames[slot] = end_frame
+        self.frames[slot] = 0
+        self.checked_frames[slot] = 0
+        self.formulae[slot] = formula
+        self.flags[slot] = SLOT_USED
+        return slot
+
+
+    cdef void release(self, long slot) nogil:
+        self.flags[slot] = 0
+        self.free_slots[self.nb_free] = slot
+        self.nb_free += 1
+
+
+    cdef double *get_values(self, long slot) nogil:
+        return &self.values[3 * slot * self.length]
+
+
+    @cython.cdivision(True)
+    cdef bint update_slot(self, long slot, unsigned long frame) nogil:
+        cdef long i, length = self.length
+        cdef double coeff
+        cdef double *values
+        cdef double *start_values
+        cdef double *end_values
+
+        # Already done for this frame, possibly by update_all().
+        if self.checked_frames[slot] == frame + 1:
+            return self.flags[slot] & SLOT_RAN
+        self.checked_frames[slot] = frame + 1
+
+        # Same test as the truth value of an Interpolator.
+        if self.frames[slot] >= self.end_frames[slot]:
+            self.flags[slot] = SLOT_USED
+            return False
+        self.flags[slot] = SLOT_USED | SLOT_RAN
+
+        values = self.get_values(slot)
+        start_values = values + length
+        end_values = values + 2 * length
+
+        # The same computations as in Interpolator.update(), bug included.
+        self.frames[slot] = frame
+        if frame + 1 >= self.end_frames[slot]:
+            for i in range(length):
+                values[i] = end_values[i]
+                start_values[i] = end_values[i]
+            self.start_frames[slot] = frame
+        else:
+            coeff = <double>(frame - self.start_frames[slot]) / <double>(self.end_frames[slot] - self.start_frames[slot])
+            coeff = ease(self.formulae[slot], coeff)
+            for i in range(length):
+                values[i] = start_values[i] + coeff * (end_values[i] - start_values[i])
+        return True
+
+
+    cdef void update_all(self, unsigned long frame) nogil:
+        cdef long slot
+
+        for slot in range(self.nb_slots):
+            if self.flags[slot] & SLOT_USED:
+                self.update_slot(slot, frame)
+
+
+    def add(self, tuple values, unsigned long start_frame=0, tuple end_values=None,
+            unsigned long end_frame=0, Formula formula=FORMULA_LINEAR):
+        """Add an interpolator, taking the same arguments as Interpolator,
+        and return its slot."""
+
+        cdef Interpolator interpolator = Interpolator(values, start_frame, end_values,
+                                                      end_frame, formula)
+
+        if len(values) != self.length:
+            raise ValueError('This bank holds interpolators of %d values.' % self.length)
+        return self.add_slot(interpolator.start_values, start_frame,
+                             interpolator.end_values, end_frame, formula)
+
+
+    def remove(self, long slot):
+        if not 0 <= slot < self.nb_slots or not self.flags[slot] & SLOT_USED:
+            raise IndexError(slot)
+        self.release(slot)
+
+
+    def update(self, unsigned long frame):
+        """Advance every interpolator of the bank to frame."""
+
+        with nogil:
+            self.update_all(frame)
+
+
+    def get(self, long slot, unsigned long frame):
+        """Return the values of slot on frame, or None if it was already
+        over, like an Interpolator which was false."""
+
+        cdef double *values
+
+        if not 0 <= slot < self.nb_slots or not self.flags[slot] & SLOT_USED:
+            raise IndexError(slot)
+        if not self.update_slot(slot, frame):
+            return None
+        values = self.get_values(slot)
+        return tuple([values[i] for i in range(self.length)])
+
+
+
+cdef bint grow_array(void **array, size_t size) nogil:
+    cdef void *new_array = realloc(array[0], size)
+    if new_array == NULL:
+        return False
+    array[0] = new_array
+    return True
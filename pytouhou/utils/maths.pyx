@@ -12,13 +12,31 @@
 ## GNU General Public License for more details.
 ##
 
-from libc.math cimport tan, M_PI as pi
+from libc.math cimport tan, pow, fabs, M_PI as pi
 cimport cython
 
 from .matrix cimport new_matrix, new_identity
 from .vector cimport Vector, sub, cross, dot, normalize
 
 
+cdef extern from *:
+    """
+    /* Read from memory on each use, so that the compiler cannot turn
+       pow(x, 2.) into x * x, which is sometimes rounded differently. */
+    static volatile double pytouhou_exponents[5] = {0., 1., 2., 3., 4.};
+    """
+    double exponents "pytouhou_exponents"[5]
+
+
+cdef double ipow(double x, long exponent) nogil:
+    """Raise x to a small integer exponent, up to 4, rounded exactly like
+    Python’s x ** exponent is."""
+
+    # Python computes pow() on the absolute value, and fixes the sign after.
+    cdef double result = pow(fabs(x), exponents[exponent])
+    return -result if x < 0 and exponent % 2 else result
+
+
 cdef double radians(double degrees) nogil:
     return degrees * pi / 180
 
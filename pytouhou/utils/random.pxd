@@ -4,7 +4,13 @@ cdef class Random:
 
     cdef void set_seed(self, unsigned short seed) nogil
     cdef unsigned short rewind(self) nogil
+    cdef void fill_uint16(self, unsigned short *values, Py_ssize_t n) nogil
+    cdef void fill_double(self, double *values, Py_ssize_t n) nogil
 
+    cpdef skip(self, long count)
+    cpdef seek(self, unsigned long counter)
     cpdef unsigned short rand_uint16(self)
     cpdef unsigned int rand_uint32(self)
     cpdef double rand_double(self)
+    cpdef rand_uint16_n(self, unsigned short[::1] values)
+    cpdef rand_double_n(self, double[::1] values)
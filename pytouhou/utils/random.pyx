@@ -26,9 +26,48 @@ It has been reverse engineered from 102h.exe."""
 #TODO: maybe some post-processing is missing
 
 cimport cython
+from libc.stdlib cimport malloc, free
 from time import time
 
 
+cdef inline unsigned short next_seed(unsigned short seed) nogil:
+    # 102h.exe@0x41e780
+    cdef unsigned short x = ((seed ^ 0x9630) - 0x6553) & 0xffff
+    return (((x & 0xc000) >> 14) | (x << 2)) & 0xffff
+
+
+# The generator goes through all of its 65536 states in a single cycle.  Built
+# on the first seek, these tables list the states in that order, and give the
+# position of every state in that list.
+cdef unsigned short *cycle_states = NULL
+cdef unsigned short *state_index = NULL
+
+
+cdef bint build_tables() except False:
+    global cycle_states, state_index
+
+    cdef unsigned long i
+    cdef unsigned short seed = 0
+
+    if cycle_states != NULL:
+        return True
+
+    states = <unsigned short*>malloc(65536 * sizeof(unsigned short))
+    index = <unsigned short*>malloc(65536 * sizeof(unsigned short))
+    if states == NULL or index == NULL:
+        free(states)
+        free(index)
+        raise MemoryError
+
+    for i in range(65536):
+        states[i] = seed
+        index[seed] = <unsigned short>i
+        seed = next_seed(seed)
+
+    cycle_states, state_index = states, index
+    return True
+
+
 @cython.final
 cdef class Random:
     def __init__(self, long seed=-1):
@@ -53,21 +92,76 @@ cdef class Random:
         return self.seed
 
 
+    cpdef skip(self, long count):
+        """Advance the PRNG by count steps, or rewind it if count is negative,
+        in constant time.
+
+        The first call builds the tables of the cycle, which take 256 KiB.
+        """
+        build_tables()
+        self.seed = cycle_states[(state_index[self.seed] + count) & 0xffff]
+        self.counter += count
+
+
+    cpdef seek(self, unsigned long counter):
+        """Move the PRNG to the state it had, or will have, after counter
+        steps since its seed was set."""
+        self.skip(<long>(counter - self.counter))
+
+
     cpdef unsigned short rand_uint16(self):
-        # 102h.exe@0x41e780
-        x = ((self.seed ^ 0x9630) - 0x6553) & 0xffff
-        self.seed = (((x & 0xc000) >> 14) | (x << 2)) & 0xffff
+        self.seed = next_seed(self.seed)
         self.counter += 1
         return self.seed
 
 
     cpdef unsigned int rand_uint32(self):
         # 102h.exe@0x41e7f0
-        a = self.rand_uint16() << 16
-        a |= self.rand_uint16()
-        return a
+        cdef unsigned int a = next_seed(self.seed)
+        self.seed = next_seed(<unsigned short>a)
+        self.counter += 2
+        return a << 16 | self.seed
 
 
     cpdef double rand_double(self):
         # 102h.exe@0x41e820
         return self.rand_uint32() / <double>0x100000000
+
+
+    cdef void fill_uint16(self, unsigned short *values, Py_ssize_t n) nogil:
+        cdef unsigned short seed = self.seed
+        cdef Py_ssize_t i
+
+        for i in range(n):
+            seed = next_seed(seed)
+            values[i] = seed
+        self.seed = seed
+        self.counter += n
+
+
+    cdef void fill_double(self, double *values, Py_ssize_t n) nogil:
+        cdef unsigned short seed = self.seed
+        cdef unsigned int a
+        cdef Py_ssize_t i
+
+        for i in range(n):
+            seed = next_seed(seed)
+            a = seed
+            seed = next_seed(seed)
+            values[i] = (a << 16 | seed) / <double>0x100000000
+        self.seed = seed
+        self.counter += 2 * n
+
+
+    cpdef rand_uint16_n(self, unsigned short[::1] values):
+        """Fill values with as many successive rand_uint16() draws."""
+        if values.shape[0] > 0:
+            with nogil:
+                self.fill_uint16(&values[0], values.shape[0])
+
+
+    cpdef rand_double_n(self, double[::1] values):
+        """Fill values with as many successive rand_double() draws."""
+        if values.shape[0] > 0:
+            with nogil:
+                self.fill_double(&values[0], values.shape[0])
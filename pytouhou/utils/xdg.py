@@ -37,6 +37,9 @@ xdg_config_dirs = [xdg_config_home] + \
 
 xdg_config_dirs = [x for x in xdg_config_dirs if x]
 
+xdg_cache_home = os.environ.get('XDG_CACHE_HOME') or \
+    os.path.join(_home, '.cache')
+
 
 def save_config_path(*resource):
     resource = os.path.join(*resource)
@@ -53,3 +56,12 @@ def load_config_paths(*resource):
         path = os.path.join(config_dir, resource)
         if os.path.exists(path):
             yield path
+
+
+def save_cache_path(*resource):
+    resource = os.path.join(*resource)
+    assert not resource.startswith('/')
+    path = os.path.join(xdg_cache_home, resource)
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    return path
@@ -1,29 +1,123 @@
+from inspect import isgeneratorfunction
+
 from .anmrunner import ANMRunner
 from .msgrunner import MSGRunner
-from .eclrunner import ECLMainRunner
+from .eclrunner import ECLMainRunner, NEVER
+from .common import handler_tables
+
+
+class CallEveryFrame:
+    """Task calling a plain function sub every frame."""
+
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+    def __next__(self):
+        self.function(*self.args)
+        return 1
+
+
+
+class ScriptRunner:
+    """Runner of Python subs, written as task classes.
+
+    A task class gets instantiated with the sub’s arguments, and its
+    instance’s __next__ returns the number of frames it wants to wait before
+    getting called again, see wait(), from its own explicit state.  It isn’t
+    called at all meanwhile.  A plain function sub gets called every frame.
+
+    Generators would be nicer to write, but they can’t be copied, and the
+    state of the game has to be, for netplay.
+
+    Other tasks can be run along the sub, with start().
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.tasks = []  # Wake frame and iterator of every task.
+        self.wake_frame = NEVER
+
+
+    def start(self, task):
+        """Run the task, an iterator, from now on, along the other ones."""
+        self.tasks.append([0, task])
+        self.wake_frame = 0
+
 
+    def start_sub(self, sub, *args):
+        if isgeneratorfunction(sub):
+            raise TypeError('Python subs can’t be generators, as those can’t be copied.')
+        if isinstance(sub, type):
+            self.start(sub(*args))
+        else:
+            self.start(CallEveryFrame(sub, args))
 
-class PythonMainRunner:
+
+    def rewind(self):
+        """Wake every task one frame earlier than it asked for."""
+        for task in self.tasks:
+            task[0] -= 1
+        self.wake_frame -= 1
+
+
+    def run_iteration(self):
+        frame = self.game.frame
+        tasks = self.tasks
+        wake_frame = NEVER
+
+        # Tasks started by other tasks get appended, and run right away.
+        i = 0
+        while i < len(tasks):
+            task = tasks[i]
+            if task[0] <= frame:
+                try:
+                    frames = next(task[1])
+                except StopIteration:
+                    del tasks[i]
+                    continue
+                task[0] = frame + max(frames or 1, 1)
+            if task[0] < wake_frame:
+                wake_frame = task[0]
+            i += 1
+
+        self.wake_frame = wake_frame
+
+
+
+class PythonMainRunner(ScriptRunner):
     def __init__(self, main, game):
+        ScriptRunner.__init__(self, game)
         self.main = main
-        self.game = game
+        self.start_sub(main, game)
 
     def run_iter(self):
-        self.main(self.game)
+        if self.wake_frame <= self.game.frame:
+            self.run_iteration()
 
 
-class EnemyRunner:
+
+class EnemyRunner(ScriptRunner):
     def __init__(self, enemy, game, sub):
+        ScriptRunner.__init__(self, game)
         self.enemy = enemy
-        self.game = game
         self.sub = sub
-
-    def run_iteration(self):
-        self.sub(self.enemy, self.game)
+        self.start_sub(sub, enemy, game)
 
 
 def spawn_enemy(game, sub, x=0., y=0., life=1, item=-1, score=0, mirrored=False, random=False):
     instr_type = (2 if mirrored else 0) | (4 if random else 0)
     enemy = game.new_enemy((x, y, 0.), life, instr_type, item, score)
-    enemy.process = EnemyRunner(enemy, game, sub)
-    enemy.process.run_iteration()
+    enemy.process = process = EnemyRunner(enemy, game, sub)
+    process.run_iteration()
+    # Like for ECL subs, the new enemy will get updated once more this frame,
+    # and its sub called again on the same enemy.frame.
+    process.rewind()
+
+
+def wait(frames):
+    """Return what a task has to return to sleep for that many frames, at
+    least one."""
+    return frames
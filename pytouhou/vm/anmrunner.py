@@ -17,6 +17,8 @@ from random import randrange, random
 
 from pytouhou.utils.helpers import get_logger
 from pytouhou.vm.common import MetaRegistry, instruction
+from pytouhou.game.sprite import Dirty
+from pytouhou.utils.interpolator import Formula
 
 logger = get_logger(__name__)
 
@@ -24,18 +26,18 @@ logger = get_logger(__name__)
 class ANMRunner(metaclass=MetaRegistry):
     __slots__ = ('_anm', '_sprite', 'running', 'sprite_index_offset', 'script',
                  'instruction_pointer', 'frame', 'waiting', 'handlers',
-                 'variables', 'version', 'timeout')
+                 'variables', 'version', 'timeout', 'sleep')
 
     #TODO: check!
-    formulae = {0: None,
-                1: lambda x: x ** 2,
-                2: lambda x: x ** 3,
-                3: lambda x: x ** 4,
-                4: lambda x: 2 * x - x ** 2,
-                5: lambda x: 2 * x - x ** 3,
-                6: lambda x: 2 * x - x ** 4,
-                7: None,
-                255: None} #XXX
+    formulae = {0: Formula.FORMULA_LINEAR,
+                1: Formula.FORMULA_ACCELERATE,
+                2: Formula.FORMULA_ACCELERATE_3,
+                3: Formula.FORMULA_ACCELERATE_4,
+                4: Formula.FORMULA_DECELERATE,
+                5: Formula.FORMULA_DECELERATE_3,
+                6: Formula.FORMULA_DECELERATE_4,
+                7: Formula.FORMULA_LINEAR,
+                255: Formula.FORMULA_LINEAR} #XXX
 
     def __init__(self, anm, script_id, sprite, sprite_index_offset=0):
         self._anm = anm
@@ -48,6 +50,7 @@ class ANMRunner(metaclass=MetaRegistry):
         self.handlers = self._handlers[{0: 6, 2: 7}[anm.version]]
         self.frame = 0
         self.timeout = -1
+        self.sleep = 0
         self.instruction_pointer = 0
         self.variables = [0,  0,  0,  0,
                           0., 0., 0., 0.,
@@ -58,6 +61,18 @@ class ANMRunner(metaclass=MetaRegistry):
         self.sprite_index_offset = 0
 
 
+    @classmethod
+    def is_deterministic(cls, anm, script_id):
+        """Return True if every runner of that script does the exact same
+        thing to its sprite, as it doesn’t use any random instruction."""
+
+        handlers = cls._handlers[{0: 6, 2: 7}[anm.version]]
+        random_handlers = (cls.load_random_sprite, cls.set_random_int,
+                           cls.set_random_float)
+        return not any(handlers.get(opcode) in random_handlers
+                       for frame, opcode, args in anm.scripts[script_id])
+
+
     def interrupt(self, interrupt):
         new_ip = self.script.interrupts.get(interrupt, None)
         if new_ip is None:
@@ -67,6 +82,7 @@ class ANMRunner(metaclass=MetaRegistry):
         self.instruction_pointer = new_ip
         self.frame, opcode, args = self.script[self.instruction_pointer]
         self.waiting = False
+        self.sleep = 0
         self._sprite.visible = True
         return True
 
@@ -75,6 +91,12 @@ class ANMRunner(metaclass=MetaRegistry):
         if not self.running:
             return False
 
+        # Nothing to do until the next instruction.
+        if self.sleep:
+            self.sleep -= 1
+            self._sprite.update()
+            return True
+
         while self.running and not self.waiting:
             frame, opcode, args = self.script[self.instruction_pointer]
 
@@ -91,10 +113,16 @@ class ANMRunner(metaclass=MetaRegistry):
                                  id(self), self.frame, opcode, args)
                 else:
                     callback(self, *args)
-                    self._sprite.changed = True
 
         if not self.waiting:
             self.frame += 1
+            # Skip the frames until the next instruction at once, instead of
+            # looking it up on every one of them.
+            if self.running:
+                frame = self.script[self.instruction_pointer][0]
+                if frame > self.frame:
+                    self.sleep = frame - self.frame
+                    self.frame = frame
         elif self.timeout == self._sprite.frame: #TODO: check if it’s happening at the correct frame.
             self.waiting = False
 
@@ -160,6 +188,7 @@ class ANMRunner(metaclass=MetaRegistry):
     @instruction(10, 7)
     def toggle_mirrored(self):
         self._sprite.mirrored = not self._sprite.mirrored
+        self._sprite.dirty |= Dirty.DIRTY_TRANSFORM
 
 
     @instruction(9)
@@ -189,11 +218,13 @@ class ANMRunner(metaclass=MetaRegistry):
     @instruction(13)
     def set_blendfunc_alphablend(self):
         self._sprite.blendfunc = 1
+        self._sprite.dirty |= Dirty.DIRTY_COLOR
 
 
     @instruction(14)
     def set_blendfunc_add(self):
         self._sprite.blendfunc = 0 #TODO
+        self._sprite.dirty |= Dirty.DIRTY_COLOR
 
 
     @instruction(15)
@@ -222,13 +253,13 @@ class ANMRunner(metaclass=MetaRegistry):
     @instruction(19)
     @instruction(18, 7)
     def move_in_decel(self, x, y, z, duration):
-        self._sprite.move_in(duration, x, y, z, lambda x: 2. * x - x ** 2)
+        self._sprite.move_in(duration, x, y, z, Formula.FORMULA_DECELERATE)
 
 
     @instruction(20)
     @instruction(19, 7)
     def move_in_accel(self, x, y, z, duration):
-        self._sprite.move_in(duration, x, y, z, lambda x: x ** 2)
+        self._sprite.move_in(duration, x, y, z, Formula.FORMULA_ACCELERATE)
 
 
     @instruction(21)
@@ -250,6 +281,7 @@ class ANMRunner(metaclass=MetaRegistry):
     @instruction(22, 7)
     def set_corner_relative_placement(self):
         self._sprite.corner_relative_placement = True #TODO
+        self._sprite.dirty |= Dirty.DIRTY_TRANSFORM
 
 
     @instruction(24)
@@ -265,6 +297,7 @@ class ANMRunner(metaclass=MetaRegistry):
     @instruction(24, 7)
     def set_allow_dest_offset(self, value):
         self._sprite.allow_dest_offset = bool(value)
+        self._sprite.dirty |= Dirty.DIRTY_TRANSFORM
 
 
     @instruction(26)
@@ -273,6 +306,7 @@ class ANMRunner(metaclass=MetaRegistry):
         """If true, rotate by pi-angle around the z axis.
         """
         self._sprite.automatic_orientation = bool(value)
+        self._sprite.dirty |= Dirty.DIRTY_TRANSFORM
 
 
     @instruction(27)
@@ -330,6 +364,7 @@ class ANMRunner(metaclass=MetaRegistry):
     @instruction(16, 7)
     def set_blendfunc(self, value):
         self._sprite.blendfunc = bool(value & 1)
+        self._sprite.dirty |= Dirty.DIRTY_COLOR
 
 
     @instruction(32, 7)
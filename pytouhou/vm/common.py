@@ -13,6 +13,10 @@
 ##
 
 
+# Every instruction table built so far, which never change once built.
+handler_tables = []
+
+
 class MetaRegistry(type):
     def __new__(mcs, name, bases, classdict):
         instruction_handlers = {}
@@ -22,6 +26,7 @@ class MetaRegistry(type):
                     for id_ in instruction_ids:
                         instruction_handlers.setdefault(version, {})[id_] = item
         classdict['_handlers'] = instruction_handlers
+        handler_tables.extend(instruction_handlers.values())
         return type.__new__(mcs, name, bases, classdict)
 
 
@@ -0,0 +1,322 @@
+# -*- encoding: utf-8 -*-
+##
+## Copyright (C) 2014 Emmanuel Gil Peyrot <linkmauve@linkmauve.fr>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published
+## by the Free Software Foundation; version 3 only.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+
+"""Ahead-of-time compiler of ECL subs into Python functions.
+
+Each sub becomes a function doing what ECLRunner.run_iteration does for it,
+without looking up its instructions nor their handlers: every instruction
+is a direct call to its handler with constant arguments, guarded by its rank
+mask.  The instructions are split into blocks sharing the same frame, which
+also end after jumps, calls and anything else which can change the control
+flow of the runner, and start where jumps go to.  Each block is a function
+returning the instruction to go on with, looked up in a table of the sub:
+resuming the sub or jumping in it doesn’t depend on where it goes to.  Once
+a block changed the sub, the runner takes over.
+
+A compiled sub is called with the runner, and returns True if the runner
+has to call the sub it switched to, False once it is done for this frame.
+
+Compiled ECL files are kept as hash-based .pyc files in the XDG cache
+directory, keyed on the subs and on the instruction table they got compiled
+against.
+"""
+
+import os
+import dis
+import marshal
+from importlib.util import MAGIC_NUMBER, source_hash
+from inspect import signature
+from math import isfinite
+from threading import get_ident
+
+from pytouhou.utils.helpers import get_logger
+from pytouhou.utils.xdg import save_cache_path
+from pytouhou.vm.eclrunner import ECLRunner, logger as runner_logger
+
+logger = get_logger(__name__)
+
+# To be incremented whenever the generated code changes.
+COMPILER_VERSION = 2
+
+# What a block returns instead of the next instruction, when the sub has to
+# wait for a later frame, or when the runner switched to another sub.
+SUSPENDED = -1
+SWITCHED = -2
+
+# Attributes and methods of the runner which, used by an instruction
+# handler, mean it can change its control flow: jumps, calls, frame skips.
+CONTROL_ATTRIBUTES = frozenset(['frame', 'instruction_pointer', 'sub',
+                                'stack', 'running', 'switch_to_sub'])
+
+# Methods of the game which can fire callbacks, calling switch_to_sub.
+CONTROL_CALLS = frozenset(['kill_enemies'])
+
+_attribute_opnames = frozenset(['LOAD_ATTR', 'LOAD_METHOD', 'STORE_ATTR',
+                                'DELETE_ATTR'])
+
+# A hash-based .pyc file, which doesn’t check its source.
+_pyc_flags = (1).to_bytes(4, 'little')
+
+
+def get_own_attributes(function):
+    """Return the names of the attributes function accesses on its first
+    argument, and maybe a few more.
+
+    Chained accesses, like self._enemy.frame, are the only ones which get
+    excluded.
+    """
+
+    attributes = set()
+    previous = None
+    for instruction in dis.get_instructions(function):
+        if (instruction.opname in _attribute_opnames and
+                previous not in _attribute_opnames):
+            attributes.add(instruction.argval)
+        previous = instruction.opname
+    return attributes
+
+
+def is_control(function, seen=None):
+    """Return True if function, or any method of the runner it calls, can
+    change the control flow of the runner."""
+
+    if seen is None:
+        seen = set()
+    seen.add(function)
+    if not CONTROL_CALLS.isdisjoint(function.__code__.co_names):
+        return True
+    attributes = get_own_attributes(function)
+    if not CONTROL_ATTRIBUTES.isdisjoint(attributes):
+        return True
+    for name in attributes:
+        method = getattr(ECLRunner, name, None)
+        if hasattr(method, '__code__') and method not in seen:
+            if is_control(method, seen):
+                return True
+    return False
+
+
+def get_control_opcodes(handlers):
+    return frozenset(opcode for opcode, handler in handlers.items()
+                     if is_control(handler))
+
+
+def literal(value):
+    """Return the Python source of an instruction argument."""
+
+    if isinstance(value, float) and not isfinite(value):
+        return 'float(%r)' % repr(value)
+    return repr(value)
+
+
+def get_jump_arguments(handlers):
+    """Return the index of the target instruction in the arguments of every
+    jump, as far as their handlers tell."""
+
+    arguments = {}
+    for opcode, handler in handlers.items():
+        try:
+            parameters = list(signature(handler).parameters)
+        except (TypeError, ValueError):
+            continue
+        if 'instruction_pointer' in parameters:
+            arguments[opcode] = parameters.index('instruction_pointer') - 1
+    return arguments
+
+
+def get_leaders(sub, control_opcodes, jump_arguments):
+    """Return the instructions starting a block: the ones a runner can
+    resume from, or get to through a jump or a return from a call."""
+
+    leaders = {0}
+    for ip, (frame, instr_type, rank_mask, param_mask, args) in enumerate(sub):
+        if ip > 0 and frame != sub[ip - 1][0]:
+            leaders.add(ip)
+        if instr_type in control_opcodes:
+            leaders.add(ip + 1)
+        index = jump_arguments.get(instr_type)
+        if index is not None and index < len(args) and isinstance(args[index], int):
+            leaders.add(args[index])
+    return sorted(ip for ip in leaders if 0 <= ip < len(sub))
+
+
+def generate_block(sub_id, sub, start, end, handlers, control_opcodes):
+    """Return the source of the function running the instructions of the
+    sub from start to end, which all share the same frame."""
+
+    lines = ['def sub_%d_%d(self, rank, frame, ip):' % (sub_id, start),
+             '    if frame < %d:' % sub[start][0],
+             '        self.instruction_pointer = ip',
+             '        return SUSPENDED',
+             '    if frame == %d:' % sub[start][0]]
+    append = lines.append
+
+    for ip in range(start, end):
+        frame, instr_type, rank_mask, param_mask, args = sub[ip]
+
+        # Only a control instruction can have sent the runner in the middle
+        # of the block.
+        conditions = [] if ip == start else ['ip <= %d' % ip]
+        if rank_mask & 0xff00 != 0xff00:
+            conditions.append('rank & %#x' % rank_mask)
+        indent = '        '
+        if conditions:
+            append('        if %s:' % ' and '.join(conditions))
+            indent = '            '
+
+        arguments = ''.join(', ' + literal(arg) for arg in args)
+        if instr_type not in handlers:
+            append(indent + "logger.debug('[%%d %%r - %%04d] unhandled opcode %%d (args: %%r)', "
+                   "id(self), [self.sub] + [e[0] for e in self.stack], frame, %d, (%s))"
+                   % (instr_type, ''.join(literal(arg) + ', ' for arg in args)))
+        elif instr_type in control_opcodes:
+            append(indent + 'self.instruction_pointer = %d' % (ip + 1))
+            append(indent + 'h%d(self%s)' % (instr_type, arguments))
+            append(indent + 'if not self.running or self.sub != %d:' % sub_id)
+            append(indent + '    return SWITCHED')
+            append(indent + 'return self.instruction_pointer')
+        else:
+            append(indent + 'h%d(self%s)' % (instr_type, arguments))
+
+    append('    return %d' % end)
+    return '\n'.join(lines)
+
+
+def generate_sub(sub_id, sub, handlers, control_opcodes, jump_arguments):
+    """Return the source of the function running the sub, after the ones of
+    its blocks.
+
+    Every instruction maps to the block it is in, so that resuming the sub
+    or jumping in it costs the same wherever it goes to.
+    """
+
+    leaders = get_leaders(sub, control_opcodes, jump_arguments)
+    ends = leaders[1:] + [len(sub)]
+    parts = [generate_block(sub_id, sub, start, end, handlers, control_opcodes)
+             for start, end in zip(leaders, ends)]
+
+    blocks = []
+    for start, end in zip(leaders, ends):
+        blocks.extend(['sub_%d_%d' % (sub_id, start)] * (end - start))
+    parts.append('blocks_%d = (%s)' % (sub_id, ''.join(block + ', ' for block in blocks)))
+
+    parts.append('\n'.join(['def sub_%d(self):' % sub_id,
+                            '    rank = 0x100 << self._game.rank',
+                            '    ip = self.instruction_pointer',
+                            '    while ip < %d:' % len(sub),
+                            '        ip = blocks_%d[ip](self, rank, self.frame, ip)' % sub_id,
+                            '        if ip < 0:',
+                            '            return ip == SWITCHED',
+                            '    # Past the end of the sub.',
+                            '    self.instruction_pointer = ip',
+                            '    self.running = False',
+                            '    return False']))
+    return '\n\n\n'.join(parts)
+
+
+def generate_source(subs, handlers, control_opcodes, jump_arguments):
+    """Return the source of the module running the subs."""
+
+    parts = ['# Generated from ECL by pytouhou.vm.eclcompiler, do not edit.',
+             'SUSPENDED = %d\nSWITCHED = %d' % (SUSPENDED, SWITCHED)]
+    for sub_id, sub in enumerate(subs):
+        parts.append(generate_sub(sub_id, sub, handlers, control_opcodes, jump_arguments))
+    parts.append('subs = [%s]' % ', '.join('sub_%d' % i for i in range(len(subs))))
+    return '\n\n\n'.join(parts) + '\n'
+
+
+
+class ECLCompiler:
+    """Compiler of ECL subs, keeping its output in directory.
+
+    Instance variables:
+    hits -- number of ECL files found already compiled
+    misses -- number of ECL files which had to be compiled
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = save_cache_path('pytouhou', 'ecl')
+        self.directory = directory
+        self.handlers = ECLRunner._handlers[6]
+        self.control_opcodes = get_control_opcodes(self.handlers)
+        self.jump_arguments = get_jump_arguments(self.handlers)
+        self.hits = 0
+        self.misses = 0
+
+
+    def get_key(self, subs):
+        # The generated code depends on which instructions are implemented,
+        # and on which of them can jump.
+        return source_hash(repr((COMPILER_VERSION, sorted(self.handlers),
+                                 sorted(self.control_opcodes),
+                                 sorted(self.jump_arguments.items()), subs)).encode())
+
+
+    def get_path(self, key):
+        return os.path.join(self.directory, 'ecl-%s.pyc' % key.hex())
+
+
+    def get(self, key):
+        """Return the cached code object, or None."""
+
+        try:
+            with open(self.get_path(key), 'rb') as file:
+                data = file.read()
+        except IOError:
+            return None
+
+        if (data[:4] != MAGIC_NUMBER or data[4:8] != _pyc_flags or
+                data[8:16] != key):
+            return None
+        try:
+            return marshal.loads(data[16:])
+        except (EOFError, ValueError, TypeError):
+            logger.warn('Corrupted compiled ECL %s, ignoring.', key.hex())
+            return None
+
+
+    def put(self, key, code):
+        path = self.get_path(key)
+        temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), get_ident())
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(MAGIC_NUMBER)
+                file.write(_pyc_flags)
+                file.write(key)
+                file.write(marshal.dumps(code))
+            os.replace(temp_path, path)
+        except IOError:
+            logger.warn('Failed to write the compiled ECL %s.', key.hex())
+
+
+    def compile(self, subs):
+        """Return the list of the compiled subs, in the order of subs."""
+
+        key = self.get_key(subs)
+        code = self.get(key)
+        if code is None:
+            self.misses += 1
+            source = generate_source(subs, self.handlers, self.control_opcodes,
+                                     self.jump_arguments)
+            code = compile(source, '<ecl %s>' % key.hex(), 'exec')
+            self.put(key, code)
+        else:
+            self.hits += 1
+
+        namespace = {'h%d' % opcode: handler
+                     for opcode, handler in self.handlers.items()}
+        namespace['logger'] = runner_logger
+        exec(code, namespace)
+        return namespace['subs']
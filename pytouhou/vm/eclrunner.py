@@ -16,20 +16,25 @@
 from math import atan2, cos, sin, pi, hypot
 
 from pytouhou.utils.helpers import get_logger
+from pytouhou.utils.interpolator import Formula
 
 from pytouhou.vm.common import MetaRegistry, instruction
 
 logger = get_logger(__name__)
 
+# Wake frame of the runners whose sub is over.
+NEVER = float('inf')
+
 
 
 class ECLMainRunner(metaclass=MetaRegistry):
-    __slots__ = ('_main', '_subs', '_game', 'frame',
+    __slots__ = ('_main', '_subs', '_compiled', '_game', 'frame',
                  'instruction_pointer', 'boss_wait', 'handlers')
 
-    def __init__(self, main, subs, game):
+    def __init__(self, main, subs, game, compiled=None):
         self._main = main
         self._subs = subs
+        self._compiled = compiled
         self._game = game
         self.handlers = self._handlers[6]
         self.frame = 0
@@ -77,8 +82,11 @@ class ECLMainRunner(metaclass=MetaRegistry):
                 z = self._game.prng.rand_double() * 800
         enemy = self._game.new_enemy((x, y, z), life, instr_type,
                                      bonus_dropped, die_score)
-        enemy.process = ECLRunner(self._subs, sub, enemy, self._game, self._pop_enemy) #TODO
-        enemy.process.run_iteration()
+        enemy.process = process = ECLRunner(self._subs, sub, enemy, self._game, self._pop_enemy, self._compiled) #TODO
+        process.run_iteration()
+        # The new enemy will get updated once more this frame, so its runner
+        # will get called one game frame earlier than it expects.
+        process.wake_frame -= 1
 
 
     @instruction(0)
@@ -118,13 +126,14 @@ class ECLMainRunner(metaclass=MetaRegistry):
 
 
 class ECLRunner(metaclass=MetaRegistry):
-    __slots__ = ('_subs', '_enemy', '_game', '_pop_enemy', 'variables', 'sub',
-                 'frame', 'instruction_pointer', 'comparison_reg', 'stack',
-                 'running', 'handlers')
+    __slots__ = ('_subs', '_compiled', '_enemy', '_game', '_pop_enemy',
+                 'variables', 'sub', 'frame', 'instruction_pointer',
+                 'comparison_reg', 'stack', 'running', 'wake_frame', 'handlers')
 
-    def __init__(self, subs, sub, enemy, game, pop_enemy):
+    def __init__(self, subs, sub, enemy, game, pop_enemy, compiled=None):
         # Things not supposed to change
         self._subs = subs
+        self._compiled = compiled  # Subs compiled by ECLCompiler, if any.
         self._enemy = enemy
         self._game = game
         self._pop_enemy = pop_enemy
@@ -149,10 +158,51 @@ class ECLRunner(metaclass=MetaRegistry):
         self.frame = 0
         self.sub = sub
         self.instruction_pointer = 0
+        self.wake_frame = 0
 
 
     def run_iteration(self):
-        # Process script
+        if self._compiled is not None:
+            self.run_compiled()
+        else:
+            self.run_interpreted()
+
+        self.frame += 1
+
+        # Until the next instruction, the next calls would only increment
+        # the frame, and once the sub is over they would do nothing at all.
+        # Advance the frame at once instead, and tell our enemy on which game
+        # frame to call us next.
+        if not self.running:
+            self.wake_frame = NEVER
+            return
+        try:
+            frame = self._subs[self.sub][self.instruction_pointer][0]
+        except IndexError:
+            # Ending the sub is the only thing left to do.
+            self.wake_frame = self._game.frame + 1
+            return
+        if frame > self.frame:
+            self.wake_frame = self._game.frame + 1 + frame - self.frame
+            self.frame = frame
+        else:
+            self.wake_frame = self._game.frame + 1
+
+
+    def run_compiled(self):
+        # A compiled sub returns True when the runner switched to another
+        # one, which then has to run from where it is.
+        while self.running:
+            try:
+                sub = self._compiled[self.sub]
+            except IndexError:
+                self.running = False
+                break
+            if not sub(self):
+                break
+
+
+    def run_interpreted(self):
         while self.running:
             try:
                 frame, instr_type, rank_mask, param_mask, args = self._subs[self.sub][self.instruction_pointer]
@@ -178,8 +228,6 @@ class ECLRunner(metaclass=MetaRegistry):
                 else:
                     callback(self, *args)
 
-        self.frame += 1
-
 
     def _getval(self, value):
         if -10012 <= value <= -10001:
@@ -495,38 +543,38 @@ class ECLRunner(metaclass=MetaRegistry):
     @instruction(52)
     def move_in_decel(self, duration, angle, speed):
         self._enemy.angle, self._enemy.speed = angle, speed
-        self._enemy.stop_in(duration, lambda x: 2. * x - x ** 2)
+        self._enemy.stop_in(duration, Formula.FORMULA_DECELERATE)
 
 
     @instruction(56)
     def move_to_linear(self, duration, x, y, z):
         self._enemy.move_to(duration,
                             self._getval(x), self._getval(y), self._getval(z),
-                            None)
+                            Formula.FORMULA_LINEAR)
 
 
     @instruction(57)
     def move_to_decel(self, duration, x, y, z):
         self._enemy.move_to(duration,
                             self._getval(x), self._getval(y), self._getval(z),
-                            lambda x: 2. * x - x ** 2)
+                            Formula.FORMULA_DECELERATE)
 
 
     @instruction(59)
     def move_to_accel(self, duration, x, y, z):
         self._enemy.move_to(duration,
                             self._getval(x), self._getval(y), self._getval(z),
-                            lambda x: x ** 2)
+                            Formula.FORMULA_ACCELERATE)
 
 
     @instruction(61)
     def stop_in(self, duration):
-        self._enemy.stop_in(duration, None)
+        self._enemy.stop_in(duration, Formula.FORMULA_LINEAR)
 
 
     @instruction(63)
     def stop_in_accel(self, duration):
-        self._enemy.stop_in(duration, lambda x: 1. - x)
+        self._enemy.stop_in(duration, Formula.FORMULA_REVERSE)
 
 
     @instruction(65)
@@ -117,7 +117,7 @@ def extract_module_types(packages):
     py_modules = []
     ext_modules = []
     for package_name, package in packages.items():
-        if package_name in ('pytouhou.ui', 'pytouhou.ui.sdl'):
+        if package_name in ('pytouhou.ui', 'pytouhou.ui.sdl', 'pytouhou.ui.software'):
             package_args = sdl_args
         elif package_name == 'pytouhou.ui.opengl':
             package_args = opengl_args